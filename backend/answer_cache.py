@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Персистентный кэш ответов LLM (SQLite рядом с DB_PATH).
+
+Ключ — sha256(модель, системный промпт, нормализованный вопрос, id найденных
+чанков): тот же вопрос по тем же фрагментам отвечается без вызова GigaChat.
+Рядом с ответом хранится версия коллекции — после любой записи в Milvus
+старые ответы считаются промахом. Записи живут ANSWER_CACHE_TTL секунд,
+при превышении ANSWER_CACHE_MAX_ITEMS вытесняются давно не использованные.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List
+
+# Если запускаешь из папки backend/, гарантируем импорт конфига из корня
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from backend.config import ANSWER_CACHE_ENABLED, ANSWER_CACHE_PATH, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ITEMS
+from backend.embed_cache import normalize_text
+
+def answer_key(model: str, system_prompt: str, question: str, chunk_ids: Iterable[str]) -> bytes:
+    h = hashlib.sha256()
+    for part in (model, system_prompt, normalize_text(question).casefold(), *chunk_ids):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.digest()
+
+def hit_ids(hits: List[Dict[str, Any]]) -> List[str]:
+    """Идентификаторы фрагментов выдачи search(): id строки и склеенные chunk_ids."""
+    out = []
+    for h in hits:
+        ent = h.get("entity", {})
+        out.append(f"{h.get('id')}:{ent.get('doc_name')}:{ent.get('chunk_ids') or ent.get('chunk_id')}")
+    return out
+
+def doc_chunk_ids(docs: List[Dict[str, Any]]) -> List[str]:
+    """То же для выдачи search_grouped_by_doc."""
+    return [f"{c.get('id')}:{d['doc_name']}:{c.get('chunk_ids') or c.get('chunk_id')}"
+            for d in docs for c in d["chunks"]]
+
+class AnswerCache:
+    def __init__(self, path: str, ttl: float, max_items: int):
+        self.ttl = ttl
+        self.max_items = max(1, max_items)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " key BLOB PRIMARY KEY, version INTEGER NOT NULL, answer TEXT NOT NULL,"
+            " created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS answers_lru ON answers(last_used)")
+
+    def get(self, key: bytes, version: int) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT version, answer, created FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] == version and (self.ttl <= 0 or now - row[2] < self.ttl):
+                self._db.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return row[1]
+            if row is not None:
+                # коллекция изменилась или запись протухла
+                self._db.execute("DELETE FROM answers WHERE key = ?", (key,))
+            self.misses += 1
+            return None
+
+    def put(self, key: bytes, version: int, answer: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                                 (key, version, answer, now, now))
+                extra = self._db.execute("SELECT COUNT(*) FROM answers").fetchone()[0] - self.max_items
+                if extra > 0:
+                    self._db.execute(
+                        "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_used LIMIT ?)",
+                        (extra,),
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = self._db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": (self.hits / total) if total else 0.0, "size": size}
+
+@lru_cache(maxsize=1)
+def get_answer_cache() -> AnswerCache | None:
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    return AnswerCache(ANSWER_CACHE_PATH, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ITEMS)
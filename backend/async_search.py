@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Асинхронный поиск для бота.
+
+Эмбеддинг запроса — из тех же кэшей, что и у синхронного поиска (L1 в памяти,
+затем дисковый кэш эмбеддингов), промах — через aiohttp с общим пулом соединений
+к /embed (keep-alive, не больше EMBED_HTTP_POOL_SIZE соединений), поиск в Milvus —
+в отдельном пуле потоков MILVUS_SEARCH_WORKERS, чтобы не занимать ни event loop,
+ни дефолтный executor (там идёт индексация). Сам поиск — те же функции
+backend/searcher.py с готовым вектором запроса.
+"""
+
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, List, Sequence
+
+import aiohttp
+import numpy as np
+
+# Если запускаешь из папки backend/, гарантируем импорт конфига из корня
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from backend.config import SERVICE_URL, EMBED_WIRE_FORMAT, EMBED_HTTP_POOL_SIZE, MILVUS_SEARCH_WORKERS, TOP_K_DEFAULT
+from backend import wire, metrics
+from backend.searcher import search, search_grouped_by_doc, cached_query_vector, remember_query_vector
+from backend.embed_cache import get_embedding_cache, cache_key
+
+_milvus_pool = ThreadPoolExecutor(max_workers=MILVUS_SEARCH_WORKERS, thread_name_prefix="milvus-search")
+
+# -------------------- HTTP-клиент к сервису эмбеддингов --------------------
+_session: aiohttp.ClientSession | None = None
+_session_loop: asyncio.AbstractEventLoop | None = None
+
+async def _get_session() -> aiohttp.ClientSession:
+    """Одна сессия на event loop: соединения к /embed переиспользуются между запросами."""
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        if _session is not None and not _session.closed:
+            # сессия прошлого event loop — закрываем, иначе коннектор и его сокеты утекают
+            await _session.close()
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=EMBED_HTTP_POOL_SIZE, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=60),
+        )
+        _session_loop = loop
+    return _session
+
+async def close_http_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+async def aembed_queries(texts: List[str]) -> np.ndarray:
+    metrics.observe_batch("embed_query", len(texts))
+    with metrics.span("embed_query"):
+        async with (await _get_session()).post(
+            f"{SERVICE_URL}/embed",
+            json={"texts": texts},
+            headers={"Accept": wire.accept_header(EMBED_WIRE_FORMAT)},
+        ) as resp:
+            resp.raise_for_status()
+            if resp.content_type == wire.MEDIA_TYPE:
+                return wire.decode(await resp.read(), resp.headers)
+            payload = await resp.json()
+    if "embeddings" not in payload:
+        raise RuntimeError("Сервис вернул некорректный ответ: нет ключа 'embeddings'")
+    return np.array(payload["embeddings"], dtype=np.float32)
+
+async def aembed_query(query: str) -> np.ndarray:
+    """Как embed_query: L1, затем дисковый кэш эмбеддингов (в потоке — там SQLite), затем /embed."""
+    vec = cached_query_vector(query)
+    if vec is not None:
+        return vec
+    cache = get_embedding_cache()
+    key = cache_key(query)
+    if cache is not None:
+        vec = (await asyncio.to_thread(cache.get_many, [key])).get(key)
+        metrics.cache_hit("embeddings", vec is not None)
+    if vec is None:
+        vec = (await aembed_queries([query]))[0]
+        if cache is not None:
+            await asyncio.to_thread(cache.put_many, [key], vec[None, :])
+    remember_query_vector(query, vec)
+    return vec
+
+# -------------------- поиск --------------------
+async def _in_milvus_pool(fn, *args, **kwargs):
+    # run_in_executor, в отличие от to_thread, контекст не копирует — без этого стадии поиска не попадут в трассу
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_milvus_pool, partial(ctx.run, fn, *args, **kwargs))
+
+async def asearch(
+    query: str,
+    top_k: int = TOP_K_DEFAULT,
+    owner: str | None = None,
+    doc_names: Sequence[str] | None = None,
+) -> List[Dict[str, Any]]:
+    query_vec = await aembed_query(query)
+    return await _in_milvus_pool(search, query, top_k, query_vec=query_vec, owner=owner, doc_names=doc_names)
+
+async def asearch_grouped_by_doc(
+    query: str,
+    top_docs: int = 5,
+    chunks_per_doc: int = 3,
+    oversample: int = 80,
+    owner: str | None = None,
+    doc_names: Sequence[str] | None = None,
+) -> List[Dict[str, Any]]:
+    query_vec = await aembed_query(query)
+    return await _in_milvus_pool(search_grouped_by_doc, query, top_docs, chunks_per_doc, oversample,
+                                 query_vec=query_vec, owner=owner, doc_names=doc_names)
@@ -25,29 +25,149 @@ BASE_DIR = ROOT_DIR
 DB_DIR = BASE_DIR / "db"
 DB_DIR.mkdir(exist_ok=True)
 
-DB_PATH = str(DB_DIR / "milvus.db")  # единый путь
+# единый путь; относительный MILVUS_DB_PATH — от корня проекта (бенчмарк держит свою базу отдельно)
+DB_PATH = str(BASE_DIR / os.getenv("MILVUS_DB_PATH", "db/milvus.db"))
+MANIFEST_PATH = os.getenv("MANIFEST_PATH", str(Path(DB_PATH).with_name("manifest.sqlite")))  # что уже проиндексировано
 
 # === Milvus ===
+# Адрес Milvus-сервера (http://host:19530); пусто — Milvus Lite в файле DB_PATH.
+# Служебные файлы (манифест, версии, кэши) в любом случае лежат рядом с DB_PATH.
+MILVUS_URI = os.getenv("MILVUS_URI", "").strip()
 COLLECTION = os.getenv("COLLECTION_NAME", "pdf_embeddings")
 VECTOR_FIELD = os.getenv("VECTOR_FIELD", "vector")
+# Поле owner (id пользователя бота, "" — общие документы из CLI) как partition key:
+# поиск с фильтром по владельцу идёт только по его партиции. Задаёт схему — только для новой коллекции.
+OWNER_PARTITION_KEY = os.getenv("OWNER_PARTITION_KEY", "true").strip().lower() in ("1", "true", "yes", "y", "on")
+OWNER_PARTITIONS = int(os.getenv("OWNER_PARTITIONS", "16"))
 
 # === Embeddings ===
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "jinaai/jina-embeddings-v3")
 DIMENSION = int(os.getenv("DIMENSION", "1024"))
 
+# Хранение векторов (backend/vector_storage.py): full — DIMENSION float32 в индексе,
+# truncated — в индексе Matryoshka-срез STORE_DIM в STORE_DTYPE, полные векторы в файле рядом
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "full").strip().lower()
+STORE_DIM = int(os.getenv("STORE_DIM", "256"))
+STORE_DTYPE = os.getenv("STORE_DTYPE", "float32").strip().lower()    # float32 | float16 | binary (последние — не Lite)
+RESCORE_FACTOR = int(os.getenv("RESCORE_FACTOR", "4"))              # кандидатов на пересчёт по полным векторам
+FULL_VECTORS_PATH = os.getenv("FULL_VECTORS_PATH", str(DB_DIR / f"{COLLECTION}.full.f32"))
+
 # === Deploy service ===
 SERVICE_HOST = os.getenv("SERVICE_HOST", "0.0.0.0")
 SERVICE_PORT = int(os.getenv("SERVICE_PORT", "8000"))
 SERVICE_URL  = os.getenv("SERVICE_URL", f"http://localhost:{SERVICE_PORT}")
 
+# === Батчинг в сервисе эмбеддингов ===
+EMBED_MAX_LENGTH = int(os.getenv("EMBED_MAX_LENGTH", "512"))                 # окно модели в токенах
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))       # сколько ждём соседние запросы
+EMBED_MAX_BATCH_SIZE = int(os.getenv("EMBED_MAX_BATCH_SIZE", "32"))          # текстов в одном forward
+EMBED_MAX_BATCH_TOKENS = int(os.getenv("EMBED_MAX_BATCH_TOKENS", "8192"))    # токенов (с паддингом) в одном forward
+EMBED_MAX_QUEUE_TEXTS = int(os.getenv("EMBED_MAX_QUEUE_TEXTS", "256"))       # максимум текстов за одно окно
+
+# Бэкенд инференса на хосте эмбеддингов: torch | int8 | onnx | onnx_int8 (см. backend/inference.py)
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch").strip().lower()
+EMBED_ONNX_PATH = Path(os.getenv("EMBED_ONNX_PATH", str(DB_DIR / "onnx" / "model.onnx")))
+EMBED_CPU_THREADS = int(os.getenv("EMBED_CPU_THREADS", "0"))                 # 0 — по умолчанию библиотеки
+# При старте сравнить не-torch бэкенд с fp32 по косинусу; ниже порога — предупреждение
+EMBED_AGREEMENT_CHECK = os.getenv("EMBED_AGREEMENT_CHECK", "true").strip().lower() in ("1", "true", "yes", "y", "on")
+EMBED_AGREEMENT_MIN = float(os.getenv("EMBED_AGREEMENT_MIN", "0.99"))
+
+# Формат ответа /embed для клиентов: float32 | float16 (бинарный, см. backend/wire.py) | json
+EMBED_WIRE_FORMAT = os.getenv("EMBED_WIRE_FORMAT", "float32").strip().lower()
+
+# === Кэш эмбеддингов (на диске, общий для бота и индексатора) ===
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "true").strip().lower() in ("1", "true", "yes", "y", "on")
+EMBED_CACHE_DIR = Path(os.getenv("EMBED_CACHE_DIR", str(DB_DIR / "embed_cache")))
+EMBED_CACHE_MAX_ITEMS = int(os.getenv("EMBED_CACHE_MAX_ITEMS", "50000"))   # ~200 МБ при D=1024
+
+# === Индексация ===
+# PDF: страницы разбираются диапазонами по PDF_PAGES_PER_TASK в общем пуле из PDF_EXTRACT_WORKERS процессов;
+# документы короче PDF_PARALLEL_MIN_PAGES страниц и загрузки в боте — в текущем процессе
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "32"))
+# Разобранный текст документов кэшируется по хэшу файла
+PARSED_CACHE_ENABLED = os.getenv("PARSED_CACHE_ENABLED", "true").strip().lower() in ("1", "true", "yes", "y", "on")
+PARSED_CACHE_DIR = Path(os.getenv("PARSED_CACHE_DIR", str(DB_DIR / "parsed")))
+# Нарезка: words — по словам (700/120), tokens — токенизатором модели под окно EMBED_MAX_LENGTH
+CHUNK_MODE = os.getenv("CHUNK_MODE", "words").strip().lower()
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", str(EMBED_MAX_LENGTH)))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))
+INDEX_EMBED_INFLIGHT = int(os.getenv("INDEX_EMBED_INFLIGHT", "4"))           # батчей эмбеддингов в полёте
+INDEX_INSERT_BATCH_ROWS = int(os.getenv("INDEX_INSERT_BATCH_ROWS", "512"))   # строк в одном milvus.insert
+
 # === Бот ===
 UPLOADS_DIR = BASE_DIR / "uploads"
 UPLOADS_DIR.mkdir(exist_ok=True)
+# Асинхронный путь вопросов: соединений к /embed, потоков под поиск в Milvus, лимиты параллельности
+EMBED_HTTP_POOL_SIZE = int(os.getenv("EMBED_HTTP_POOL_SIZE", "16"))
+MILVUS_SEARCH_WORKERS = int(os.getenv("MILVUS_SEARCH_WORKERS", "4"))
+BOT_MAX_CONCURRENT_QUESTIONS = int(os.getenv("BOT_MAX_CONCURRENT_QUESTIONS", "16"))   # на весь бот
+BOT_USER_MAX_CONCURRENCY = int(os.getenv("BOT_USER_MAX_CONCURRENCY", "1"))            # на одного пользователя
+# Очередь индексации загрузок: воркеров, всего ждущих файлов, ждущих от одного пользователя
+INDEX_QUEUE_WORKERS = int(os.getenv("INDEX_QUEUE_WORKERS", "1"))        # Milvus Lite — один файл, больше 1-2 нет смысла
+INDEX_QUEUE_MAX_PENDING = int(os.getenv("INDEX_QUEUE_MAX_PENDING", "32"))
+INDEX_QUEUE_MAX_PER_USER = int(os.getenv("INDEX_QUEUE_MAX_PER_USER", "5"))
+INDEX_PROGRESS_INTERVAL = float(os.getenv("INDEX_PROGRESS_INTERVAL", "3.0"))   # секунд между правками статуса
+# Стриминг ответа: одно сообщение дописывается правками не чаще раза в BOT_STREAM_EDIT_INTERVAL секунд
+BOT_STREAM_ANSWERS = os.getenv("BOT_STREAM_ANSWERS", "true").strip().lower() in ("1", "true", "yes", "y", "on")
+BOT_STREAM_EDIT_INTERVAL = float(os.getenv("BOT_STREAM_EDIT_INTERVAL", "1.0"))
+# Область поиска по вопросу: own — документы, загруженные этим пользователем, и общие (из CLI), all — вся база
+BOT_SEARCH_SCOPE = os.getenv("BOT_SEARCH_SCOPE", "own").strip().lower()
 
 # === Метрики поиска ===
 SEARCH_METRIC = os.getenv("SEARCH_METRIC", "IP")
 TOP_K_DEFAULT = int(os.getenv("TOP_K_DEFAULT", "5"))
 
+# Профиль ANN-индекса: auto (AUTOINDEX) | flat | hnsw | ivf_flat | ivf_sq8; подбор — backend/tune_index.py
+INDEX_PROFILE = os.getenv("INDEX_PROFILE", "auto").strip().lower()
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+IVF_NLIST = int(os.getenv("IVF_NLIST", "1024"))
+SEARCH_EF = int(os.getenv("SEARCH_EF", "64"))            # hnsw: не меньше limit запроса
+SEARCH_NPROBE = int(os.getenv("SEARCH_NPROBE", "16"))    # ivf_*: сколько кластеров просматривать
+
+# Группировка по документам: auto | native (group_by_field Milvus) | two_phase | oversample (старый режим)
+SEARCH_GROUPING = os.getenv("SEARCH_GROUPING", "auto").strip().lower()
+SEARCH_GROUP_MAX_LIMIT = int(os.getenv("SEARCH_GROUP_MAX_LIMIT", "1024"))   # потолок адаптивного окна two_phase
+
+# Режим поиска: dense — только Milvus, hybrid — Milvus + BM25 с reciprocal rank fusion
+SEARCH_MODE = os.getenv("SEARCH_MODE", "dense").strip().lower()
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+LEXICAL_INDEX_ENABLED = os.getenv("LEXICAL_INDEX_ENABLED", "true").strip().lower() in ("1", "true", "yes", "y", "on")
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", str(DB_DIR / f"{COLLECTION}.lexical.sqlite"))
+
+# Постобработка выдачи: MMR по векторам кандидатов (MMR_FETCH_FACTOR * top_k);
+# склейка соседних чанков — только при упаковке контекста для LLM, выдача search() не меняется
+MMR_ENABLED = os.getenv("MMR_ENABLED", "true").strip().lower() in ("1", "true", "yes", "y", "on")
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))               # 1 — только релевантность, 0 — только разнообразие
+MMR_FETCH_FACTOR = int(os.getenv("MMR_FETCH_FACTOR", "4"))
+MERGE_NEIGHBOURS = os.getenv("MERGE_NEIGHBOURS", "true").strip().lower() in ("1", "true", "yes", "y", "on")
+
+# Бюджет контекста для LLM в токенах; оценка токенов — длина текста / CONTEXT_CHARS_PER_TOKEN.
+# Чанк по умолчанию — 700 слов (~1400 токенов), склеенный спан — 3-4 тыс.: каждый фрагмент
+# обрезается до CONTEXT_SPAN_MAX_TOKENS вокруг лучшего чанка, в бюджет входит ~8 таких
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_SPAN_MAX_TOKENS = int(os.getenv("CONTEXT_SPAN_MAX_TOKENS", "700"))     # 0 — не обрезать
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "3.5"))   # ~3-4 для русского текста
+CONTEXT_MIN_SPAN_TOKENS = int(os.getenv("CONTEXT_MIN_SPAN_TOKENS", "48"))      # короче не обрезаем — пропускаем
+
+# === Кэши поиска (в памяти процесса) ===
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "1024"))        # текст запроса -> вектор (LRU)
+SEARCH_RESULT_CACHE_SIZE = int(os.getenv("SEARCH_RESULT_CACHE_SIZE", "1024"))    # (вектор, top_k, версия) -> хиты
+SEARCH_RESULT_CACHE_TTL = float(os.getenv("SEARCH_RESULT_CACHE_TTL", "300"))     # секунд
+
+# === Кэш ответов LLM (SQLite, переживает рестарт; сбрасывается при изменении коллекции) ===
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").strip().lower() in ("1", "true", "yes", "y", "on")
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", str(DB_DIR / "answers.sqlite"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))          # секунд, 0 — без срока
+ANSWER_CACHE_MAX_ITEMS = int(os.getenv("ANSWER_CACHE_MAX_ITEMS", "5000"))
+
+# === Метрики и тайминги стадий (backend/metrics.py) ===
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").strip().lower() in ("1", "true", "yes", "y", "on")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))                      # /metrics бота и индексатора, 0 — не поднимать
+METRICS_SLOW_SECONDS = float(os.getenv("METRICS_SLOW_SECONDS", "5.0"))  # трасса медленнее — разбивка по стадиям в лог
+
 # === GigaChat (если используешь OpenAI-совместимое API) ===
 GIGACHAT_API_URL = os.getenv("GIGACHAT_API_URL")
 GIGACHAT_API_KEY = os.getenv("GIGACHAT_API_KEY")
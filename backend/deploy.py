@@ -3,29 +3,167 @@
 
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+import numpy as np
 import torch
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from pydantic import BaseModel
 from transformers import AutoTokenizer, AutoModel
 import uvicorn
 
-from backend.config import EMBEDDING_MODEL_NAME, DIMENSION, SERVICE_HOST, SERVICE_PORT, HF_TOKEN
+from backend.config import (
+    EMBEDDING_MODEL_NAME, DIMENSION, SERVICE_HOST, SERVICE_PORT, HF_TOKEN,
+    EMBED_MAX_LENGTH, EMBED_BATCH_WINDOW_MS, EMBED_MAX_BATCH_SIZE,
+    EMBED_MAX_BATCH_TOKENS, EMBED_MAX_QUEUE_TEXTS,
+    EMBED_BACKEND, EMBED_ONNX_PATH, EMBED_CPU_THREADS, EMBED_AGREEMENT_CHECK, EMBED_AGREEMENT_MIN,
+)
+from backend import wire, metrics
+from backend.inference import TorchEncoder, make_encoder, cosine_agreement, AGREEMENT_TEXTS
 
+# int8 и ONNX Runtime — CPU-бэкенды
 device = (
-    "cuda" if torch.cuda.is_available()
+    "cpu" if EMBED_BACKEND != "torch"
+    else "cuda" if torch.cuda.is_available()
     else ("mps" if hasattr(torch.backends, "mps") and torch.backends.mps.is_available()
           else "cpu")
 )
 
 # === Загружаем модель один раз при старте ===
-print(f"🚀 Загружаем модель {EMBEDDING_MODEL_NAME} на {device}...")
+print(f"🚀 Загружаем модель {EMBEDDING_MODEL_NAME} на {device} (бэкенд {EMBED_BACKEND})...")
 tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL_NAME, trust_remote_code=True, token=HF_TOKEN)
 model = AutoModel.from_pretrained(EMBEDDING_MODEL_NAME, trust_remote_code=True, token=HF_TOKEN)
 if device == "cuda":
     model = model.half()
 model = model.eval().to(device)
+encoder = TorchEncoder(model, device)
+
+def _length_buckets(lengths: list[int]) -> list[list[int]]:
+    """
+    Группирует индексы текстов по длине в токенах: сортируем по длине и режем
+    на батчи не больше EMBED_MAX_BATCH_SIZE текстов и EMBED_MAX_BATCH_TOKENS токенов
+    с учётом паддинга. Похожие по длине тексты почти не добивают паддингом.
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    buckets: list[list[int]] = []
+    cur: list[int] = []
+    for i in order:
+        # длины отсортированы, значит текущая — максимальная в батче
+        if cur and (len(cur) >= EMBED_MAX_BATCH_SIZE
+                    or (len(cur) + 1) * lengths[i] > EMBED_MAX_BATCH_TOKENS):
+            buckets.append(cur)
+            cur = []
+        cur.append(i)
+    if cur:
+        buckets.append(cur)
+    return buckets
+
+def encode_texts(texts: list[str]) -> np.ndarray:
+    """
+    Токенизирует без паддинга, гоняет encoder по бакетам длины и собирает [N, D] в исходном порядке.
+    Пулинг и нормализация — backend/inference.pool для любого бэкенда.
+    """
+    with metrics.span("tokenize"):
+        enc = tokenizer(texts, truncation=True, max_length=EMBED_MAX_LENGTH, padding=False)
+    ids = enc["input_ids"]
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+    out: np.ndarray | None = None
+    for bucket in _length_buckets([len(x) for x in ids]):
+        max_len = max(len(ids[i]) for i in bucket)
+        input_ids = torch.full((len(bucket), max_len), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(bucket), max_len), dtype=torch.long)
+        for row, i in enumerate(bucket):
+            input_ids[row, : len(ids[i])] = torch.tensor(ids[i], dtype=torch.long)
+            attention_mask[row, : len(ids[i])] = 1
+        metrics.observe_batch("model_batch", len(bucket))
+        metrics.observe_tokens("model_batch", len(bucket) * max_len)
+        metrics.observe_tokens("model_padding", len(bucket) * max_len - sum(len(ids[i]) for i in bucket))
+        with metrics.span("model_forward"):
+            vecs = encoder.embed(input_ids, attention_mask)
+        if out is None:
+            out = np.empty((len(texts), vecs.shape[1]), dtype=np.float32)
+        out[bucket] = vecs
+    return out if out is not None else np.zeros((0, DIMENSION), dtype=np.float32)
+
+# === Бэкенд инференса ===
+backend_agreement: dict | None = None
+if EMBED_BACKEND != "torch":
+    # эталон fp32 считаем до замены: int8 квантует модель на месте
+    reference = encode_texts(AGREEMENT_TEXTS) if EMBED_AGREEMENT_CHECK else None
+    encoder = make_encoder(EMBED_BACKEND, model, device, EMBED_ONNX_PATH, EMBED_CPU_THREADS)
+    if reference is not None:
+        backend_agreement = cosine_agreement(reference, encode_texts(AGREEMENT_TEXTS))
+        print(f"🔍 Согласие {EMBED_BACKEND} с fp32: mean cos={backend_agreement['mean_cos']:.4f}, "
+              f"min cos={backend_agreement['min_cos']:.4f}")
+        if backend_agreement["min_cos"] < EMBED_AGREEMENT_MIN:
+            print(f"⚠️ min cos ниже EMBED_AGREEMENT_MIN={EMBED_AGREEMENT_MIN} — качество поиска может просесть")
+    if EMBED_BACKEND.startswith("onnx"):
+        model = None   # граф в ONNX Runtime, torch-модель больше не нужна
 print("✅ Модель готова!")
 
+# === Микробатчинг ===
+@dataclass
+class _EmbedJob:
+    texts: list[str]
+    future: Future = field(default_factory=Future)
+
+class MicroBatcher:
+    """
+    Планировщик /embed: один фоновый поток забирает запросы из очереди, ждёт
+    соседние в пределах окна EMBED_BATCH_WINDOW_MS, склеивает их тексты в общий
+    прогон через encode_texts и раздаёт каждому вызывающему его строки.
+    """
+
+    def __init__(self, window_ms: float, max_queue_texts: int):
+        self.window = max(0.0, window_ms) / 1000.0
+        self.max_queue_texts = max(1, max_queue_texts)
+        self._queue: "queue.Queue[_EmbedJob]" = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="embed-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, texts: list[str]) -> np.ndarray:
+        job = _EmbedJob(texts)
+        self._queue.put(job)
+        return job.future.result()
+
+    def _collect(self) -> list[_EmbedJob]:
+        jobs = [self._queue.get()]
+        total = len(jobs[0].texts)
+        deadline = time.monotonic() + self.window
+        while total < self.max_queue_texts:
+            timeout = deadline - time.monotonic()
+            try:
+                job = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            jobs.append(job)
+            total += len(job.texts)
+        return jobs
+
+    def _loop(self) -> None:
+        while True:
+            jobs = self._collect()
+            texts = [t for job in jobs for t in job.texts]
+            metrics.observe_batch("merged_requests", len(jobs))
+            metrics.observe_batch("merged_texts", len(texts))
+            try:
+                embeddings = encode_texts(texts)
+            except Exception as e:
+                for job in jobs:
+                    job.future.set_exception(e)
+                continue
+            offset = 0
+            for job in jobs:
+                job.future.set_result(embeddings[offset : offset + len(job.texts)])
+                offset += len(job.texts)
+
+batcher = MicroBatcher(EMBED_BATCH_WINDOW_MS, EMBED_MAX_QUEUE_TEXTS)
+
 # === FastAPI ===
 app = FastAPI(title="Jina Embedding Service")
 
@@ -37,37 +175,37 @@ class EmbedResponse(BaseModel):
 
 @app.get("/healthz")
 def healthz():
-    return {"status": "ok", "device": device, "model": EMBEDDING_MODEL_NAME}
+    return {
+        "status": "ok",
+        "device": device,
+        "model": EMBEDDING_MODEL_NAME,
+        "backend": EMBED_BACKEND,
+        "agreement": backend_agreement,
+        "batch_window_ms": EMBED_BATCH_WINDOW_MS,
+        "max_batch_size": EMBED_MAX_BATCH_SIZE,
+    }
 
 @app.post("/embed", response_model=EmbedResponse)
-def embed(req: EmbedRequest):
+def embed(req: EmbedRequest, request: Request):
+    wire_dtype = wire.negotiate(request.headers.get("accept"))
     if not req.texts:
-        return {"embeddings": []}
-
-    with torch.no_grad():
-        toks = tokenizer(
-            req.texts,
-            padding=True,
-            truncation=True,
-            max_length=512,
-            return_tensors="pt"
-        ).to(device)
-
-        outputs = model(**toks)
-        last_hidden = outputs.last_hidden_state
-        mask = toks["attention_mask"].unsqueeze(-1)
-
-        # mean pooling
-        masked = last_hidden * mask
-        sum_vec = masked.sum(dim=1)
-        lengths = mask.sum(dim=1).clamp(min=1)
-        mean_vec = sum_vec / lengths
-
-        # L2 нормализация
-        mean_vec = torch.nn.functional.normalize(mean_vec, p=2, dim=1)
-
-        embeddings = mean_vec.cpu().to(torch.float32).numpy().tolist()
-        return {"embeddings": embeddings}
+        embeddings = np.zeros((0, DIMENSION), dtype=np.float32)
+    else:
+        # синхронный эндпоинт FastAPI крутится в threadpool — конкурентные вызовы
+        # блокируются здесь и попадают в общий батч
+        metrics.observe_batch("embed_request", len(req.texts))
+        with metrics.span("embed_request"):   # ожидание в очереди + прогон общего батча
+            embeddings = batcher.submit(req.texts)
+
+    if wire_dtype is not None:
+        body, headers = wire.encode(embeddings, wire_dtype)
+        return Response(content=body, media_type=wire.MEDIA_TYPE, headers=headers)
+    return {"embeddings": embeddings.tolist()}
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Текстовый формат Prometheus (METRICS_ENABLED=false — только заголовки метрик)."""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 if __name__ == "__main__":
     uvicorn.run(app, host=SERVICE_HOST, port=SERVICE_PORT, reload=False)
\ No newline at end of file
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Постобработка выдачи поиска.
+
+Чанки нарезаются с перекрытием, поэтому соседние chunk_id одного документа
+почти совпадают и съедают бюджет контекста. Здесь:
+  mmr()            — maximal marginal relevance на NumPy: из кандидатов
+                     выбираются релевантные запросу, но непохожие друг на друга;
+  merge_neighbours — соседние chunk_id одного документа склеиваются в один
+                     спан, перекрытие текста выкидывается.
+"""
+
+from typing import Any, Dict, List
+
+import numpy as np
+
+def mmr(query_vec: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float = 0.7) -> List[int]:
+    """
+    Индексы k выбранных строк vectors в порядке выбора.
+    score_i = lambda * sim(q, d_i) - (1 - lambda) * max_j∈выбранные sim(d_i, d_j);
+    векторы L2-нормализованы, так что sim — скалярное произведение.
+    """
+    n = len(vectors)
+    k = min(k, n)
+    if k <= 0:
+        return []
+    vectors = np.asarray(vectors, dtype=np.float32)
+    relevance = vectors @ np.asarray(query_vec, dtype=np.float32)
+    similarity = vectors @ vectors.T
+    redundancy = np.zeros(n, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    selected: List[int] = []
+    for _ in range(k):
+        scores = np.where(available, lambda_mult * relevance - (1.0 - lambda_mult) * redundancy, -np.inf)
+        i = int(np.argmax(scores))
+        selected.append(i)
+        available[i] = False
+        np.maximum(redundancy, similarity[i], out=redundancy)
+    return selected
+
+def join_overlapping(a: str, b: str, anchor: int = 16) -> str:
+    """
+    a + b без повторения перекрытия: самый длинный хвост a, с которого начинается b.
+    Кандидаты ищутся по первым anchor символам b — перекрытия короче не убираются.
+    """
+    if not a:
+        return b
+    if not b:
+        return a
+    head = b[: min(anchor, len(b))]
+    p = a.find(head)
+    while p != -1:
+        if b.startswith(a[p:]):
+            return a + b[len(a) - p:]
+        p = a.find(head, p + 1)
+    return a + " " + b
+
+def merge_neighbours(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    chunks — dict с doc_name, chunk_id, text, score (+ owner, page, id и прочее).
+    Документ — пара (owner, doc_name). Цепочки соседних chunk_id одного документа становятся одним спаном:
+    текст склеен без перекрытия, score — лучший в цепочке, page/id/chunk_id — первого
+    чанка, chunk_ids — все, hit_range — (начало, конец) текста лучшего чанка в тексте спана
+    (вокруг него контекст обрезает длинные спаны). Порядок спанов — по убыванию score.
+    """
+    doc = lambda c: (c.get("owner") or "", c.get("doc_name") or "")
+    ordered = sorted((c for c in chunks if c.get("chunk_id") is not None), key=lambda c: (*doc(c), c["chunk_id"]))
+    spans: List[Dict[str, Any]] = []
+    for c in ordered:
+        last = spans[-1] if spans else None
+        if (last is not None and doc(last) == doc(c)
+                and c["chunk_id"] == last["chunk_ids"][-1] + 1):
+            text = c.get("text") or ""
+            last["text"] = join_overlapping(last["text"], text)
+            if c["score"] > last["score"]:
+                last["score"] = c["score"]
+                last["hit_range"] = (len(last["text"]) - len(text), len(last["text"]))
+            last["chunk_ids"].append(c["chunk_id"])
+        elif last is not None and doc(last) == doc(c) and c["chunk_id"] == last["chunk_ids"][-1]:
+            continue   # дубль того же чанка
+        else:
+            text = c.get("text") or ""
+            spans.append({**c, "text": text, "chunk_ids": [c["chunk_id"]], "hit_range": (0, len(text))})
+    # без chunk_id склеивать не с чем
+    spans += [{**c, "chunk_ids": []} for c in chunks if c.get("chunk_id") is None]
+    return sorted(spans, key=lambda s: s["score"], reverse=True)
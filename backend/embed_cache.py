@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Персистентный кэш эмбеддингов с адресацией по содержимому.
+
+Ключ — sha1(модель, бэкенд инференса, размерность, max_length, нормализованный
+текст). Векторы лежат в memory-mapped файле float32 [capacity, D], индекс
+ключ -> слот и время последнего обращения — в SQLite рядом. При заполнении
+вытесняются самые давно использованные записи (LRU).
+
+Файлы общие для бота и CLI-индексатора, поэтому файл векторов читается и
+пишется только под блокировкой записи SQLite (BEGIN IMMEDIATE). Запись идёт
+в два шага: сначала слоты закрепляются за ключами (ready = 0) и вытеснение
+коммитится, затем в них пишутся векторы и записи помечаются ready = 1.
+Упавший между шагами процесс не портит чужие векторы: читаются только
+ready-записи, а зависшие незавершённые через PENDING_TTL_S вытесняются.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+# Если запускаешь из папки backend/, гарантируем импорт конфига из корня
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from backend.config import (
+    EMBEDDING_MODEL_NAME, DIMENSION, EMBED_MAX_LENGTH, EMBED_BACKEND,
+    EMBED_CACHE_ENABLED, EMBED_CACHE_DIR, EMBED_CACHE_MAX_ITEMS,
+)
+from backend import metrics
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def cache_key(text: str, model: str = EMBEDDING_MODEL_NAME, max_length: int = EMBED_MAX_LENGTH,
+              backend: str = EMBED_BACKEND, dim: int = DIMENSION) -> bytes:
+    # int8 / onnx дают чуть другие векторы, чем torch, а dim — Matryoshka-срез модели
+    h = hashlib.sha1()
+    h.update(f"{model}\x00{backend}\x00{dim}\x00{max_length}\x00".encode("utf-8"))
+    h.update(normalize_text(text).encode("utf-8"))
+    return h.digest()
+
+# незавершённая запись (ready = 0) старше этого считается брошенной упавшим процессом
+PENDING_TTL_S = 600
+
+# ключей в одном "IN (?, …)": у SQLite ограничено число параметров запроса (999 до 3.32)
+SQL_IN_BATCH = 500
+
+def _select_in(db: sqlite3.Connection, sql: str, keys: list[bytes]) -> list[tuple]:
+    """sql с одним "IN ({})" для всех keys — пачками по SQL_IN_BATCH параметров."""
+    rows: list[tuple] = []
+    for i in range(0, len(keys), SQL_IN_BATCH):
+        part = keys[i : i + SQL_IN_BATCH]
+        rows += db.execute(sql.format(",".join("?" * len(part))), part).fetchall()
+    return rows
+
+class EmbeddingCache:
+    def __init__(self, directory: Path, dim: int, capacity: int):
+        self.dim = dim
+        self.capacity = max(1, capacity)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(directory / "index.sqlite"), timeout=30,
+                                   check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key BLOB PRIMARY KEY, slot INTEGER NOT NULL UNIQUE, last_used REAL NOT NULL,"
+            " ready INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries(last_used)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER NOT NULL)")
+
+        vec_path = directory / "vectors.f32"
+        stored = dict(self._db.execute("SELECT k, v FROM meta").fetchall())
+        if stored.get("dim") != dim or stored.get("capacity") != self.capacity or not vec_path.exists():
+            # геометрия поменялась — старые слоты невалидны
+            self._db.execute("DELETE FROM entries")
+            self._db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                 [("dim", dim), ("capacity", self.capacity)])
+            self._vectors = np.memmap(vec_path, dtype=np.float32, mode="w+", shape=(self.capacity, dim))
+        else:
+            self._vectors = np.memmap(vec_path, dtype=np.float32, mode="r+", shape=(self.capacity, dim))
+
+    # -------------------- чтение --------------------
+    def get_many(self, keys: list[bytes]) -> dict[bytes, np.ndarray]:
+        found: dict[bytes, np.ndarray] = {}
+        if not keys:
+            return found
+        uniq = list(dict.fromkeys(keys))
+        with self._lock:
+            # под блокировкой записи: пока читаем слот, другой процесс не перезапишет его
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = _select_in(self._db, "SELECT key, slot FROM entries WHERE ready = 1 AND key IN ({})", uniq)
+                for k, slot in rows:
+                    found[bytes(k)] = np.array(self._vectors[slot])
+                now = time.time()
+                self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?",
+                                     [(now, k) for k, _ in rows])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            hit = sum(1 for k in keys if k in found)
+            self.hits += hit
+            self.misses += len(keys) - hit
+        return found
+
+    # -------------------- запись --------------------
+    def put_many(self, keys: list[bytes], vectors: np.ndarray) -> None:
+        items = dict(zip(keys, vectors))
+        if not items:
+            return
+        with self._lock:
+            # шаг 1: закрепить слоты за ключами и закоммитить вытеснение
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                stale = now - PENDING_TTL_S
+                rows = _select_in(self._db, "SELECT key, slot, ready, last_used FROM entries WHERE key IN ({})",
+                                  list(items))
+                # брошенную упавшим процессом запись того же ключа дописываем в её слот
+                retake = {bytes(k): slot for k, slot, ready, used in rows if not ready and used < stale}
+                existing = {bytes(k) for k, _, _, _ in rows}
+                new = [k for k in items if k not in existing]
+                slots = self._allocate(len(new), stale)
+                self._db.executemany("INSERT INTO entries VALUES (?, ?, ?, 0)",
+                                     [(k, slot, now) for k, slot in zip(new, slots)])
+                self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, k) for k in retake])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            jobs = dict(zip(new, slots)) | retake
+            if not jobs:
+                return
+            # шаг 2: векторы — только в слоты, которые всё ещё наши
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                owned = [(bytes(k), slot) for k, slot in _select_in(
+                    self._db, "SELECT key, slot FROM entries WHERE ready = 0 AND key IN ({})", list(jobs))
+                    if jobs.get(bytes(k)) == slot]
+                for k, slot in owned:
+                    self._vectors[slot] = items[k]
+                self._vectors.flush()
+                self._db.executemany("UPDATE entries SET ready = 1 WHERE key = ?", [(k,) for k, _ in owned])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _allocate(self, n: int, stale: float) -> list[int]:
+        """
+        Свободные слоты, при нехватке — вытеснение LRU среди готовых записей и
+        брошенных незавершённых (last_used < stale). Вызывается внутри транзакции.
+        """
+        n = min(n, self.capacity)
+        if n <= 0:
+            return []
+        # слоты освобождаются только здесь и сразу переиспользуются,
+        # поэтому занятые слоты всегда образуют префикс 0..count-1
+        count = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        free = list(range(count, min(count + n, self.capacity)))
+        if len(free) < n:
+            victims = self._db.execute(
+                "SELECT key, slot FROM entries WHERE ready = 1 OR last_used < ? ORDER BY last_used LIMIT ?",
+                (stale, n - len(free)),
+            ).fetchall()
+            self._db.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k, _ in victims])
+            free += [s for _, s in victims]
+        return free
+
+    # -------------------- статистика --------------------
+    def stats(self) -> dict:
+        with self._lock:
+            size = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "size": size,
+                "capacity": self.capacity,
+            }
+
+@lru_cache(maxsize=1)
+def get_embedding_cache() -> EmbeddingCache | None:
+    if not EMBED_CACHE_ENABLED:
+        return None
+    return EmbeddingCache(EMBED_CACHE_DIR, DIMENSION, EMBED_CACHE_MAX_ITEMS)
+
+def embed_with_cache(texts: list[str], embed_fn: Callable[[list[str]], np.ndarray]) -> np.ndarray:
+    """
+    Возвращает эмбеддинги [N, D] для texts, вызывая embed_fn только для промахов
+    (каждый уникальный текст — один раз). Без кэша просто проксирует в embed_fn.
+    """
+    cache = get_embedding_cache()
+    if cache is None or not texts:
+        return embed_fn(texts)
+
+    keys = [cache_key(t) for t in texts]
+    found = cache.get_many(keys)
+
+    missing: dict[bytes, str] = {}
+    for k, t in zip(keys, texts):
+        if k not in found and k not in missing:
+            missing[k] = t
+    metrics.cache_hit("embeddings", True, len(found))
+    metrics.cache_hit("embeddings", False, len(missing))
+    if missing:
+        vecs = embed_fn(list(missing.values()))
+        fresh = dict(zip(missing, vecs))
+        cache.put_many(list(fresh), vecs)
+        found.update(fresh)
+
+    out = np.empty((len(texts), cache.dim), dtype=np.float32)
+    for i, k in enumerate(keys):
+        out[i] = found[k]
+    return out
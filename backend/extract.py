@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Извлечение текста документов (PDF / DOCX / TXT) и кэш разобранного текста.
+
+Модуль нарочно лёгкий — только PyMuPDF, python-docx и конфиг: его функции
+выполняются в процессах-воркерах (spawn), и каждый воркер импортирует модуль
+заново. Тяжёлые зависимости индексатора (pymilvus, requests, токенизатор)
+сюда не тянуть.
+
+PDF разбирается диапазонами по PDF_PAGES_PER_TASK страниц в одном на процесс
+пуле из PDF_EXTRACT_WORKERS процессов; документы короче PDF_PARALLEL_MIN_PAGES
+страниц — в текущем процессе (запуск воркеров дороже разбора).
+Бот разбирает PDF в своём процессе (pdf_workers=1): spawn-воркер заново
+импортирует главный скрипт, а у бота это весь frontend_tg/app.py.
+"""
+
+import json
+import multiprocessing
+import os
+import re
+import threading
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import fitz
+import pymupdf4llm
+import docx
+
+# Если запускаешь из папки backend/, гарантируем импорт конфига из корня
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from backend.config import (
+    PDF_EXTRACT_WORKERS, PDF_PAGES_PER_TASK, PDF_PARALLEL_MIN_PAGES, PARSED_CACHE_ENABLED, PARSED_CACHE_DIR,
+)
+from backend import metrics
+from backend.manifest import file_hash
+
+def clean_ws(s: str) -> str:
+    return re.sub(r"\s+", " ", s).strip()
+
+# -------------------- PDF --------------------
+_pdf_pool: ProcessPoolExecutor | None = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """Пул страниц PDF — один на процесс, воркеры запускаются один раз и живут до выхода."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn, а не fork: в процессе уже живут потоки gRPC клиента Milvus
+            _pdf_pool = ProcessPoolExecutor(max_workers=max(1, PDF_EXTRACT_WORKERS),
+                                            mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+def _drop_pdf_pool(pool: ProcessPoolExecutor) -> None:
+    """Воркер упал (битый PDF уронил MuPDF) — пул сломан, следующий вызов создаст новый."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False)
+
+def _pdf_pages_markdown(path: str, start: int, end: int) -> list[str]:
+    """Markdown страниц [start, end) — единица работы для пула процессов."""
+    doc = fitz.open(path)
+    try:
+        pages = pymupdf4llm.to_markdown(doc, pages=list(range(start, end)), page_chunks=True, show_progress=False)
+    finally:
+        doc.close()
+    return [clean_ws(p.get("text", "")) for p in pages]
+
+def load_pdf_pages(path: str, workers: int | None = PDF_EXTRACT_WORKERS) -> list[str]:
+    """
+    Текст PDF постранично. Диапазоны по PDF_PAGES_PER_TASK страниц раздаются
+    общему пулу процессов, результат склеивается в порядке страниц.
+    workers <= 1 или меньше PDF_PARALLEL_MIN_PAGES страниц — в текущем процессе.
+    """
+    doc = fitz.open(path)
+    n_pages = doc.page_count
+    doc.close()
+    ranges = [(s, min(s + PDF_PAGES_PER_TASK, n_pages)) for s in range(0, n_pages, PDF_PAGES_PER_TASK)]
+    if (workers or 1) <= 1 or len(ranges) <= 1 or n_pages < PDF_PARALLEL_MIN_PAGES:
+        return [p for s, e in ranges for p in _pdf_pages_markdown(path, s, e)]
+    pool = _get_pdf_pool()
+    try:
+        parts = pool.map(_pdf_pages_markdown, [path] * len(ranges), *zip(*ranges))
+        return [p for part in parts for p in part]
+    except BrokenProcessPool:
+        _drop_pdf_pool(pool)
+        raise
+
+def load_pdf(path: str) -> str:
+    return " ".join(p for p in load_pdf_pages(path) if p)
+
+# -------------------- TXT / DOCX --------------------
+def load_txt(path: str) -> str:
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        return clean_ws(f.read())
+
+def load_docx(path: str) -> str:
+    d = docx.Document(path)
+    paras = [p.text for p in d.paragraphs if p.text]
+    return clean_ws("\n".join(paras))
+
+def extract_text(path: str) -> tuple[str, str]:
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":  return load_pdf(path), "pdf"
+    if ext == ".txt":  return load_txt(path), "txt"
+    if ext == ".docx": return load_docx(path), "docx"
+    raise ValueError(f"Неизвестный формат {ext}")
+
+# -------------------- разобранный документ --------------------
+@dataclass
+class ParsedDocument:
+    text: str
+    doc_type: str
+    # (смещение в text, номер страницы с 1) для начала каждой непустой страницы; пусто — без страниц
+    page_starts: list[tuple[int, int]] = field(default_factory=list)
+
+    def page_at(self, offset: int) -> int | None:
+        if not self.page_starts:
+            return None
+        i = bisect_right(self.page_starts, (offset, float("inf"))) - 1
+        return self.page_starts[max(i, 0)][1]
+
+def _parsed_cache_path(content_hash: str) -> Path:
+    return PARSED_CACHE_DIR / f"{content_hash}.json"
+
+def extract_document(path: str, content_hash: str | None = None, pdf_workers: int | None = PDF_EXTRACT_WORKERS) -> ParsedDocument:
+    """
+    extract_text с номерами страниц для PDF и кэшем разобранного текста на диске
+    по хэшу файла: повторная нарезка с другими параметрами не парсит файл заново.
+    """
+    content_hash = content_hash or file_hash(path)
+    cache_path = _parsed_cache_path(content_hash)
+    if PARSED_CACHE_ENABLED and cache_path.exists():
+        try:
+            data = json.loads(cache_path.read_text(encoding="utf-8"))
+            metrics.cache_hit("parsed", True)
+            return ParsedDocument(data["text"], data["doc_type"], [tuple(x) for x in data["page_starts"]])
+        except (OSError, ValueError, KeyError):
+            pass  # битый кэш — просто парсим заново
+
+    metrics.cache_hit("parsed", False)
+    ext = os.path.splitext(path)[1].lower()
+    with metrics.span("extract"):
+        if ext == ".pdf":
+            parts, page_starts, offset = [], [], 0
+            for page_no, page in enumerate(load_pdf_pages(path, pdf_workers), start=1):
+                if not page:
+                    continue
+                if parts:
+                    offset += 1  # пробел-разделитель
+                page_starts.append((offset, page_no))
+                parts.append(page)
+                offset += len(page)
+            parsed = ParsedDocument(" ".join(parts), "pdf", page_starts)
+        else:
+            parsed = ParsedDocument(*extract_text(path))
+
+    if PARSED_CACHE_ENABLED:
+        PARSED_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps({"text": parsed.text, "doc_type": parsed.doc_type,
+                                   "page_starts": parsed.page_starts}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, cache_path)
+    return parsed
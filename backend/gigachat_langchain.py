@@ -2,8 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
 from functools import lru_cache
-from typing import Optional
+from typing import AsyncIterator, Iterator, Optional
 from pathlib import Path
 # Если запускаешь из папки backend/, гарантируем импорт конфига из корня
 import sys
@@ -22,12 +23,17 @@ except Exception:
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_gigachat.chat_models import GigaChat
 
+from backend import metrics
+
 def _bool_env(name: str, default: bool = True) -> bool:
     v = os.getenv(name)
     if v is None:
         return default
     return v.strip().lower() in ("1", "true", "yes", "y", "on")
 
+def gigachat_model() -> str:
+    return os.getenv("GIGACHAT_MODEL", "GigaChat-2")
+
 @lru_cache(maxsize=1)
 def get_gigachat() -> GigaChat:
     """
@@ -53,7 +59,7 @@ def get_gigachat() -> GigaChat:
             "Проверь .env."
         )
 
-    model = os.getenv("GIGACHAT_MODEL", "GigaChat-2")
+    model = gigachat_model()
     scope = os.getenv("GIGACHAT_SCOPE", "GIGACHAT_API_PERS")
     verify_ssl = _bool_env("GIGACHAT_VERIFY_SSL", True)
 
@@ -73,5 +79,51 @@ def lc_answer(system_prompt: str, user_prompt: str) -> str:
         SystemMessage(content=system_prompt),
         HumanMessage(content=user_prompt),
     ]
-    res = giga.invoke(msgs)
-    return res.content
\ No newline at end of file
+    with metrics.span("llm"):
+        res = giga.invoke(msgs)
+    return res.content
+
+async def alc_answer(system_prompt: str, user_prompt: str) -> str:
+    """Асинхронный lc_answer: ainvoke не блокирует event loop бота."""
+    giga = get_gigachat()
+    msgs = [
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=user_prompt),
+    ]
+    with metrics.span("llm"):
+        res = await giga.ainvoke(msgs)
+    return res.content
+
+# --------- стриминг: ответ по кусочкам по мере генерации ---------
+
+def lc_stream(system_prompt: str, user_prompt: str) -> Iterator[str]:
+    giga = get_gigachat()
+    msgs = [
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=user_prompt),
+    ]
+    started = time.perf_counter()
+    first = True
+    with metrics.span("llm"):
+        for chunk in giga.stream(msgs):
+            if chunk.content:
+                if first:
+                    metrics.record_stage("llm_first_token", time.perf_counter() - started)
+                    first = False
+                yield chunk.content
+
+async def alc_stream(system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+    giga = get_gigachat()
+    msgs = [
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=user_prompt),
+    ]
+    started = time.perf_counter()
+    first = True
+    with metrics.span("llm"):
+        async for chunk in giga.astream(msgs):
+            if chunk.content:
+                if first:
+                    metrics.record_stage("llm_first_token", time.perf_counter() - started)
+                    first = False
+                yield chunk.content
@@ -1,172 +1,682 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import glob
+import multiprocessing
 import os
 import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
 import requests
 import numpy as np
-import fitz
-import pymupdf4llm
-import docx
 from tqdm import tqdm
-from pymilvus import MilvusClient, DataType
 
 # Если запускаешь из папки backend/, гарантируем импорт конфига из корня
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
-from backend.config import DB_PATH, COLLECTION, VECTOR_FIELD, DIMENSION, SERVICE_URL
+from backend.config import (
+    BASE_DIR, DB_PATH, COLLECTION, VECTOR_FIELD, DIMENSION, SERVICE_URL, EMBED_WIRE_FORMAT,
+    INDEX_EMBED_INFLIGHT, INDEX_INSERT_BATCH_ROWS, EMBEDDING_MODEL_NAME, HF_TOKEN,
+    CHUNK_MODE, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS,
+    METRICS_ENABLED, PDF_EXTRACT_WORKERS,
+)
+from backend import wire, metrics
+from backend.embed_cache import embed_with_cache, get_embedding_cache
+# извлечение текста — в отдельном лёгком модуле: его импортируют процессы-воркеры
+from backend.extract import (
+    clean_ws, load_pdf, load_pdf_pages, load_txt, load_docx, extract_text, ParsedDocument, extract_document,
+)
+from backend.manifest import get_manifest, file_hash, text_hash
+from backend.lexical import DocumentPostings, get_lexical_index
+from backend.vector_storage import TRUNCATED, ROW_FIELD, reduce_vectors, get_full_vectors
+from backend.milvus_store import (
+    MilvusStore, get_store, bump_collection_version, milvus_str,
+    ensure_collection, load_collection, collection_fields,
+)
 
 # -------------------- utils --------------------
-def clean_ws(s: str) -> str:
-    return re.sub(r"\s+", " ", s).strip()
-
-def load_pdf(path: str) -> str:
-    doc = fitz.open(path)
-    md = pymupdf4llm.to_markdown(doc)
-    doc.close()
-    return clean_ws(md)
-
-def load_txt(path: str) -> str:
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        return clean_ws(f.read())
-
-def load_docx(path: str) -> str:
-    d = docx.Document(path)
-    paras = [p.text for p in d.paragraphs if p.text]
-    return clean_ws("\n".join(paras))
-
-def extract_text(path: str) -> tuple[str, str]:
-    ext = os.path.splitext(path)[1].lower()
-    if ext == ".pdf":  return load_pdf(path), "pdf"
-    if ext == ".txt":  return load_txt(path), "txt"
-    if ext == ".docx": return load_docx(path), "docx"
-    raise ValueError(f"Неизвестный формат {ext}")
+DOC_NAME_MAX_BYTES = 512   # max_length поля doc_name в схеме коллекции
 
-def chunk_text(text: str, chunk_size: int = 700, overlap: int = 120) -> list[str]:
-    words = text.split()
-    chunks = []
+def document_name(path: str, name: str | None = None) -> str:
+    """
+    Постоянное имя документа — ключ в манифесте, Milvus и BM25-индексе.
+    name (исходное имя загрузки в боте) берётся как есть, иначе — путь файла
+    относительно корня проекта (вне его — абсолютный), со слешами "/".
+    Одноимённые файлы из разных папок так не перетирают друг друга, а изменённый
+    файл под тем же именем заменяет свои старые чанки.
+    """
+    if name is None:
+        full = os.path.abspath(path)
+        rel = os.path.relpath(full, BASE_DIR)
+        name = full if rel == os.pardir or rel.startswith(os.pardir + os.sep) else rel
+        name = Path(name).as_posix()
+    name = unicodedata.normalize("NFC", name).strip()
+    if not name:
+        raise ValueError(f"Пустое имя документа для {path}")
+    if len(name.encode("utf-8")) > DOC_NAME_MAX_BYTES:
+        raise ValueError(f"Имя документа длиннее {DOC_NAME_MAX_BYTES} байт: {name[:80]}…")
+    return name
+
+def iter_chunk_spans(text: str, chunk_size: int = 700, overlap: int = 120) -> Iterator[tuple[int, str]]:
+    """
+    Ленивая версия chunk_text с тем же результатом: слова читаются через
+    re.finditer, в памяти держится только окно текущего чанка.
+    Отдаёт (смещение первого слова чанка в text, чанк).
+    """
     step = max(1, chunk_size - overlap)
-    for i in range(0, len(words), step):
-        part = words[i:i + chunk_size]
-        if not part:
-            break
-        chunks.append(" ".join(part))
-        if i + chunk_size >= len(words):
-            break
-    return chunks
+    window: deque[tuple[int, str]] = deque()
+    fresh = 0   # слов в окне, ещё не попавших ни в один чанк
+    skip = 0    # при step > chunk_size часть слов между чанками пропускается
+    for m in re.finditer(r"\S+", text):
+        if skip:
+            skip -= 1
+            continue
+        window.append((m.start(), m.group(0)))
+        fresh += 1
+        if len(window) == chunk_size:
+            yield window[0][0], " ".join(w for _, w in window)
+            fresh = 0
+            for _ in range(min(step, len(window))):
+                window.popleft()
+            skip = step - chunk_size if step > chunk_size else 0
+    if fresh:
+        yield window[0][0], " ".join(w for _, w in window)
+
+def iter_chunks(text: str, chunk_size: int = 700, overlap: int = 120) -> Iterator[str]:
+    return (chunk for _, chunk in iter_chunk_spans(text, chunk_size, overlap))
+
+def chunk_text(text: str, chunk_size: int = 700, overlap: int = 120) -> list[str]:
+    return list(iter_chunks(text, chunk_size=chunk_size, overlap=overlap))
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    it = iter(items)
+    while batch := list(islice(it, batch_size)):
+        yield batch
+
+# -------------------- нарезка по токенам --------------------
+# Предложение: до .!?… перед пробелом или до конца текста (переводов строк после clean_ws нет)
+_SENTENCE_RE = re.compile(r"\S.*?(?:[.!?…]+(?=\s|$)|$)")
+# текст без знаков препинания режется по пробелам на куски не длиннее этого до токенизации
+_SENTENCE_MAX_CHARS = 2000
+_TOKEN_COUNT_CACHE: "OrderedDict[str, int]" = OrderedDict()
+_TOKEN_COUNT_CACHE_SIZE = 100_000
+_TOKEN_COUNT_CACHE_MAX_CHARS = 1000   # длинные строки не кэшируются — повторяются редко, а память держат
+_token_cache_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    """Токенизатор модели эмбеддингов (transformers нужен только для режима tokens)."""
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(EMBEDDING_MODEL_NAME, trust_remote_code=True, token=HF_TOKEN)
+
+def count_tokens(texts: list[str]) -> list[int]:
+    """Число токенов (без спецтокенов) для списка текстов: один батч в токенизатор + LRU по тексту."""
+    counts: list[int | None] = [None] * len(texts)
+    missing: list[int] = []
+    with _token_cache_lock:
+        for i, t in enumerate(texts):
+            n = _TOKEN_COUNT_CACHE.get(t)
+            if n is None:
+                missing.append(i)
+            else:
+                _TOKEN_COUNT_CACHE.move_to_end(t)
+                counts[i] = n
+    if missing:
+        ids = get_tokenizer()([texts[i] for i in missing], add_special_tokens=False)["input_ids"]
+        with _token_cache_lock:
+            for i, x in zip(missing, ids):
+                counts[i] = len(x)
+                if len(texts[i]) <= _TOKEN_COUNT_CACHE_MAX_CHARS:
+                    _TOKEN_COUNT_CACHE[texts[i]] = len(x)
+            while len(_TOKEN_COUNT_CACHE) > _TOKEN_COUNT_CACHE_SIZE:
+                _TOKEN_COUNT_CACHE.popitem(last=False)
+    return counts
+
+def _split_by_tokens(offset: int, sentence: str, budget: int) -> Iterator[tuple[int, str, int]]:
+    """Режет слишком длинное предложение на куски по budget токенов по offset'ам токенизатора."""
+    offsets = get_tokenizer()(sentence, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    for s in range(0, len(offsets), budget):
+        window = offsets[s : s + budget]
+        piece = sentence[window[0][0] : window[-1][1]].strip()
+        if piece:
+            yield offset + window[0][0], piece, len(window)
+
+def _iter_sentences(text: str, max_chars: int = _SENTENCE_MAX_CHARS) -> Iterator[tuple[int, str]]:
+    """(смещение, предложение); предложения длиннее max_chars режутся по последнему пробелу до предела."""
+    for m in _SENTENCE_RE.finditer(text):
+        start, sent = m.start(), m.group(0).rstrip()
+        while len(sent) > max_chars:
+            cut = sent.rfind(" ", 0, max_chars + 1)
+            if cut <= 0:
+                cut = max_chars
+            yield start, sent[:cut].rstrip()
+            rest = sent[cut:]
+            start += cut + len(rest) - len(rest.lstrip())
+            sent = rest.lstrip()
+        if sent:
+            yield start, sent
+
+def _iter_token_units(text: str, budget: int, batch_size: int = 256) -> Iterator[tuple[int, str, int]]:
+    """(смещение, предложение, токенов) с токенизацией батчами; длинные предложения разбиты до budget."""
+    for batch in iter_batches(_iter_sentences(text), batch_size):
+        for (offset, sent), n in zip(batch, count_tokens([s for _, s in batch])):
+            if n <= budget:
+                yield offset, sent, n
+            else:
+                yield from _split_by_tokens(offset, sent, budget)
+
+def iter_token_chunk_spans(
+    text: str,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> Iterator[tuple[int, str]]:
+    """
+    Чанки, которые целиком влезают в окно модели (max_tokens вместе со спецтокенами).
+    Набираются целыми предложениями; следующий чанк начинается с хвостовых
+    предложений предыдущего суммарно не больше overlap_tokens.
+    Отдаёт (смещение начала чанка в text, чанк).
+    """
+    budget = max(1, max_tokens - get_tokenizer().num_special_tokens_to_add())
+    window: deque[tuple[int, str, int]] = deque()
+    total = 0
+    fresh = False
+    for offset, piece, n in _iter_token_units(text, budget):
+        if window and total + n > budget:
+            yield window[0][0], " ".join(p for _, p, _ in window)
+            keep: deque[tuple[int, str, int]] = deque()
+            kept = 0
+            for unit in reversed(window):
+                k = unit[2]
+                if kept + k > overlap_tokens or kept + k + n > budget:
+                    break
+                keep.appendleft(unit)
+                kept += k
+            window, total = keep, kept
+        window.append((offset, piece, n))
+        total += n
+        fresh = True
+    if fresh:
+        yield window[0][0], " ".join(p for _, p, _ in window)
+
+def iter_token_chunks(
+    text: str,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> Iterator[str]:
+    return (chunk for _, chunk in iter_token_chunk_spans(text, max_tokens, overlap_tokens))
+
+def make_chunker(
+    mode: str = CHUNK_MODE,
+    chunk_size_words: int = 700,
+    chunk_overlap_words: int = 120,
+    chunk_max_tokens: int = CHUNK_MAX_TOKENS,
+    chunk_overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> tuple[Callable[[str], Iterator[tuple[int, str]]], str]:
+    """
+    (функция нарезки, строка параметров для манифеста) для режима words или tokens.
+    Функция нарезки отдаёт (смещение в тексте, чанк).
+    """
+    if mode == "tokens":
+        return (lambda text: iter_token_chunk_spans(text, chunk_max_tokens, chunk_overlap_tokens),
+                f"tokens:{EMBEDDING_MODEL_NAME}:{chunk_max_tokens}:{chunk_overlap_tokens}")
+    if mode == "words":
+        return (lambda text: iter_chunk_spans(text, chunk_size_words, chunk_overlap_words),
+                f"words:{chunk_size_words}:{chunk_overlap_words}")
+    raise ValueError(f"Неизвестный режим нарезки {mode!r} (ожидается words или tokens)")
 
 def embed_via_service(texts: list[str]) -> np.ndarray:
     """Отправляем запрос к deploy.py (/embed) и получаем эмбеддинги [N, DIMENSION]."""
     if not texts:
         return np.zeros((0, DIMENSION), dtype=np.float32)
-    r = requests.post(f"{SERVICE_URL}/embed", json={"texts": texts}, timeout=120)
-    r.raise_for_status()
-    payload = r.json()
-    if "embeddings" not in payload:
-        raise RuntimeError("Сервис вернул некорректный ответ: нет ключа 'embeddings'")
-    arr = np.array(payload["embeddings"], dtype=np.float32)
+    metrics.observe_batch("embed_index", len(texts))
+    with metrics.span("embed_index"):
+        r = requests.post(
+            f"{SERVICE_URL}/embed",
+            json={"texts": texts},
+            headers={"Accept": wire.accept_header(EMBED_WIRE_FORMAT)},
+            timeout=120,
+        )
+        r.raise_for_status()
+        arr = wire.decode_response(r)
     if arr.ndim != 2 or arr.shape[1] != DIMENSION:
         raise RuntimeError(f"Ожидался массив [N,{DIMENSION}], получили {arr.shape}")
     return arr
 
-def ensure_collection(milvus: MilvusClient) -> None:
-    """Создаёт коллекцию и индекс при отсутствии. PK обязателен даже при auto_id=True."""
-    if milvus.has_collection(COLLECTION):
-        return
+def chunks_filter(doc_name: str, chunk_ids: Iterable[int] | None = None, owner: str | None = None) -> str | None:
+    """
+    Filter на строки документа: все или только указанные chunk_id (None — удалять нечего).
+    owner — владелец документа; None только для коллекций без поля owner (старая схема).
+    """
+    expr = f"doc_name == {milvus_str(doc_name)}"
+    if owner is not None:
+        expr = f"owner == {milvus_str(owner)} and " + expr
+    if chunk_ids is not None:
+        ids = sorted(set(int(c) for c in chunk_ids))
+        if not ids:
+            return None
+        expr += f" and chunk_id in {ids}"
+    return expr
 
-    schema = MilvusClient.create_schema(
-        auto_id=True,                 # генерируем PK автоматически
-        enable_dynamic_field=False,
-    )
-    schema.add_field("id", DataType.INT64, is_primary=True, auto_id=True)
-    schema.add_field(VECTOR_FIELD, DataType.FLOAT_VECTOR, dim=DIMENSION)
-    schema.add_field("text", DataType.VARCHAR, max_length=4096)
-    schema.add_field("doc_name", DataType.VARCHAR, max_length=512)
-    schema.add_field("doc_type", DataType.VARCHAR, max_length=16)
-    schema.add_field("chunk_id", DataType.INT64)
-
-    milvus.create_collection(
-        collection_name=COLLECTION,
-        schema=schema,
-        consistency_level="Strong",
-        num_shards=2,
-    )
-
-    # ВАЖНО: используем IndexParams, а не dict
-    index_params = milvus.prepare_index_params()
-    index_params.add_index(
-        field_name=VECTOR_FIELD,
-        index_type="AUTOINDEX",
-        metric_type="IP",   # косинус при L2-нормализованных векторах
-        params={},          # для AUTOINDEX можно пусто
-    )
-    milvus.create_index(
-        collection_name=COLLECTION,
-        index_params=index_params,
-    )
-
-def load_collection(milvus: MilvusClient) -> None:
-    try:
-        milvus.load_collection(collection_name=COLLECTION)
-    except Exception:
-        # В Milvus Lite это может быть no-op — ок.
-        pass
+# -------------------- запись в Milvus --------------------
+class MilvusWriter:
+    """
+    Буфер строк для Milvus, общий для одного или многих документов.
+    Пачка (удаления, вставка, колбэки) пишется в фоне, в полёте не больше одной;
+    удаления пачки выполняются до её вставки, колбэки — после.
+    """
+
+    def __init__(self, store: MilvusStore, batch_rows: int = INDEX_INSERT_BATCH_ROWS):
+        self.store = store
+        self.batch_rows = max(1, batch_rows)
+        store.ready()
+        self.fields = store.fields
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="milvus-insert")
+        self._inflight: Future | None = None
+        self._deletes: list[str] = []
+        self._rows: list[dict] = []
+        self._callbacks: list[Callable[[], None]] = []
+
+    def delete(self, doc_name: str, chunk_ids: Iterable[int] | None = None, owner: str = "") -> None:
+        # одноимённые документы других владельцев не трогаем
+        expr = chunks_filter(doc_name, chunk_ids, owner if "owner" in self.fields else None)
+        if expr is not None:
+            self._deletes.append(expr)
+
+    def add(self, rows: list[dict]) -> None:
+        # поля, которых нет в схеме коллекции, отбрасываем (enable_dynamic_field=False)
+        if rows and not rows[0].keys() <= self.fields:
+            rows = [{k: v for k, v in r.items() if k in self.fields} for r in rows]
+        self._rows.extend(rows)
+        if len(self._rows) >= self.batch_rows:
+            self.flush()
+
+    def after(self, callback: Callable[[], None]) -> None:
+        """Вызвать callback, когда всё добавленное до этого момента будет записано."""
+        self._callbacks.append(callback)
+
+    def flush(self) -> None:
+        self.wait()
+        if self._deletes or self._rows or self._callbacks:
+            batch = (self._deletes, self._rows, self._callbacks)
+            self._deletes, self._rows, self._callbacks = [], [], []
+            self._inflight = self._pool.submit(self._write, *batch)
+
+    def wait(self) -> None:
+        if self._inflight is not None:
+            fut, self._inflight = self._inflight, None
+            fut.result()
+
+    def close(self) -> None:
+        try:
+            self.flush()
+            self.wait()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def _write(self, deletes: list[str], rows: list[dict], callbacks: list[Callable[[], None]]) -> None:
+        for expr in deletes:
+            with metrics.span("milvus_delete"):
+                self.store.call(lambda c: c.delete(collection_name=COLLECTION, filter=expr))
+        if rows:
+            metrics.observe_batch("milvus_insert", len(rows))
+            with metrics.span("milvus_insert"):
+                # без повтора: после обрыва на ответе вставка могла пройти — повтор задвоил бы чанки
+                self.store.call(lambda c: c.insert(collection_name=COLLECTION, data=rows), retry=False)
+        if deletes or rows:
+            bump_collection_version()   # сбрасывает кэши результатов поиска
+        for cb in callbacks:
+            cb()
+
+# -------------------- индексация документа --------------------
+def _index_document(
+    fname: str,
+    doc: ParsedDocument,
+    content_hash: str,
+    params: str,
+    embed_pool: ThreadPoolExecutor,
+    writer: MilvusWriter,
+    chunker: Callable[[str], Iterator[tuple[int, str]]],
+    batch_size: int,
+    max_inflight: int,
+    force: bool = False,
+    on_chunks: Callable[[int], None] | None = None,
+    owner: str = "",
+) -> tuple[int, int]:
+    """
+    Конвейер одного документа: ленивые чанки chunker(doc.text) -> до max_inflight батчей эмбеддингов
+    в embed_pool -> строки в writer. Манифест и BM25-индекс документа обновляются,
+    когда строки записаны.
+    Возвращает (всего чанков, переэмбежено чанков).
+    """
+    manifest = get_manifest()
+    old_hashes = None if force else manifest.chunk_hashes(fname, owner)
+    if old_hashes is None:
+        # документ не в манифесте (или force) — заменяем все его строки
+        writer.delete(fname, owner=owner)
+        old_hashes = {}
+
+    new_hashes: dict[int, str] = {}
+    lexical = get_lexical_index()
+    postings = DocumentPostings() if lexical is not None else None
+    n_chunks = 0
+    n_embedded = 0
+    pending: deque[tuple[list[int], list[int], list[str], Future]] = deque()
+
+    def drain_one():
+        ids, pages, batch, fut = pending.popleft()
+        vecs = fut.result()  # [B, D]
+        # truncated: полные векторы — в файл рядом, в Milvus — срез и номер строки
+        rows = get_full_vectors().append(vecs).tolist() if TRUNCATED else [None] * len(ids)
+        # сначала убираем старые версии перезаписываемых чанков
+        writer.delete(fname, [cid for cid in ids if cid in old_hashes], owner)
+        writer.add([
+            {
+                # id НЕ передаём — auto_id=True
+                "text": chunk[:4096],
+                "doc_name": fname,
+                "doc_type": doc.doc_type,
+                "chunk_id": int(cid),
+                "page": page,
+                "owner": owner,
+                VECTOR_FIELD: vec,
+                ROW_FIELD: row,
+            }
+            for cid, page, chunk, vec, row in zip(ids, pages, batch, reduce_vectors(vecs), rows)
+        ])
+
+    # нарезка ленивая — её время набирается в next() между батчами
+    for batch in iter_batches(metrics.timed(chunker(doc.text), "chunk"), batch_size):
+        ids, pages, changed = [], [], []
+        for j, (offset, chunk) in enumerate(batch):
+            cid = n_chunks + j
+            h = new_hashes[cid] = text_hash(chunk)
+            if postings is not None:
+                postings.add(cid, chunk)   # BM25 строится по всем чанкам, не только изменённым
+            if old_hashes.get(cid) != h:
+                ids.append(cid)
+                pages.append(doc.page_at(offset) or 0)
+                changed.append(chunk)
+        n_chunks += len(batch)
+        if on_chunks is not None:
+            on_chunks(len(batch))
+        if not changed:
+            continue
+        # промахи кэша — в deploy.py
+        pending.append((ids, pages, changed, embed_pool.submit(embed_with_cache, changed, embed_via_service)))
+        n_embedded += len(changed)
+        if len(pending) >= max_inflight:
+            drain_one()
+    while pending:
+        drain_one()
+
+    # документ стал короче — хвост старых чанков больше не нужен
+    writer.delete(fname, [cid for cid in old_hashes if cid >= n_chunks], owner)
+    writer.after(lambda: manifest.record(fname, content_hash, params, new_hashes, owner))
+    if lexical is not None:
+        writer.after(lambda: lexical.replace_document(fname, postings, owner))
+    metrics.inc("chunks_indexed", n_chunks)
+    metrics.inc("chunks_embedded", n_embedded)
+    return n_chunks, n_embedded
+
+def _unchanged(doc_name: str, content_hash: str, params: str, owner: str) -> bool:
+    """
+    Документ уже в индексе с тем же содержимым и параметрами нарезки — файл можно пропустить.
+    Копия содержимого под другим именем индексируется под своим: эмбеддинги придут
+    из кэша, а замена и удаление по имени работают как для любого документа.
+    """
+    return get_manifest().version_of(doc_name, owner) == (content_hash, params)
+
+def _print_cache_stats() -> None:
+    cache = get_embedding_cache()
+    if cache is not None:
+        st = cache.stats()
+        print(f"   embed cache: hits={st['hits']} misses={st['misses']} "
+              f"hit_rate={st['hit_rate']:.1%} size={st['size']}/{st['capacity']}")
+
+def _print_stage_summary() -> None:
+    """Куда ушло время индексации (METRICS_ENABLED): стадии по убыванию суммарного времени."""
+    if not METRICS_ENABLED:
+        return
+    print("⏱️ Стадии:")
+    for stage, n, seconds in metrics.stage_summary():
+        print(f"   {stage:<14} {seconds:>9.2f} с  вызовов {n:<6} в среднем {1000 * seconds / max(n, 1):.1f} мс")
 
 # -------------------- главная функция --------------------
 def index_file(
     path: str,
     chunk_size_words: int = 700,
     chunk_overlap_words: int = 120,
+    chunk_mode: str = CHUNK_MODE,
     batch_size: int = 16,
-):
+    max_inflight: int = INDEX_EMBED_INFLIGHT,
+    insert_batch_rows: int = INDEX_INSERT_BATCH_ROWS,
+    force: bool = False,
+    content_hash: str | None = None,
+    on_chunks: Callable[[int], None] | None = None,
+    owner: str = "",
+    doc_name: str | None = None,
+    pdf_workers: int | None = PDF_EXTRACT_WORKERS,
+) -> dict:
     """
     Загружает файл, бьёт на чанки, получает эмбеддинги от deploy.py и индексирует в Milvus.
     Добавляет doc_name/doc_type/chunk_id. PK создаётся Milvus автоматически.
+
+    Работает конвейером: чанки нарезаются лениво, до max_inflight батчей
+    эмбеддингов считаются параллельно, готовые строки уходят в Milvus пачками
+    по insert_batch_rows в отдельном потоке. Память не растёт с размером документа.
+
+    Документ в индексе называется document_name(path, doc_name): путь от корня проекта
+    или переданное имя (бот передаёт исходное имя загрузки).
+    Инкрементальность через манифест (backend/manifest.py): неизменённый документ
+    пропускается сразу, у изменённого переэмбеддятся только чанки
+    с новым текстом, а их старые строки и лишние хвостовые чанки удаляются.
+    force=True переиндексирует документ целиком.
+
+    content_hash — уже посчитанный file_hash(path); on_chunks(n) вызывается по мере
+    нарезки (прогресс для бота). Возвращает {"doc_name", "chunks", "embedded", "skipped"},
+    skipped — документ не изменился и не переиндексировался.
+    owner — кто загрузил документ (id пользователя бота), "" — общий документ;
+    пишется в поле owner строк, по нему поиск ограничивается своими документами.
+
+    chunk_mode="tokens" режет по токенизатору модели точно под окно EMBED_MAX_LENGTH
+    (см. iter_token_chunks), "words" — по словам chunk_size_words/chunk_overlap_words.
+    pdf_workers — процессов разбора PDF (см. load_pdf_pages); 1 — в текущем процессе.
     """
     if not os.path.isfile(path):
         raise FileNotFoundError(f"Файл не найден: {path}")
 
-    text, doc_type = extract_text(path)
-    chunks = chunk_text(text, chunk_size=chunk_size_words, overlap=chunk_overlap_words)
+    fname = document_name(path, doc_name)
+    content_hash = content_hash or file_hash(path)
+    chunker, params = make_chunker(chunk_mode, chunk_size_words, chunk_overlap_words)
+    result = {"doc_name": fname, "chunks": 0, "embedded": 0, "skipped": False}
 
-    if not chunks:
+    if not force:
+        if _unchanged(fname, content_hash, params, owner):
+            print(f"⏭️ {path} не изменился (в индексе как '{fname}') — пропускаю.")
+            return {**result, "skipped": True}
+
+    doc = extract_document(path, content_hash, pdf_workers)
+    if not doc.text.strip():
         print(f"⚠️ Нет текста для индексации в {path}")
-        return
+        return result
+
+    def progress(n: int) -> None:
+        bar.update(n)
+        if on_chunks is not None:
+            on_chunks(n)
+
+    # Milvus: общий на процесс клиент, коллекция проверяется один раз
+    writer = MilvusWriter(get_store(), insert_batch_rows)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_inflight), thread_name_prefix="embed") as embed_pool, \
+             tqdm(desc="Indexing", unit="chunk") as bar:
+            n_chunks, n_embedded = _index_document(
+                fname, doc, content_hash, params, embed_pool, writer,
+                chunker, batch_size, max_inflight,
+                force=force, on_chunks=progress, owner=owner,
+            )
+    finally:
+        writer.close()
 
-    # Эмбеддинги батчами
-    embs_list: list[np.ndarray] = []
-    for i in tqdm(range(0, len(chunks), batch_size), desc="Creating embeddings"):
-        batch = chunks[i : i + batch_size]
-        vecs = embed_via_service(batch)  # [B, D]
-        embs_list.append(vecs)
-    embeddings = np.vstack(embs_list) if embs_list else np.zeros((0, DIMENSION), dtype=np.float32)
-
-    # Milvus
-    milvus = MilvusClient(uri=DB_PATH)
-    ensure_collection(milvus)
-
-    fname = os.path.basename(path)
-    rows = []
-    for i, (chunk, vec) in enumerate(zip(chunks, embeddings)):
-        rows.append({
-            # id НЕ передаём — auto_id=True
-            "text": chunk[:4096],
-            "doc_name": fname,
-            "doc_type": doc_type,
-            "chunk_id": int(i),
-            VECTOR_FIELD: vec.tolist(),
-        })
-
-    if rows:
-        milvus.insert(collection_name=COLLECTION, data=rows)
-
-    load_collection(milvus)
-    print(f"✅ Indexed {len(chunks)} chunks from {path} into collection '{COLLECTION}'.")
+    print(f"✅ Indexed {n_chunks} chunks ({n_embedded} new/changed) from {path} into collection '{COLLECTION}'.")
+    _print_cache_stats()
+    return {**result, "chunks": n_chunks, "embedded": n_embedded}
+
+# -------------------- пакетная индексация --------------------
+SUPPORTED_EXTS = (".pdf", ".txt", ".docx")
+
+def expand_paths(inputs: Iterable[str]) -> list[str]:
+    """Файлы, директории (рекурсивно) и glob-шаблоны -> отсортированный список поддерживаемых файлов."""
+    found: dict[str, None] = {}
+    for inp in inputs:
+        if os.path.isdir(inp):
+            for root, _, files in os.walk(inp):
+                for f in sorted(files):
+                    if f.lower().endswith(SUPPORTED_EXTS):
+                        found[os.path.join(root, f)] = None
+        elif os.path.isfile(inp):
+            found[inp] = None
+        else:
+            for f in sorted(glob.glob(inp, recursive=True)):
+                if os.path.isfile(f) and f.lower().endswith(SUPPORTED_EXTS):
+                    found[f] = None
+    return list(found)
+
+def index_paths(
+    inputs: Iterable[str],
+    workers: int | None = None,
+    chunk_size_words: int = 700,
+    chunk_overlap_words: int = 120,
+    chunk_mode: str = CHUNK_MODE,
+    batch_size: int = 16,
+    max_inflight: int = INDEX_EMBED_INFLIGHT,
+    insert_batch_rows: int = 4 * INDEX_INSERT_BATCH_ROWS,
+    force: bool = False,
+    owner: str = "",
+) -> dict:
+    """
+    Пакетная индексация директорий/glob'ов. extract_document (PyMuPDF, python-docx)
+    крутится в пуле процессов на всех ядрах, документы по мере готовности идут
+    в общий пул эмбеддингов и общий MilvusWriter с крупными пачками вставки.
+    Клиент Milvus общий на процесс (backend/milvus_store.py), коллекция проверяется один раз.
+    """
+    chunker, params = make_chunker(chunk_mode, chunk_size_words, chunk_overlap_words)
+    stats = {"files": 0, "skipped": 0, "indexed": 0, "failed": 0, "chunks": 0, "embedded": 0}
+
+    def failed(p: str, e: Exception) -> None:
+        stats["failed"] += 1
+        metrics.inc("index_failed")
+        tqdm.write(f"❌ {p}: {e}")
+
+    # один файл под разными путями (./docs/a.pdf и docs/a.pdf) — один документ
+    names: dict[str, str] = {}
+    seen: set[str] = set()
+    for p in expand_paths(inputs):
+        try:
+            name = document_name(p)
+        except ValueError as e:
+            stats["files"] += 1
+            failed(p, e)
+            continue
+        if name not in seen:
+            seen.add(name)
+            names[p] = name
+    stats["files"] += len(names)
+
+    todo: list[tuple[str, str]] = []
+    for p, name in names.items():
+        try:
+            h = file_hash(p)
+        except OSError as e:
+            failed(p, e)
+            continue
+        if not force and _unchanged(name, h, params, owner):
+            stats["skipped"] += 1
+        else:
+            todo.append((p, h))
+
+    if not todo:
+        print(f"⏭️ Нечего индексировать: {stats['files']} файлов, {stats['skipped']} уже в индексе, "
+              f"{stats['failed']} с ошибками.")
+        return stats
+
+    workers = max(1, workers or os.cpu_count() or 1)
+    t0 = time.perf_counter()
+    writer = MilvusWriter(get_store(), insert_batch_rows)
+    try:
+        # spawn, а не fork: в процессе уже живут потоки gRPC клиента Milvus
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as extract_pool, \
+             ThreadPoolExecutor(max_workers=max(1, max_inflight), thread_name_prefix="embed") as embed_pool, \
+             tqdm(total=len(todo), desc="Indexing files", unit="file") as bar:
+
+            def on_chunks(n: int):
+                stats["chunks"] += n
+                bar.set_postfix(chunks=stats["chunks"],
+                                chunks_s=f"{stats['chunks'] / max(time.perf_counter() - t0, 1e-9):.1f}")
+
+            queue = iter(todo)
+            running: dict[Future, tuple[str, str]] = {}
+
+            def refill():
+                # не больше 2*workers извлечённых текстов в памяти одновременно
+                for p, h in islice(queue, 2 * workers - len(running)):
+                    # параллелим по файлам, поэтому страницы PDF внутри — в одном процессе
+                    running[extract_pool.submit(extract_document, p, h, 1)] = (p, h)
+
+            refill()
+            while running:
+                # extract_document идёт в других процессах — их метрики сюда не попадают;
+                # видно только, сколько конвейер простаивал в ожидании текста
+                with metrics.span("extract_wait"):
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    p, h = running.pop(fut)
+                    try:
+                        doc = fut.result()
+                        if doc.text.strip():
+                            _, n_emb = _index_document(
+                                names[p], doc, h, params, embed_pool, writer,
+                                chunker, batch_size, max_inflight,
+                                force=force, on_chunks=on_chunks, owner=owner,
+                            )
+                            stats["embedded"] += n_emb
+                        stats["indexed"] += 1
+                    except Exception as e:
+                        failed(p, e)
+                    bar.update(1)
+                refill()
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - t0
+    print(f"✅ Indexed {stats['indexed']} files ({stats['skipped']} unchanged, {stats['failed']} failed), "
+          f"{stats['chunks']} chunks in {elapsed:.1f}s ({stats['chunks'] / max(elapsed, 1e-9):.1f} chunks/s) "
+          f"into collection '{COLLECTION}'.")
+    _print_cache_stats()
+    return stats
 
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) != 2:
-        print("Usage: python indexer.py <file.pdf|file.txt|file.docx>")
-        sys.exit(1)
-    index_file(sys.argv[1])
\ No newline at end of file
+    ap = argparse.ArgumentParser(description="Индексация документов (PDF/TXT/DOCX) в Milvus")
+    ap.add_argument("paths", nargs="+", help="файлы, директории или glob-шаблоны")
+    ap.add_argument("--workers", type=int, default=None, help="процессов для извлечения текста (по умолчанию — все ядра)")
+    ap.add_argument("--force", action="store_true", help="переиндексировать даже неизменённые файлы")
+    ap.add_argument("--chunk-mode", choices=("words", "tokens"), default=CHUNK_MODE, help="режим нарезки")
+    ap.add_argument("--owner", default="", help="владелец документов (id пользователя бота); по умолчанию — общие")
+    args = ap.parse_args()
+
+    metrics.start_exporter()
+    if len(args.paths) == 1 and os.path.isfile(args.paths[0]):
+        index_file(args.paths[0], chunk_mode=args.chunk_mode, force=args.force, owner=args.owner)
+    else:
+        index_paths(args.paths, workers=args.workers, chunk_mode=args.chunk_mode, force=args.force, owner=args.owner)
+    _print_stage_summary()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бэкенды инференса модели эмбеддингов для deploy.py (EMBED_BACKEND).
+
+torch     — исходная модель (fp16 на CUDA, fp32 на CPU);
+int8      — динамическая int8-квантизация Linear-слоёв (torch.ao), только CPU;
+onnx      — ONNX Runtime; граф экспортируется из той же модели в EMBED_ONNX_PATH
+            при первом запуске (или берётся уже лежащий там файл);
+onnx_int8 — то же, веса дополнительно квантуются onnxruntime.quantization.
+
+onnx* требуют необязательных зависимостей: pip install -r requirements-onnx.txt.
+Папка EMBED_ONNX_PATH принадлежит модели: веса лежат рядом с графом
+(<имя>.onnx.data), int8-граф — там же.
+
+Пулинг у всех один — pool(): mean pooling по attention_mask + L2-нормализация.
+cosine_agreement() сравнивает выход бэкенда с fp32 на одних и тех же текстах.
+"""
+
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import torch
+
+BACKENDS = ("torch", "int8", "onnx", "onnx_int8")
+
+# тексты для проверки согласия с fp32: разной длины, русские и английские
+AGREEMENT_TEXTS = [
+    "Договор вступает в силу с момента подписания сторонами.",
+    "Срок поставки товара составляет 30 календарных дней с даты оплаты счёта.",
+    "Ответственность сторон за неисполнение обязательств определяется действующим законодательством "
+    "Российской Федерации и условиями настоящего договора, включая штрафы и пени.",
+    "What is the maximum allowed operating temperature of the device?",
+    "Таблица 3. Технические характеристики: напряжение 220 В, мощность 1,5 кВт, масса 12 кг.",
+    "привет",
+    "The quarterly report shows revenue growth of 12% compared to the same period last year, "
+    "driven mainly by the new product line and expansion into two additional regions.",
+    "Пункт 4.2.1 не применяется к работникам, принятым на срок до двух месяцев.",
+]
+
+def pool(last_hidden: torch.Tensor, attention_mask: torch.Tensor) -> np.ndarray:
+    """Mean pooling + L2-нормализация, результат [B, D] float32."""
+    mask = attention_mask.to(last_hidden.device).unsqueeze(-1).to(last_hidden.dtype)
+    sum_vec = (last_hidden * mask).sum(dim=1)
+    lengths = mask.sum(dim=1).clamp(min=1)
+    mean_vec = torch.nn.functional.normalize(sum_vec / lengths, p=2, dim=1)
+    return mean_vec.cpu().to(torch.float32).numpy()
+
+def cosine_agreement(reference: np.ndarray, candidate: np.ndarray) -> dict:
+    """Косинус между строками (векторы уже нормализованы): среднее, минимум, p5."""
+    cos = np.sum(reference * candidate, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1) + 1e-12
+    )
+    return {
+        "mean_cos": float(cos.mean()),
+        "min_cos": float(cos.min()),
+        "p5_cos": float(np.percentile(cos, 5)),
+        "n": int(len(cos)),
+    }
+
+# -------------------- бэкенды --------------------
+class TorchEncoder:
+    name = "torch"
+
+    def __init__(self, model: torch.nn.Module, device: str):
+        self.model = model
+        self.device = device
+
+    def embed(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> np.ndarray:
+        with torch.inference_mode():
+            outputs = self.model(input_ids=input_ids.to(self.device), attention_mask=attention_mask.to(self.device))
+            return pool(outputs.last_hidden_state, attention_mask)
+
+class Int8Encoder(TorchEncoder):
+    name = "int8"
+
+    def __init__(self, model: torch.nn.Module):
+        # квантуем на месте — fp32-копию модели не держим
+        qmodel = torch.ao.quantization.quantize_dynamic(
+            model.float().cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True,
+        )
+        super().__init__(qmodel, "cpu")
+
+class OnnxEncoder:
+    name = "onnx"
+
+    def __init__(self, path: Path, threads: int = 0):
+        import onnxruntime as ort   # нужен только для EMBED_BACKEND=onnx*
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(path), opts, providers=["CPUExecutionProvider"])
+        self.inputs = {i.name for i in self.session.get_inputs()}
+
+    def embed(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> np.ndarray:
+        feed = {"input_ids": input_ids.numpy(), "attention_mask": attention_mask.numpy()}
+        last_hidden = self.session.run(None, {k: v for k, v in feed.items() if k in self.inputs})[0]
+        return pool(torch.from_numpy(last_hidden), attention_mask)
+
+def export_onnx(model: torch.nn.Module, path: Path) -> None:
+    """
+    Экспорт forward(input_ids=..., attention_mask=...) -> last_hidden_state с динамическими batch/seq.
+    Веса больше 2 ГБ (jina-v3 в fp32 — около 2.2 ГБ) в protobuf не влезают, поэтому граф
+    сохраняется с весами во внешнем файле <имя>.onnx.data. Всё собирается во временной
+    папке, которая затем целиком становится path.parent — недописанная модель не видна.
+    """
+    import onnx   # нужен только для EMBED_BACKEND=onnx*
+
+    target = path.parent
+    if target.exists() and any(not p.name.startswith(path.stem) for p in target.iterdir()):
+        raise RuntimeError(f"EMBED_ONNX_PATH должен лежать в отдельной папке: в {target} есть чужие файлы")
+    tmp_dir = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    raw = tmp_dir / "export"
+    raw.mkdir(parents=True)
+    model = model.float().cpu().eval()
+    dummy = torch.ones((2, 16), dtype=torch.long)
+    try:
+        with torch.inference_mode():
+            torch.onnx.export(
+                model,
+                # словарь последним аргументом — именованные аргументы forward: порядок
+                # позиционных у моделей разный (у XLM-R вторым идёт не attention_mask)
+                ({"input_ids": dummy, "attention_mask": dummy},),
+                str(raw / path.name),
+                input_names=["input_ids", "attention_mask"],
+                output_names=["last_hidden_state"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "seq"},
+                    "attention_mask": {0: "batch", 1: "seq"},
+                    "last_hidden_state": {0: "batch", 1: "seq"},
+                },
+                opset_version=17,
+            )
+        # экспортёр раскладывает большие веса по файлу на тензор — собираем их в один рядом с графом
+        graph = onnx.load(str(raw / path.name))
+        onnx.save_model(graph, str(tmp_dir / path.name), save_as_external_data=True,
+                        all_tensors_to_one_file=True, location=path.name + ".data", size_threshold=1024)
+        del graph
+        shutil.rmtree(raw)
+        if target.exists():
+            # старая модель (и int8 от неё) заменяется целиком
+            old = target.with_name(f"{target.name}.{os.getpid()}.old")
+            os.replace(target, old)
+            os.replace(tmp_dir, target)
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.replace(tmp_dir, target)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+def quantize_onnx(src: Path, dst: Path) -> None:
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    tmp = dst.with_suffix(f".{os.getpid()}.tmp")
+    quantize_dynamic(str(src), str(tmp), weight_type=QuantType.QInt8)
+    os.replace(tmp, dst)
+
+def make_encoder(backend: str, model: torch.nn.Module, device: str, onnx_path: Path, threads: int = 0):
+    """Энкодер выбранного бэкенда. Для int8 модель квантуется на месте и дальше как fp32 не годится."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный EMBED_BACKEND {backend!r} (ожидается один из {', '.join(BACKENDS)})")
+    if backend == "torch":
+        return TorchEncoder(model, device)
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if backend == "int8":
+        return Int8Encoder(model)
+
+    if not onnx_path.exists():
+        print(f"📦 Экспортирую модель в ONNX: {onnx_path}")
+        export_onnx(model, onnx_path)
+    path = onnx_path
+    if backend == "onnx_int8":
+        path = onnx_path.with_name(onnx_path.stem + ".int8.onnx")
+        if not path.exists():
+            print(f"📦 Квантую ONNX-граф в int8: {path}")
+            quantize_onnx(onnx_path, path)
+    encoder = OnnxEncoder(path, threads)
+    encoder.name = backend
+    return encoder
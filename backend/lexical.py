@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Лексический (BM25) индекс чанков рядом с коллекцией Milvus.
+
+Хранится в SQLite: на каждую пару (терм, документ) одна строка с постингами
+в виде двух массивов — chunk_id (int32) и tf (int32). Длины чанков лежат
+массивом в строке документа. Переиндексация документа целиком заменяет его
+строки. Поиск читает постинги только термов запроса и считает BM25 в NumPy.
+Документ — пара (owner, doc_name), как в манифесте, чанк — (owner, doc_name, chunk_id).
+"""
+
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Collection, Iterable
+
+import numpy as np
+
+# Если запускаешь из папки backend/, гарантируем импорт конфига из корня
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from backend.config import LEXICAL_INDEX_PATH, LEXICAL_INDEX_ENABLED
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# слова и коды вида 15.3, 2024-01, А-12/7
+_TERM_RE = re.compile(r"\w+(?:[.\-/]\w+)*")
+
+def tokenize(text: str) -> list[str]:
+    return _TERM_RE.findall(text.lower().replace("ё", "е"))
+
+class DocumentPostings:
+    """Накопитель постингов одного документа по мере нарезки чанков."""
+
+    def __init__(self):
+        self._chunk_ids: dict[str, list[int]] = defaultdict(list)
+        self._tfs: dict[str, list[int]] = defaultdict(list)
+        self.lengths: dict[int, int] = {}
+
+    def add(self, chunk_id: int, text: str) -> None:
+        terms = tokenize(text)
+        self.lengths[chunk_id] = len(terms)
+        for term, tf in Counter(terms).items():
+            self._chunk_ids[term].append(chunk_id)
+            self._tfs[term].append(tf)
+
+    def rows(self) -> Iterable[tuple[str, bytes, bytes]]:
+        for term, ids in self._chunk_ids.items():
+            yield (term, np.asarray(ids, dtype=np.int32).tobytes(),
+                   np.asarray(self._tfs[term], dtype=np.int32).tobytes())
+
+class LexicalIndex:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            " doc_id INTEGER PRIMARY KEY, owner TEXT NOT NULL, doc_name TEXT NOT NULL, lengths BLOB NOT NULL,"
+            " UNIQUE (owner, doc_name))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " term TEXT NOT NULL, doc_id INTEGER NOT NULL, chunk_ids BLOB NOT NULL, tfs BLOB NOT NULL,"
+            " PRIMARY KEY (term, doc_id)) WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings(doc_id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS stats (k TEXT PRIMARY KEY, v INTEGER NOT NULL)")
+
+    # -------------------- запись --------------------
+    def _add_stats(self, n_chunks: int, total_len: int) -> None:
+        self._db.executemany(
+            "INSERT INTO stats VALUES (?, ?) ON CONFLICT(k) DO UPDATE SET v = v + excluded.v",
+            [("n_chunks", n_chunks), ("total_len", total_len)],
+        )
+
+    def _drop(self, doc_name: str, owner: str) -> None:
+        row = self._db.execute("SELECT doc_id, lengths FROM docs WHERE owner = ? AND doc_name = ?",
+                               (owner, doc_name)).fetchone()
+        if row is None:
+            return
+        lengths = np.frombuffer(row[1], dtype=np.int32)
+        self._add_stats(-int((lengths >= 0).sum()), -int(lengths[lengths > 0].sum()))
+        self._db.execute("DELETE FROM postings WHERE doc_id = ?", (row[0],))
+        self._db.execute("DELETE FROM docs WHERE doc_id = ?", (row[0],))
+
+    def replace_document(self, doc_name: str, postings: DocumentPostings, owner: str = "") -> None:
+        n = max(postings.lengths, default=-1) + 1
+        lengths = np.full(n, -1, dtype=np.int32)   # -1 — нет такого chunk_id
+        for cid, length in postings.lengths.items():
+            lengths[cid] = length
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._drop(doc_name, owner)
+                cur = self._db.execute("INSERT INTO docs (owner, doc_name, lengths) VALUES (?, ?, ?)",
+                                       (owner, doc_name, lengths.tobytes()))
+                doc_id = cur.lastrowid
+                self._db.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)",
+                                     [(term, doc_id, ids, tfs) for term, ids, tfs in postings.rows()])
+                self._add_stats(len(postings.lengths), sum(postings.lengths.values()))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    # -------------------- поиск --------------------
+    def search(
+        self,
+        query: str,
+        top_k: int,
+        owners: Collection[str] | None = None,
+        doc_names: Collection[str] | None = None,
+    ) -> list[tuple[str, str, int, float]]:
+        """
+        [(owner, doc_name, chunk_id, bm25)] по убыванию скора. owners / doc_names — искать
+        только в документах этих владельцев / с этими именами (IDF — по всем).
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or top_k <= 0:
+            return []
+        with self._lock:
+            stats = dict(self._db.execute("SELECT k, v FROM stats").fetchall())
+            rows = self._db.execute(
+                f"SELECT term, doc_id, chunk_ids, tfs FROM postings WHERE term IN ({','.join('?' * len(terms))})",
+                terms,
+            ).fetchall()
+            doc_ids = sorted({r[1] for r in rows})
+            docs = self._db.execute(
+                f"SELECT doc_id, owner, doc_name, lengths FROM docs WHERE doc_id IN ({','.join('?' * len(doc_ids))})",
+                doc_ids,
+            ).fetchall() if doc_ids else []
+        n_total = stats.get("n_chunks", 0)
+        if not rows or n_total <= 0:
+            return []
+        if owners is not None:
+            docs = [d for d in docs if d[1] in owners]
+        if doc_names is not None:
+            docs = [d for d in docs if d[2] in doc_names]
+        avgdl = max(stats.get("total_len", 0) / n_total, 1e-9)
+        names = {d: (owner, name) for d, owner, name, _ in docs}
+        lengths = {d: np.frombuffer(blob, dtype=np.int32) for d, _, _, blob in docs}
+
+        df: Counter = Counter()
+        for term, _, ids, _ in rows:
+            df[term] += len(ids) // 4
+        keys_parts, score_parts = [], []
+        for term, doc_id, ids_blob, tfs_blob in rows:
+            if doc_id not in lengths:
+                continue   # документ вне области поиска
+            ids = np.frombuffer(ids_blob, dtype=np.int32)
+            tf = np.frombuffer(tfs_blob, dtype=np.int32).astype(np.float32)
+            dl = lengths[doc_id][ids].astype(np.float32)
+            idf = np.log1p((n_total - df[term] + 0.5) / (df[term] + 0.5))
+            score_parts.append(idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl)))
+            keys_parts.append((np.int64(doc_id) << 32) | ids.astype(np.int64))
+
+        if not keys_parts:
+            return []
+        keys, inverse = np.unique(np.concatenate(keys_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(*names[int(keys[i] >> 32)], int(keys[i] & 0xFFFFFFFF), float(scores[i])) for i in top]
+
+@lru_cache(maxsize=1)
+def get_lexical_index() -> LexicalIndex | None:
+    if not LEXICAL_INDEX_ENABLED:
+        return None
+    return LexicalIndex(LEXICAL_INDEX_PATH)
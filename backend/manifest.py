@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Манифест проиндексированных документов (SQLite рядом с DB_PATH).
+
+documents: (owner, doc_name) -> хэш содержимого файла + параметры нарезки,
+chunks:    (owner, doc_name, chunk_id) -> хэш текста чанка.
+doc_name — постоянное имя документа (indexer.document_name): путь от корня
+проекта или исходное имя загрузки в боте, не просто имя файла; owner — id
+пользователя бота, "" — общие документы. Одноимённые документы разных
+владельцев — разные документы.
+По нему index_file пропускает неизменённые файлы и переэмбеддит только
+изменившиеся чанки, удаляя их старые строки из Milvus. Дубликат ищется
+только среди документов того же владельца — у каждого пользователя своя копия.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+# Если запускаешь из папки backend/, гарантируем импорт конфига из корня
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from backend.config import MANIFEST_PATH
+
+def file_hash(path: str, block: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while data := f.read(block):
+            h.update(data)
+    return h.hexdigest()
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class Manifest:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " owner TEXT NOT NULL, doc_name TEXT NOT NULL, content_hash TEXT NOT NULL, params TEXT NOT NULL,"
+            " n_chunks INTEGER NOT NULL, indexed_at REAL NOT NULL, PRIMARY KEY (owner, doc_name))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " owner TEXT NOT NULL, doc_name TEXT NOT NULL, chunk_id INTEGER NOT NULL, text_hash TEXT NOT NULL,"
+            " PRIMARY KEY (owner, doc_name, chunk_id))"
+        )
+
+    def version_of(self, doc_name: str, owner: str = "") -> tuple[str, str] | None:
+        """(хэш содержимого, параметры нарезки) документа владельца, None если его нет в индексе."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT content_hash, params FROM documents WHERE owner = ? AND doc_name = ?", (owner, doc_name)
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def chunk_hashes(self, doc_name: str, owner: str = "") -> dict[int, str] | None:
+        """chunk_id -> хэш текста для известного документа, None если документа нет в манифесте."""
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM documents WHERE owner = ? AND doc_name = ?",
+                                (owner, doc_name)).fetchone() is None:
+                return None
+            return dict(self._db.execute(
+                "SELECT chunk_id, text_hash FROM chunks WHERE owner = ? AND doc_name = ?", (owner, doc_name)
+            ).fetchall())
+
+    def record(self, doc_name: str, content_hash: str, params: str, hashes: dict[int, str], owner: str = "") -> None:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("DELETE FROM chunks WHERE owner = ? AND doc_name = ?", (owner, doc_name))
+                self._db.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)",
+                                     [(owner, doc_name, cid, h) for cid, h in hashes.items()])
+                self._db.execute(
+                    "INSERT OR REPLACE INTO documents (owner, doc_name, content_hash, params, n_chunks, indexed_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (owner, doc_name, content_hash, params, len(hashes), time.time()),
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+@lru_cache(maxsize=1)
+def get_manifest() -> Manifest:
+    return Manifest(MANIFEST_PATH)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Метрики и тайминги по стадиям (METRICS_ENABLED).
+
+span("embed")            — длительность стадии в гистограмму rag_stage_seconds{stage=...}
+                           и в текущую трассу, если она открыта;
+timed(iterable, stage)   — то же для ленивых стадий (нарезка): суммарное время в next();
+observe / inc            — гистограммы размеров (батчи, токены) и счётчики (попадания кэшей);
+trace("question")        — трасса одного запроса: стадии, прошедшие внутри (в том числе
+                           в to_thread / пуле с copy_context), и итог в лог, если запрос медленный.
+
+render() — текстовый формат Prometheus; его отдаёт /metrics в deploy.py, а бот
+и индексатор поднимают для него маленький HTTP-сервер (start_exporter, METRICS_PORT).
+Метрики живут в памяти процесса, без внешних зависимостей.
+
+Выключено — span/trace отдают общий пустой контекст-менеджер, inc/observe
+возвращаются сразу: стоимость — проверка одного флага.
+"""
+
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Iterator, List, Tuple, TypeVar
+
+# Если запускаешь из папки backend/, гарантируем импорт конфига из корня
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from backend.config import METRICS_ENABLED, METRICS_PORT, METRICS_SLOW_SECONDS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+_NOOP = nullcontext()
+
+# -------------------- метрики --------------------
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels_text(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, *values: str) -> None:
+        with self._lock:
+            self._values[values] = self._values.get(values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        out += [f"{self.name}{_labels_text(self.labels, k)} {v:g}" for k, v in items]
+        return out
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, tuple(buckets)
+        self._values: Dict[Tuple[str, ...], List[float]] = {}   # [счётчики по бакетам..., +Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *values: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(values)
+            if row is None:
+                row = self._values[values] = [0.0] * (len(self.buckets) + 2)
+            row[i] += 1
+            row[-1] += value
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Tuple[int, float]]:
+        """labels -> (count, sum)."""
+        with self._lock:
+            return {k: (int(sum(row[:-1])), row[-1]) for k, row in self._values.items()}
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(row)) for k, row in self._values.items())
+        for k, row in items:
+            acc = 0.0
+            for le, n in zip(self.buckets, row):
+                acc += n
+                bucket = 'le="%g"' % le
+                out.append(f"{self.name}_bucket{_labels_text(self.labels, k, bucket)} {acc:g}")
+            acc += row[len(self.buckets)]
+            inf = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_labels_text(self.labels, k, inf)} {acc:g}")
+            out.append(f"{self.name}_sum{_labels_text(self.labels, k)} {row[-1]:g}")
+            out.append(f"{self.name}_count{_labels_text(self.labels, k)} {acc:g}")
+        return out
+
+STAGE_SECONDS = Histogram("rag_stage_seconds", "Длительность стадии конвейера", ("stage",))
+BATCH_SIZE = Histogram("rag_batch_size", "Размер батча (тексты, строки, векторы)", ("kind",), SIZE_BUCKETS)
+TOKENS = Histogram("rag_tokens", "Число токенов (батч модели, контекст LLM)", ("kind",), SIZE_BUCKETS)
+CACHE = Counter("rag_cache_requests_total", "Обращения к кэшам", ("cache", "result"))
+EVENTS = Counter("rag_events_total", "События (вопросы, проиндексированные чанки, ошибки)", ("event",))
+_REGISTRY = (STAGE_SECONDS, BATCH_SIZE, TOKENS, CACHE, EVENTS)
+
+def render() -> str:
+    return "\n".join(line for m in _REGISTRY for line in m.render()) + "\n"
+
+# -------------------- запись --------------------
+def inc(event: str, amount: float = 1.0) -> None:
+    if METRICS_ENABLED:
+        EVENTS.inc(amount, event)
+
+def cache_hit(cache: str, hit: bool, n: int = 1) -> None:
+    if METRICS_ENABLED and n:
+        CACHE.inc(n, cache, "hit" if hit else "miss")
+
+def observe_batch(kind: str, size: int) -> None:
+    if METRICS_ENABLED:
+        BATCH_SIZE.observe(size, kind)
+
+def observe_tokens(kind: str, n: int) -> None:
+    if METRICS_ENABLED:
+        TOKENS.observe(n, kind)
+
+# -------------------- стадии и трассы --------------------
+_trace: contextvars.ContextVar[List[Tuple[str, float]] | None] = contextvars.ContextVar("metrics_trace", default=None)
+
+def record_stage(stage: str, seconds: float) -> None:
+    """Готовое наблюдение стадии (когда время меряется не блоком with, например до первого токена)."""
+    if not METRICS_ENABLED:
+        return
+    STAGE_SECONDS.observe(seconds, stage)
+    spans = _trace.get()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+@contextmanager
+def _span(stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+def span(stage: str):
+    return _span(stage) if METRICS_ENABLED else _NOOP
+
+def timed(iterable: Iterable[T], stage: str) -> Iterable[T]:
+    """Итератор-обёртка: время, проведённое в next(), одним наблюдением стадии в конце."""
+    return _timed(iterable, stage) if METRICS_ENABLED else iterable
+
+def _timed(iterable: Iterable[T], stage: str) -> Iterator[T]:
+    it = iter(iterable)
+    total = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                total += time.perf_counter() - started
+            yield item
+    finally:
+        record_stage(stage, total)
+
+@contextmanager
+def _trace_ctx(name: str) -> Iterator[List[Tuple[str, float]]]:
+    spans: List[Tuple[str, float]] = []
+    token = _trace.set(spans)
+    started = time.perf_counter()
+    try:
+        yield spans
+    finally:
+        _trace.reset(token)
+        total = time.perf_counter() - started
+        record_stage(name, total)
+        if total >= METRICS_SLOW_SECONDS:
+            by_stage: Dict[str, float] = {}
+            for stage, sec in spans:
+                by_stage[stage] = by_stage.get(stage, 0.0) + sec
+            logger.info("⏱️ %s: %.2f с — %s", name, total,
+                        ", ".join(f"{s} {sec:.3f}" for s, sec in sorted(by_stage.items(), key=lambda x: -x[1])) or "без стадий")
+
+def trace(name: str):
+    """Трасса запроса; стадии во вложенных потоках видны, если контекст скопирован (to_thread, copy_context)."""
+    return _trace_ctx(name) if METRICS_ENABLED else _NOOP
+
+def stage_summary() -> List[Tuple[str, int, float]]:
+    """[(стадия, вызовов, секунд)] по убыванию времени — для отчёта CLI."""
+    rows = [(k[0], n, s) for k, (n, s) in STAGE_SECONDS.snapshot().items()]
+    return sorted(rows, key=lambda r: -r[2])
+
+# -------------------- экспортер --------------------
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass   # без строки в stdout на каждый scrape
+
+_exporter: ThreadingHTTPServer | None = None
+
+def start_exporter(port: int = METRICS_PORT, host: str = "0.0.0.0") -> ThreadingHTTPServer | None:
+    """/metrics на port в фоновом потоке (бот, индексатор). port <= 0 или метрики выключены — ничего."""
+    global _exporter
+    if not METRICS_ENABLED or port <= 0 or _exporter is not None:
+        return _exporter
+    try:
+        _exporter = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logger.warning("Не удалось открыть /metrics на порту %s: %s", port, e)
+        return None
+    _exporter.daemon_threads = True
+    threading.Thread(target=_exporter.serve_forever, name="metrics-exporter", daemon=True).start()
+    logger.info("📈 Метрики: http://%s:%s/metrics", host, port)
+    return _exporter
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Долгоживущий клиент Milvus на процесс.
+
+MilvusStore открывает Milvus (MILVUS_URI, по умолчанию Milvus Lite в DB_PATH) один раз, один раз проверяет/создаёт
+коллекцию с индексом профиля INDEX_PROFILE (перестраивает индекс, если профиль
+сменился) и загружает её, помнит набор полей схемы. Все вызовы идут
+через call(): при ошибке связи с сервером клиент пересоздаётся и вызов
+повторяется один раз (вставки — без повтора: она могла дойти до сервера).
+Клиент потокобезопасен, лок нужен только на подключение и настройку — так
+его можно делить между executor-потоками бота и пакетной индексацией.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, TypeVar
+
+import grpc
+from pymilvus import MilvusClient, DataType
+from pymilvus.exceptions import ConnectError, ConnectionNotExistException, MilvusUnavailableException
+
+# Если запускаешь из папки backend/, гарантируем импорт конфига из корня
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from backend.config import (
+    DB_PATH, MILVUS_URI, COLLECTION, VECTOR_FIELD, STORE_DTYPE, OWNER_PARTITION_KEY, OWNER_PARTITIONS,
+    INDEX_PROFILE, HNSW_M, HNSW_EF_CONSTRUCTION, IVF_NLIST, SEARCH_EF, SEARCH_NPROBE,
+)
+from backend.vector_storage import TRUNCATED, ROW_FIELD, index_dim, metric_type
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# -------------------- схема --------------------
+def ensure_collection(milvus: MilvusClient) -> None:
+    """Создаёт коллекцию и индекс при отсутствии. PK обязателен даже при auto_id=True."""
+    if milvus.has_collection(COLLECTION):
+        return
+
+    schema = MilvusClient.create_schema(
+        auto_id=True,                 # генерируем PK автоматически
+        enable_dynamic_field=False,
+    )
+    schema.add_field("id", DataType.INT64, is_primary=True, auto_id=True)
+    if TRUNCATED and STORE_DTYPE == "binary":
+        schema.add_field(VECTOR_FIELD, DataType.BINARY_VECTOR, dim=index_dim())
+    elif TRUNCATED and STORE_DTYPE == "float16":
+        schema.add_field(VECTOR_FIELD, DataType.FLOAT16_VECTOR, dim=index_dim())
+    else:
+        schema.add_field(VECTOR_FIELD, DataType.FLOAT_VECTOR, dim=index_dim())
+    schema.add_field("text", DataType.VARCHAR, max_length=4096)
+    schema.add_field("doc_name", DataType.VARCHAR, max_length=512)
+    schema.add_field("doc_type", DataType.VARCHAR, max_length=16)
+    schema.add_field("chunk_id", DataType.INT64)
+    schema.add_field("page", DataType.INT64)       # страница начала чанка (PDF), 0 — нет страниц
+    # кто загрузил документ: id пользователя бота, "" — общие документы (CLI)
+    schema.add_field("owner", DataType.VARCHAR, max_length=64, is_partition_key=OWNER_PARTITION_KEY)
+    if TRUNCATED:
+        schema.add_field(ROW_FIELD, DataType.INT64)  # строка полного вектора в FULL_VECTORS_PATH
+
+    extra = {"num_partitions": OWNER_PARTITIONS} if OWNER_PARTITION_KEY else {}
+    milvus.create_collection(
+        collection_name=COLLECTION,
+        schema=schema,
+        consistency_level="Strong",
+        num_shards=2,
+        **extra,
+    )
+    ensure_index(milvus)
+
+# -------------------- профили индекса --------------------
+INDEX_PROFILES = ("auto", "flat", "hnsw", "ivf_flat", "ivf_sq8")
+
+def index_spec(profile: str = INDEX_PROFILE) -> tuple[str, dict]:
+    """
+    (index_type, params) профиля. Для binary-векторов — BIN_* аналоги.
+    Milvus Lite такие индексы принимает, но ищет по ним перебором, как FLAT.
+    """
+    binary = TRUNCATED and STORE_DTYPE == "binary"
+    if profile == "auto":
+        return "AUTOINDEX", {}
+    if profile == "flat":
+        return ("BIN_FLAT" if binary else "FLAT"), {}
+    if profile == "hnsw":
+        return "HNSW", {"M": HNSW_M, "efConstruction": HNSW_EF_CONSTRUCTION}
+    if profile == "ivf_flat":
+        return ("BIN_IVF_FLAT" if binary else "IVF_FLAT"), {"nlist": IVF_NLIST}
+    if profile == "ivf_sq8" and not binary:
+        return "IVF_SQ8", {"nlist": IVF_NLIST}
+    raise ValueError(f"Неизвестный INDEX_PROFILE {profile!r} (ожидается один из {', '.join(INDEX_PROFILES)})")
+
+def search_params(profile: str = INDEX_PROFILE, limit: int = 0,
+                  ef: int = SEARCH_EF, nprobe: int = SEARCH_NPROBE) -> dict:
+    """search_params для client.search под профиль; ef у HNSW не может быть меньше limit."""
+    params: dict = {}
+    if profile == "hnsw":
+        params["ef"] = max(ef, limit)
+    elif profile.startswith("ivf"):
+        params["nprobe"] = min(nprobe, IVF_NLIST)
+    return {"metric_type": metric_type(), "params": params}
+
+# Профиль, под который построен индекс, записывается в файл рядом с базой: Milvus Lite
+# в describe_index не отдаёт M / efConstruction, по нему смену параметров не увидеть.
+_INDEX_VERSION_PATH = Path(DB_PATH).with_name(f"{COLLECTION}.index.version")
+
+def index_signature(profile: str = INDEX_PROFILE) -> dict:
+    index_type, params = index_spec(profile)
+    return {"profile": profile, "index_type": index_type, "metric_type": metric_type(), "params": params}
+
+def applied_index() -> dict | None:
+    """Что записал последний ensure_index; None — файла нет (коллекция старше него)."""
+    try:
+        return json.loads(_INDEX_VERSION_PATH.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _remember_index(profile: str) -> None:
+    tmp = _INDEX_VERSION_PATH.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(index_signature(profile)))
+    os.replace(tmp, _INDEX_VERSION_PATH)
+
+def ensure_index(milvus: MilvusClient, profile: str = INDEX_PROFILE) -> None:
+    index_type, params = index_spec(profile)
+    # ВАЖНО: используем IndexParams, а не dict
+    index_params = milvus.prepare_index_params()
+    index_params.add_index(
+        field_name=VECTOR_FIELD,
+        index_type=index_type,
+        metric_type=metric_type(),   # IP — косинус при L2-нормализованных векторах, HAMMING — для binary
+        params=params,               # для AUTOINDEX/FLAT пусто
+    )
+    milvus.create_index(
+        collection_name=COLLECTION,
+        index_params=index_params,
+    )
+    _remember_index(profile)
+
+def rebuild_index(milvus: MilvusClient, profile: str) -> float:
+    """Пересоздаёт индекс вектора под profile и загружает коллекцию; возвращает секунды на это."""
+    started = time.perf_counter()
+    try:
+        milvus.release_collection(collection_name=COLLECTION)
+    except Exception:
+        pass
+    for name in milvus.list_indexes(collection_name=COLLECTION, field_name=VECTOR_FIELD):
+        milvus.drop_index(collection_name=COLLECTION, index_name=name)
+    ensure_index(milvus, profile)
+    milvus.load_collection(collection_name=COLLECTION)
+    return time.perf_counter() - started
+
+def sync_index(milvus: MilvusClient) -> None:
+    """
+    Индекс существующей коллекции построен под другой профиль или параметры — перестраиваем
+    под INDEX_PROFILE. Сверяемся с записанным профилем (index_signature); если записи нет —
+    с тем, что отдаёт describe_index, и при совпадении запоминаем текущий профиль.
+    """
+    names = milvus.list_indexes(collection_name=COLLECTION, field_name=VECTOR_FIELD)
+    if not names:
+        return   # нет индекса — его создаст call() по ошибке "index not found"
+    wanted = index_signature()
+    applied = applied_index()
+    if applied == wanted:
+        return
+    if applied is None:
+        info = milvus.describe_index(collection_name=COLLECTION, index_name=names[0])
+        if info.get("index_type") == wanted["index_type"] \
+                and all(str(info[k]) == str(v) for k, v in wanted["params"].items() if k in info):
+            _remember_index(INDEX_PROFILE)
+            return
+        applied = {"index_type": info.get("index_type"), "params": {k: info.get(k) for k in wanted["params"]}}
+    rows = milvus.get_collection_stats(collection_name=COLLECTION).get("row_count", "?")
+    logger.warning("Индекс коллекции %s (%s строк) построен как %s %s, а INDEX_PROFILE=%s требует %s %s — "
+                   "перестраиваю; до конца перестройки поиск и индексация ждут",
+                   COLLECTION, rows, applied.get("index_type"), applied.get("params"),
+                   INDEX_PROFILE, wanted["index_type"], wanted["params"])
+    seconds = rebuild_index(milvus, INDEX_PROFILE)
+    logger.warning("Индекс коллекции %s перестроен за %.1f с", COLLECTION, seconds)
+
+def milvus_str(s: str) -> str:
+    """Строковый литерал для filter-выражений Milvus."""
+    return json.dumps(s, ensure_ascii=False)
+
+def collection_fields(milvus: MilvusClient) -> set[str]:
+    """Имена полей коллекции — коллекции, созданные старым кодом, могут не иметь новых полей."""
+    return {f["name"] for f in milvus.describe_collection(collection_name=COLLECTION)["fields"]}
+
+def load_collection(milvus: MilvusClient) -> None:
+    try:
+        milvus.load_collection(collection_name=COLLECTION)
+    except Exception:
+        # В Milvus Lite это может быть no-op — ок.
+        pass
+
+# -------------------- версия коллекции --------------------
+# Файл-маркер: любая запись в коллекцию (из бота или CLI-индексатора) меняет его
+# содержимое и mtime, кэши поиска/ответов включают версию в ключ.
+_VERSION_PATH = Path(DB_PATH).with_name(f"{COLLECTION}.version")
+
+def collection_version() -> int:
+    try:
+        return _VERSION_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+def bump_collection_version() -> None:
+    tmp = _VERSION_PATH.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(str(time.time_ns()))
+    os.replace(tmp, _VERSION_PATH)
+
+# -------------------- клиент --------------------
+def is_transport_error(e: BaseException) -> bool:
+    """
+    Ошибка связи с сервером, а не отказ в запросе: переподключение может помочь.
+    pymilvus заворачивает неожиданные ошибки в MilvusException — смотрим и причины.
+    """
+    while e is not None:
+        if isinstance(e, (ConnectionError, ConnectError, ConnectionNotExistException,
+                          MilvusUnavailableException, grpc.FutureTimeoutError)):
+            return True
+        if isinstance(e, grpc.RpcError) and callable(getattr(e, "code", None)) \
+                and e.code() == grpc.StatusCode.UNAVAILABLE:
+            return True
+        e = e.__cause__
+    return False
+
+class MilvusStore:
+    def __init__(self, uri: str = DB_PATH):
+        self.uri = uri
+        self._lock = threading.Lock()
+        self._client: MilvusClient | None = None
+        self._ready = False
+        self._generation = 0     # номер подключения: reset() от устаревшей ошибки его не трогает
+        self.fields: set[str] = set()
+
+    @property
+    def is_lite(self) -> bool:
+        """Milvus Lite (локальный файл .db — так его различает и pymilvus): ANN-индексы там фактически FLAT."""
+        return self.uri.endswith(".db")
+
+    def ready(self) -> MilvusClient:
+        """Клиент с созданной и загруженной коллекцией; настройка выполняется один раз."""
+        return self._connect()[0]
+
+    def _connect(self) -> tuple[MilvusClient, int]:
+        client, ready, generation = self._client, self._ready, self._generation
+        if client is not None and ready:
+            return client, generation
+        with self._lock:
+            if self._client is None:
+                self._client = MilvusClient(uri=self.uri)
+                self._generation += 1
+            if not self._ready:
+                if self.is_lite and INDEX_PROFILE not in ("auto", "flat"):
+                    logger.warning("INDEX_PROFILE=%s на Milvus Lite ищет как FLAT — ANN-индекс нужен Milvus-серверу "
+                                   "(MILVUS_URI)", INDEX_PROFILE)
+                ensure_collection(self._client)
+                sync_index(self._client)
+                load_collection(self._client)
+                self.fields = collection_fields(self._client)
+                self._ready = True
+            return self._client, self._generation
+
+    def reset(self, generation: int | None = None) -> None:
+        """
+        Забыть клиент и состояние — следующий ready() переподключится и заново проверит коллекцию.
+        generation — подключение, на котором случилась ошибка: если другой поток уже
+        переподключился, новый клиент не сбрасываем. Старый клиент не закрываем —
+        им могут пользоваться запросы других потоков; соединение закроется вместе с объектом.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._client, self._ready = None, False
+
+    def call(self, fn: Callable[[MilvusClient], T], retry: bool = True) -> T:
+        """
+        fn(client) с одним повтором после переподключения — только при ошибках связи
+        (is_transport_error); ошибки самого запроса пробрасываются сразу.
+        retry=False — без повторов (неидемпотентные вызовы вроде insert: повтор после
+        обрыва на ответе задвоил бы строки).
+        """
+        try:
+            return self._call_once(fn)
+        except Exception as e:
+            if not retry:
+                raise
+            if "index not found" in str(e).lower():
+                logger.info("Индекс отсутствует — создаю и повторяю запрос…")
+                client = self.ready()
+                ensure_index(client)
+                load_collection(client)
+                return self._call_once(fn)
+            if not is_transport_error(e):
+                raise
+            logger.warning("Ошибка связи с Milvus (%s) — переподключаюсь и повторяю запрос", e)
+            return self._call_once(fn)
+
+    def _call_once(self, fn: Callable[[MilvusClient], T]) -> T:
+        """fn(client) без повторов; при ошибке связи клиент сбрасывается, чтобы следующий вызов переподключился."""
+        client, generation = self._connect()
+        try:
+            return fn(client)
+        except Exception as e:
+            if is_transport_error(e):
+                self.reset(generation)
+            raise
+
+@lru_cache(maxsize=1)
+def get_store() -> MilvusStore:
+    return MilvusStore(MILVUS_URI or DB_PATH)
@@ -1,38 +1,175 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from textwrap import shorten
-from typing import List, Dict, Any
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import AsyncIterator, List, Dict, Any, Sequence
 
-from backend.searcher import search, search_grouped_by_doc
-from backend.gigachat_langchain import lc_answer  # LangChain-клиент GigaChat
+from backend.config import (
+    CONTEXT_TOKEN_BUDGET, CONTEXT_CHARS_PER_TOKEN, CONTEXT_MIN_SPAN_TOKENS, CONTEXT_SPAN_MAX_TOKENS,
+    MERGE_NEIGHBOURS,
+)
+from backend.searcher import search, search_grouped_by_doc, hit_score
+from backend.diversify import merge_neighbours
+from backend.async_search import asearch, asearch_grouped_by_doc
+from backend.answer_cache import get_answer_cache, answer_key, hit_ids, doc_chunk_ids
+from backend.milvus_store import collection_version
+from backend import metrics
+from backend.gigachat_langchain import lc_answer, alc_answer, alc_stream, gigachat_model  # LangChain-клиент GigaChat
 
-# --------- сборка контекста ---------
+# --------- упаковка контекста по бюджету токенов ---------
 
-def build_context_from_chunks(hits: List[Dict[str, Any]], max_chars: int = 8000) -> str:
-    parts: List[str] = []
-    for i, h in enumerate(hits, start=1):
-        score = h.get("score", 0.0)
-        ent = h.get("entity", {})
-        text = (ent.get("text") or "").replace("\n", " ").strip()
+logger = logging.getLogger(__name__)
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов LLM без токенизатора."""
+    return max(1, int(len(text) / CONTEXT_CHARS_PER_TOKEN + 0.5)) if text else 0
+
+@dataclass
+class PackedContext:
+    text: str
+    budget: int
+    used_tokens: int
+    n_spans: int          # фрагментов в контексте
+    n_candidates: int     # фрагментов было на входе
+    truncated: int = 0    # из них обрезано под остаток бюджета
+    sources: List[str] = field(default_factory=list)
+
+    @property
+    def usage(self) -> float:
+        return self.used_tokens / self.budget if self.budget else 0.0
+
+def _trim_to_tokens(text: str, tokens: int) -> str:
+    """Префикс text примерно на tokens токенов, по границе предложения или слова."""
+    limit = int(tokens * CONTEXT_CHARS_PER_TOKEN) - 1
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    end = max(cut.rfind(". "), cut.rfind("! "), cut.rfind("? "))
+    if end >= limit // 2:
+        return cut[: end + 1]
+    return cut.rsplit(" ", 1)[0] + "…"
+
+def _span_text(raw: str, hit: Sequence[int] | None = None, max_tokens: int = CONTEXT_SPAN_MAX_TOKENS) -> str:
+    """
+    Текст фрагмента для контекста: пробелы схлопнуты, длиннее max_tokens — окно вокруг hit
+    (диапазон символов лучшего чанка склеенного спана, см. merge_neighbours), иначе — начало.
+    Склеенный спан из 3–4 чанков иначе съел бы весь бюджет одним фрагментом.
+    """
+    text = " ".join(raw.split())
+    limit = int(max_tokens * CONTEXT_CHARS_PER_TOKEN)
+    if max_tokens <= 0 or len(text) <= limit:
+        return text
+    # смещения hit — в исходном тексте, переводим в схлопнутый
+    start, end = ((len(" ".join(raw[:hit[0]].split())), len(" ".join(raw[:hit[1]].split())))
+                  if hit else (0, len(text)))
+    lo = start if end - start >= limit else max(0, min((start + end - limit) // 2, len(text) - limit))
+    hi = lo + limit
+    window = text[lo:hi]
+    if lo > 0:
+        window = "…" + window.split(" ", 1)[-1]
+    if hi < len(text):
+        window = window.rsplit(" ", 1)[0] + "…"
+    return window
+
+def _select_spans(spans: List[Dict[str, Any]], budget: int) -> tuple[List[int], int, int]:
+    """
+    Жадный выбор по score / токен. spans: label, text (уже не длиннее CONTEXT_SPAN_MAX_TOKENS),
+    score (label тоже занимает бюджет).
+    Не влезающий целиком фрагмент обрезается под остаток, если остаток не меньше
+    CONTEXT_MIN_SPAN_TOKENS. Возвращает (индексы выбранных, израсходовано токенов, обрезано).
+    """
+    costs = [estimate_tokens(s["label"]) + estimate_tokens(s["text"]) for s in spans]
+    order = sorted(range(len(spans)), key=lambda i: spans[i]["score"] / costs[i], reverse=True)
+    chosen: List[int] = []
+    used = truncated = 0
+    for i in order:
+        left = budget - used
+        if costs[i] <= left:
+            chosen.append(i)
+            used += costs[i]
+            continue
+        room = left - estimate_tokens(spans[i]["label"])
+        if room >= CONTEXT_MIN_SPAN_TOKENS:
+            spans[i]["text"] = _trim_to_tokens(spans[i]["text"], room)
+            chosen.append(i)
+            used += estimate_tokens(spans[i]["label"]) + estimate_tokens(spans[i]["text"])
+            truncated += 1
+    return sorted(chosen), used, truncated
+
+def pack_chunks(hits: List[Dict[str, Any]], token_budget: int = CONTEXT_TOKEN_BUDGET) -> PackedContext:
+    """
+    Контекст из хитов search() под бюджет токенов; порядок — как в выдаче, метки источников сохраняются.
+    С MERGE_NEIGHBOURS соседние чанки одного документа склеиваются в один спан.
+    """
+    entities = [{**h.get("entity", {}), "score": hit_score(h)} for h in hits]
+    if MERGE_NEIGHBOURS:
+        entities = merge_neighbours(entities)
+    spans: List[Dict[str, Any]] = []
+    for ent in entities:
         doc_name = ent.get("doc_name") or ""
-        prefix = f"[{i} score={score:.6f}] "
-        if doc_name:
-            prefix += f"{doc_name}: "
-        parts.append(prefix + shorten(text, width=900, placeholder="…"))
-    ctx = "\n".join(parts)
-    return ctx[:max_chars] + ("…" if len(ctx) > max_chars else "")
-
-def build_context_from_docs(docs: List[Dict[str, Any]], max_chars: int = 8000) -> str:
+        source = doc_name + (f", стр. {ent['page']}" if doc_name and ent.get("page") else "")
+        spans.append({
+            "label": source,
+            "text": _span_text(ent.get("text") or "", ent.get("hit_range")),
+            "score": max(float(ent.get("score") or 0.0), 0.0) + 1e-9,
+        })
+    chosen, used, truncated = _select_spans(spans, token_budget)
+    lines = []
+    for n, i in enumerate(chosen, start=1):
+        s = spans[i]
+        lines.append(f"[{n}] " + (f"{s['label']}: " if s["label"] else "") + s["text"])
+    packed = PackedContext("\n".join(lines), token_budget, used, len(chosen), len(spans), truncated,
+                           list(dict.fromkeys(spans[i]["label"] for i in chosen if spans[i]["label"])))
+    logger.info("Контекст: %d/%d фрагментов, ~%d/%d токенов (%.0f%%), обрезано %d",
+                packed.n_spans, packed.n_candidates, used, token_budget, packed.usage * 100, truncated)
+    return packed
+
+def pack_docs(docs: List[Dict[str, Any]], token_budget: int = CONTEXT_TOKEN_BUDGET) -> PackedContext:
+    """
+    Контекст из search_grouped_by_doc под бюджет токенов: фрагменты под заголовками своих документов.
+    С MERGE_NEIGHBOURS соседние чанки документа склеиваются в один спан.
+    """
+    spans: List[Dict[str, Any]] = []
+    for d_i, d in enumerate(docs):
+        for c in merge_neighbours(d["chunks"]) if MERGE_NEIGHBOURS else d["chunks"]:
+            spans.append({
+                "doc": d_i,
+                "label": f"[стр. {c['page']}]" if c.get("page") else "",
+                "text": _span_text(c.get("text") or "", c.get("hit_range")),
+                "score": max(float(c.get("score") or 0.0), 0.0) + 1e-9,
+            })
+    # заголовок документа тоже стоит токенов — закладываем его в бюджет заранее
+    headers = [f"[DOC {d_i}] {d['doc_name']}" for d_i, d in enumerate(docs, start=1)]
+    budget = token_budget - sum(estimate_tokens(h) for h in headers)
+    chosen, used, truncated = _select_spans(spans, max(budget, 0))
+
     rows: List[str] = []
-    for d_i, d in enumerate(docs, start=1):
-        header = f"[DOC {d_i}] {d['doc_name']} (score={d['score']:.6f})"
-        rows.append(header)
-        for c in d["chunks"]:
-            rows.append("• " + shorten((c["text"] or "").replace("\n", " ").strip(), width=900, placeholder="…"))
+    by_doc: Dict[int, List[int]] = {}
+    for i in chosen:
+        by_doc.setdefault(spans[i]["doc"], []).append(i)
+    for d_i, idx in sorted(by_doc.items()):
+        rows.append(headers[d_i])
+        rows += ["• " + (spans[i]["label"] + " " if spans[i]["label"] else "") + spans[i]["text"] for i in idx]
         rows.append("")
-    ctx = "\n".join(rows)
-    return ctx[:max_chars] + ("…" if len(ctx) > max_chars else "")
+    used += sum(estimate_tokens(headers[d_i]) for d_i in by_doc)
+    packed = PackedContext("\n".join(rows).strip(), token_budget, used, len(chosen), len(spans), truncated,
+                           [docs[d_i]["doc_name"] for d_i in sorted(by_doc)])
+    logger.info("Контекст: %d/%d фрагментов из %d документов, ~%d/%d токенов (%.0f%%), обрезано %d",
+                packed.n_spans, packed.n_candidates, len(by_doc), used, token_budget, packed.usage * 100, truncated)
+    return packed
+
+def _budget_for(max_chars: int | None) -> int:
+    return CONTEXT_TOKEN_BUDGET if max_chars is None else max(1, int(max_chars / CONTEXT_CHARS_PER_TOKEN))
+
+def build_context_from_chunks(hits: List[Dict[str, Any]], max_chars: int | None = None) -> str:
+    """Текст контекста из хитов search(): pack_chunks(...).text; max_chars — бюджет в символах вместо токенов."""
+    return pack_chunks(hits, _budget_for(max_chars)).text
+
+def build_context_from_docs(docs: List[Dict[str, Any]], max_chars: int | None = None) -> str:
+    """Текст контекста из search_grouped_by_doc: pack_docs(...).text; max_chars — как у build_context_from_chunks."""
+    return pack_docs(docs, _budget_for(max_chars)).text
 
 # --------- вызов GigaChat через LangChain ---------
 
@@ -40,34 +177,136 @@ def gigachat_answer(system_prompt: str, user_prompt: str) -> str:
     """Синоним для обратной совместимости со старыми вызовами."""
     return lc_answer(system_prompt, user_prompt)
 
-# --------- публичные функции ---------
+# --------- промпты ---------
 
-def answer_with_top_chunks(query: str, top_k: int = 10) -> str:
-    hits = search(query, top_k=top_k)
-    if not hits:
-        return "Не нашёл релевантного контента в базе. Попробуй переформулировать вопрос."
+NOT_FOUND_ANSWER = "Не нашёл релевантного контента в базе. Попробуй переформулировать вопрос."
 
-    context = build_context_from_chunks(hits, max_chars=8000)
-    system_prompt = (
-        "Ты помощник, отвечающий строго по предоставленному контексту. "
-        "Если ответа нет в контексте — честно скажи об этом. Отвечай кратко и по делу."
-    )
-    user_prompt = f"Вопрос: {query}\n\nКонтекст:\n{context}\n\nДай связанный ответ на русском языке."
-    return gigachat_answer(system_prompt, user_prompt)
+SYSTEM_PROMPT = (
+    "Ты помощник, отвечающий строго по предоставленному контексту. "
+    "Если ответа нет в контексте — честно скажи об этом. Отвечай кратко и по делу."
+)
 
-def answer_with_top_docs(query: str, top_docs: int = 5, chunks_per_doc: int = 3) -> str:
-    docs = search_grouped_by_doc(query, top_docs=top_docs, chunks_per_doc=chunks_per_doc, oversample=80)
-    if not docs:
-        return "Не нашёл релевантного контента в базе. Попробуй переформулировать вопрос."
+def chunks_prompt(query: str, hits: List[Dict[str, Any]]) -> str:
+    with metrics.span("context"):
+        packed = pack_chunks(hits)
+    metrics.observe_tokens("context", packed.used_tokens)
+    context = packed.text
+    return f"Вопрос: {query}\n\nКонтекст:\n{context}\n\nДай связанный ответ на русском языке."
 
-    context = build_context_from_docs(docs, max_chars=8000)
-    system_prompt = (
-        "Ты помощник, отвечающий строго по предоставленному контексту. "
-        "Если ответа нет в контексте — честно скажи об этом. Отвечай кратко и по делу."
-    )
-    user_prompt = (
+def docs_prompt(query: str, docs: List[Dict[str, Any]]) -> str:
+    with metrics.span("context"):
+        packed = pack_docs(docs)
+    metrics.observe_tokens("context", packed.used_tokens)
+    context = packed.text
+    return (
         f"Вопрос: {query}\n\n"
         f"Контекст: ниже собраны фрагменты из топ-{len(docs)} документов.\n"
         f"{context}\n\nСформулируй ответ на русском."
     )
-    return gigachat_answer(system_prompt, user_prompt)
\ No newline at end of file
+
+# --------- кэш ответов ---------
+
+def _cached_answer(query: str, ids: List[str]) -> tuple[bytes | None, int, str | None]:
+    """(ключ, версия коллекции, ответ из кэша или None). Версия берётся до вызова LLM."""
+    cache = get_answer_cache()
+    if cache is None:
+        return None, 0, None
+    key = answer_key(gigachat_model(), SYSTEM_PROMPT, query, ids)
+    version = collection_version()
+    answer = cache.get(key, version)
+    metrics.cache_hit("answers", answer is not None)
+    return key, version, answer
+
+def _remember_answer(key: bytes | None, version: int, answer: str) -> None:
+    cache = get_answer_cache()
+    if cache is not None and key is not None and answer.strip():
+        cache.put(key, version, answer)
+
+# --------- публичные функции ---------
+# owner / doc_names — область поиска (см. searcher.search): бот ищет по документам пользователя
+
+def answer_with_top_chunks(
+    query: str, top_k: int = 10, owner: str | None = None, doc_names: Sequence[str] | None = None,
+) -> str:
+    hits = search(query, top_k=top_k, owner=owner, doc_names=doc_names)
+    if not hits:
+        return NOT_FOUND_ANSWER
+    key, version, answer = _cached_answer(query, hit_ids(hits))
+    if answer is None:
+        answer = gigachat_answer(SYSTEM_PROMPT, chunks_prompt(query, hits))
+        _remember_answer(key, version, answer)
+    return answer
+
+def answer_with_top_docs(
+    query: str,
+    top_docs: int = 5,
+    chunks_per_doc: int = 3,
+    owner: str | None = None,
+    doc_names: Sequence[str] | None = None,
+) -> str:
+    docs = search_grouped_by_doc(query, top_docs=top_docs, chunks_per_doc=chunks_per_doc, oversample=80,
+                                 owner=owner, doc_names=doc_names)
+    if not docs:
+        return NOT_FOUND_ANSWER
+    key, version, answer = _cached_answer(query, doc_chunk_ids(docs))
+    if answer is None:
+        answer = gigachat_answer(SYSTEM_PROMPT, docs_prompt(query, docs))
+        _remember_answer(key, version, answer)
+    return answer
+
+# --------- асинхронные версии (бот) ---------
+# эмбеддинг — aiohttp, поиск — в пуле потоков Milvus, GigaChat — ainvoke;
+# event loop не блокируется, пока готовится ответ (SQLite кэша ответов — в потоке)
+
+async def aanswer_with_top_chunks(
+    query: str, top_k: int = 10, owner: str | None = None, doc_names: Sequence[str] | None = None,
+) -> str:
+    hits = await asearch(query, top_k=top_k, owner=owner, doc_names=doc_names)
+    if not hits:
+        return NOT_FOUND_ANSWER
+    key, version, answer = await asyncio.to_thread(_cached_answer, query, hit_ids(hits))
+    if answer is None:
+        answer = await alc_answer(SYSTEM_PROMPT, chunks_prompt(query, hits))
+        await asyncio.to_thread(_remember_answer, key, version, answer)
+    return answer
+
+async def aanswer_with_top_docs(
+    query: str,
+    top_docs: int = 5,
+    chunks_per_doc: int = 3,
+    owner: str | None = None,
+    doc_names: Sequence[str] | None = None,
+) -> str:
+    docs = await asearch_grouped_by_doc(query, top_docs=top_docs, chunks_per_doc=chunks_per_doc, oversample=80,
+                                        owner=owner, doc_names=doc_names)
+    if not docs:
+        return NOT_FOUND_ANSWER
+    key, version, answer = await asyncio.to_thread(_cached_answer, query, doc_chunk_ids(docs))
+    if answer is None:
+        answer = await alc_answer(SYSTEM_PROMPT, docs_prompt(query, docs))
+        await asyncio.to_thread(_remember_answer, key, version, answer)
+    return answer
+
+async def astream_answer_with_top_docs(
+    query: str,
+    top_docs: int = 5,
+    chunks_per_doc: int = 3,
+    owner: str | None = None,
+    doc_names: Sequence[str] | None = None,
+) -> AsyncIterator[str]:
+    """Как aanswer_with_top_docs, но ответ GigaChat отдаётся кусочками по мере генерации."""
+    docs = await asearch_grouped_by_doc(query, top_docs=top_docs, chunks_per_doc=chunks_per_doc, oversample=80,
+                                        owner=owner, doc_names=doc_names)
+    if not docs:
+        yield NOT_FOUND_ANSWER
+        return
+    key, version, answer = await asyncio.to_thread(_cached_answer, query, doc_chunk_ids(docs))
+    if answer is not None:
+        yield answer
+        return
+    parts: List[str] = []
+    async for delta in alc_stream(SYSTEM_PROMPT, docs_prompt(query, docs)):
+        parts.append(delta)
+        yield delta
+    # в кэш — только полностью полученный ответ
+    await asyncio.to_thread(_remember_answer, key, version, "".join(parts))
@@ -1,105 +1,620 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import contextvars
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import numpy as np
-from collections import defaultdict
-from typing import List, Dict, Any
+import grpc
+from collections import OrderedDict, defaultdict
+from typing import List, Dict, Any, Hashable, Sequence
 import logging
 
-from pymilvus import MilvusClient
-from pymilvus.exceptions import MilvusException
-from backend.config import DB_PATH, COLLECTION, VECTOR_FIELD, DIMENSION, SERVICE_URL, TOP_K_DEFAULT
+from backend.config import (
+    COLLECTION, VECTOR_FIELD, DIMENSION, SERVICE_URL, TOP_K_DEFAULT, EMBED_WIRE_FORMAT,
+    QUERY_EMBED_CACHE_SIZE, SEARCH_RESULT_CACHE_SIZE, SEARCH_RESULT_CACHE_TTL,
+    SEARCH_GROUPING, SEARCH_GROUP_MAX_LIMIT, SEARCH_MODE, HYBRID_RRF_K,
+    MMR_ENABLED, MMR_LAMBDA, MMR_FETCH_FACTOR, RESCORE_FACTOR,
+)
+from backend import wire, metrics
+from backend.embed_cache import embed_with_cache, normalize_text
+from backend.milvus_store import get_store, collection_version, milvus_str, search_params
+from backend.lexical import get_lexical_index
+from backend.diversify import mmr
+from backend.vector_storage import TRUNCATED, ROW_FIELD, reduce_vectors, rescore, get_full_vectors
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
 
-def _ensure_loaded(client: MilvusClient):
-    try:
-        client.load_collection(collection_name=COLLECTION)
-    except Exception:
-        pass
+# -------------------- кэши --------------------
+class _LRUCache:
+    """Потокобезопасный LRU со счётчиками; ttl > 0 — записи ещё и протухают."""
 
-def _ensure_index(client: MilvusClient):
-    """
-    Создаём индекс, если его ещё нет. Используем именно IndexParams, а не dict.
-    """
-    try:
-        # если индекса нет — create_index не упадёт при повторном создании в AUTOINDEX
-        index_params = client.prepare_index_params()
-        index_params.add_index(
-            field_name=VECTOR_FIELD,
-            index_type="AUTOINDEX",
-            metric_type="IP",
-            params={},  # AUTOINDEX не требует параметров
+    def __init__(self, name: str, maxsize: int, ttl: float = 0.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (not self.ttl or item[0] > time.monotonic()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                metrics.cache_hit(self.name, True)
+                return item[1]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+        metrics.cache_hit(self.name, False)
+        return None
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": (self.hits / total) if total else 0.0, "size": len(self._data)}
+
+# L1: нормализованный текст запроса -> эмбеддинг (без похода в /embed и дисковый кэш)
+_query_vectors = _LRUCache("query_embeddings", QUERY_EMBED_CACHE_SIZE)
+# L2: (вектор, top_k, поля, версия коллекции) -> хиты; запись в коллекцию меняет версию
+_search_results = _LRUCache("search_results", SEARCH_RESULT_CACHE_SIZE, ttl=SEARCH_RESULT_CACHE_TTL)
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {"query_embeddings": _query_vectors.stats(), "search_results": _search_results.stats()}
+
+def clear_caches() -> None:
+    _query_vectors.clear()
+    _search_results.clear()
+
+# -------------------- эмбеддинги запросов --------------------
+def _embed_remote(texts: List[str]) -> np.ndarray:
+    metrics.observe_batch("embed_query", len(texts))
+    with metrics.span("embed_query"):
+        resp = requests.post(
+            f"{SERVICE_URL}/embed",
+            json={"texts": texts},
+            headers={"Accept": wire.accept_header(EMBED_WIRE_FORMAT)},
+            timeout=60,
         )
-        client.create_index(collection_name=COLLECTION, index_params=index_params)
-        _ensure_loaded(client)
-    except Exception as e:
-        logger.warning("Не удалось создать индекс (возможно уже есть): %s", e)
+        resp.raise_for_status()
+        return wire.decode_response(resp)
 
 def embed_query(query: str) -> np.ndarray:
-    resp = requests.post(f"{SERVICE_URL}/embed", json={"texts": [query]}, timeout=60)
-    resp.raise_for_status()
-    vecs = np.array(resp.json()["embeddings"], dtype=np.float32)
-    return vecs[0]
+    return embed_queries([query])[0]
 
-def search(query: str, top_k: int = TOP_K_DEFAULT) -> List[Dict[str, Any]]:
-    client = MilvusClient(uri=DB_PATH)
-    _ensure_loaded(client)
-    qv = embed_query(query).tolist()
+def cached_query_vector(query: str) -> np.ndarray | None:
+    """Вектор запроса из L1, без похода в сервис."""
+    return _query_vectors.get(normalize_text(query))
 
-    try:
-        results = client.search(
-            collection_name=COLLECTION,
-            data=[qv],
-            anns_field=VECTOR_FIELD,
-            limit=top_k,
-            output_fields=["id", "text", "doc_name", "chunk_id"],
-        )
-    except MilvusException as e:
-        # код 700 = index not found
-        if "index not found" in str(e).lower():
-            logger.info("Индекс отсутствует — создаю и повторяю поиск…")
-            _ensure_index(client)
-            results = client.search(
+def remember_query_vector(query: str, vec: np.ndarray) -> None:
+    _query_vectors.put(normalize_text(query), vec)
+
+def embed_queries(queries: List[str]) -> np.ndarray:
+    """Эмбеддинги [N, D] для пачки запросов — промахи кэшей уходят одним вызовом /embed."""
+    keys = [normalize_text(q) for q in queries]
+    found = {k: v for k in dict.fromkeys(keys) if (v := _query_vectors.get(k)) is not None}
+    missing = [k for k in dict.fromkeys(keys) if k not in found]
+    if missing:
+        for k, v in zip(missing, embed_with_cache(missing, _embed_remote)):
+            _query_vectors.put(k, v)
+            found[k] = v
+    if not keys:
+        return np.zeros((0, DIMENSION), dtype=np.float32)
+    return np.stack([found[k] for k in keys])
+
+def _output_fields() -> List[str]:
+    fields = ["id", "text", "doc_name", "chunk_id"]
+    for extra in ("owner", "page", ROW_FIELD):
+        if extra in get_store().fields:
+            fields.append(extra)
+    return fields
+
+def doc_key(ent: Dict[str, Any]) -> tuple[str, str]:
+    """Документ хита: (owner, doc_name) — одноимённые документы разных владельцев различаются."""
+    return ent.get("owner") or "", ent.get("doc_name") or "unknown"
+
+def hit_score(h: Dict[str, Any]) -> float:
+    """Скор хита: MilvusClient отдаёт его как distance (для IP — чем больше, тем лучше)."""
+    score = h.get("score")
+    return float(score if score is not None else h.get("distance", 0.0))
+
+def _search_vectors(
+    vectors: np.ndarray,
+    top_k: int,
+    fields: List[str] | None = None,
+    **search_kwargs: Any,
+) -> List[List[Dict[str, Any]]]:
+    """
+    Один client.search на все векторы, которых нет в кэше результатов;
+    хиты по каждому в исходном порядке. search_kwargs (например, group_by_field)
+    уходят в client.search и входят в ключ кэша.
+    VECTOR_STORAGE=truncated: ищем по срезу RESCORE_FACTOR * top_k кандидатов
+    и пересчитываем скоры по полным векторам (у группирующего поиска — без обрезки).
+    """
+    if len(vectors) == 0:
+        return []
+    store = get_store()
+    store.ready()
+    fields = fields or _output_fields()
+    if TRUNCATED and ROW_FIELD not in fields:
+        fields = fields + [ROW_FIELD]
+    version = collection_version()
+    extra = tuple(sorted(search_kwargs.items()))
+    keys = [(hashlib.sha1(np.ascontiguousarray(v, dtype=np.float32).tobytes()).digest(),
+             top_k, tuple(fields), extra, version) for v in vectors]
+
+    out: List[List[Dict[str, Any]] | None] = [_search_results.get(k) for k in keys]
+    todo = [i for i, r in enumerate(out) if r is None]
+    if todo:
+        data = reduce_vectors(vectors[todo])
+        grouped = "group_by_field" in search_kwargs
+        limit = top_k * max(RESCORE_FACTOR, 1) if TRUNCATED and not grouped else top_k
+        # ef / nprobe под INDEX_PROFILE, если вызывающий не передал свои
+        search_kwargs.setdefault("search_params", search_params(limit=limit))
+        metrics.observe_batch("milvus_search", len(todo))
+        # долгоживущий клиент: коллекция загружена один раз, при ошибке — переподключение
+        with metrics.span("milvus_search"):
+            results = store.call(lambda client: client.search(
                 collection_name=COLLECTION,
-                data=[qv],
+                data=data,
                 anns_field=VECTOR_FIELD,
-                limit=top_k,
-                output_fields=["id", "text", "doc_name", "chunk_id"],
-            )
-        else:
-            raise
+                limit=limit,
+                output_fields=fields,
+                **search_kwargs,
+            ))
+        for i, r in zip(todo, results):
+            out[i] = rescore(vectors[i], list(r), None if grouped else top_k) if TRUNCATED else list(r)
+            _search_results.put(keys[i], _without_vectors(out[i]))
+    return [list(r) for r in out]
+
+def _without_vectors(hits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Хиты для кэша результатов — без VECTOR_FIELD (4 КБ на хит при DIMENSION=1024).
+    Свежий ответ отдаётся с векторами; при попадании в кэш MMR дозагружает их по id.
+    """
+    return [{**h, "entity": {f: v for f, v in h["entity"].items() if f != VECTOR_FIELD}}
+            if VECTOR_FIELD in h.get("entity", {}) else h for h in hits]
+
+# -------------------- область поиска --------------------
+# owner — документы этого владельца (id пользователя бота) и общие (owner "", из CLI);
+# owner="" — только общие, None — вся коллекция. doc_names — только эти документы.
+# Ограничение уходит в filter поиска Milvus (owner — partition key, так что Milvus
+# смотрит только партиции этих владельцев) и в ключ кэша результатов.
+_owner_field_warned = False
+
+def _has_owner_field() -> bool:
+    global _owner_field_warned
+    store = get_store()
+    store.ready()
+    if "owner" in store.fields:
+        return True
+    if not _owner_field_warned:
+        logger.warning("В коллекции %s нет поля owner (создана старой версией) — поиск без ограничения по владельцу",
+                       COLLECTION)
+        _owner_field_warned = True
+    return False
 
-    hits = results[0]
+def scope_owners(owner: str | None = None) -> List[str] | None:
+    """Владельцы документов в области поиска; None — без ограничения."""
+    if owner is None or not _has_owner_field():
+        return None
+    return list(dict.fromkeys([owner, ""]))
+
+def scope_filter(owner: str | None = None, doc_names: Sequence[str] | None = None) -> str | None:
+    """Filter-выражение Milvus для области поиска; None — вся коллекция."""
+    parts = []
+    owners = scope_owners(owner)
+    if owners is not None:
+        parts.append(f"owner in [{', '.join(milvus_str(o) for o in owners)}]")
+    if doc_names is not None:
+        parts.append(f"doc_name in [{', '.join(milvus_str(d) for d in doc_names)}]")
+    return " and ".join(parts) or None
+
+def _filter_kwargs(expr: str | None) -> Dict[str, Any]:
+    # без области — без filter: ключ кэша и запрос как раньше
+    return {"filter": expr} if expr else {}
+
+def search(
+    query: str,
+    top_k: int = TOP_K_DEFAULT,
+    query_vec: np.ndarray | None = None,
+    owner: str | None = None,
+    doc_names: Sequence[str] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    query_vec — готовый эмбеддинг запроса (асинхронный путь бота считает его сам).
+    owner / doc_names — искать только в документах владельца и/или в перечисленных.
+    Хиты — отдельные чанки; соседние склеивает только упаковка контекста (rag_qa).
+    """
+    if MMR_ENABLED:
+        return search_diverse(query, top_k, query_vec, owner=owner, doc_names=doc_names)
+    if SEARCH_MODE == "hybrid":
+        return search_hybrid(query, top_k, query_vec=query_vec, owner=owner, doc_names=doc_names)
+    if query_vec is None:
+        query_vec = embed_query(query)
+    hits = _search_vectors(query_vec[None, :], top_k, **_filter_kwargs(scope_filter(owner, doc_names)))[0]
     logger.info("Поиск '%s' -> %d хитов", query, len(hits))
     for i, h in enumerate(hits[:10]):
         ent = h.get("entity", {})
         logger.info("#%d doc=%s chunk=%s score=%.4f",
                     i + 1, ent.get("doc_name", "unknown"),
                     ent.get("chunk_id", "-"),
-                    h.get("score", 0.0))
+                    hit_score(h))
+    return hits
+
+def search_many(
+    queries: List[str],
+    top_k: int = TOP_K_DEFAULT,
+    owner: str | None = None,
+    doc_names: Sequence[str] | None = None,
+) -> List[List[Dict[str, Any]]]:
+    """
+    Пакетный search: все запросы эмбеддятся одним /embed и ищутся одним
+    client.search(data=[...]). Возвращает список хитов на каждый запрос.
+    С MMR — тот же один client.search на MMR_FETCH_FACTOR * top_k кандидатов
+    и MMR по каждому запросу. Гибридный режим — search() на каждый запрос
+    (BM25 пакетно не ищет; эмбеддинги всё равно одним /embed).
+    """
+    if not queries:
+        return []
+    vectors = embed_queries(queries)
+    if SEARCH_MODE == "hybrid":
+        return [search(q, top_k, query_vec=v, owner=owner, doc_names=doc_names) for q, v in zip(queries, vectors)]
+    expr = scope_filter(owner, doc_names)
+    if MMR_ENABLED:
+        raw = _search_vectors(vectors, top_k * max(MMR_FETCH_FACTOR, 1), fields=_mmr_fields(), **_filter_kwargs(expr))
+        results = [_diverse_hits(v, r, top_k) for v, r in zip(vectors, raw)]
+    else:
+        results = _search_vectors(vectors, top_k, **_filter_kwargs(expr))
+    logger.info("Пакетный поиск: %d запросов -> %d хитов", len(queries), sum(len(r) for r in results))
+    return results
+
+# -------------------- гибридный поиск --------------------
+_hybrid_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hybrid")
+
+def _fetch_chunks(keys: List[tuple[str, str, int]]) -> Dict[tuple[str, str, int], Dict[str, Any]]:
+    """Строки Milvus по (owner, doc_name, chunk_id) — для чанков, найденных только BM25."""
+    if not keys:
+        return {}
+    by_doc: Dict[tuple[str, str], List[int]] = defaultdict(list)
+    for owner, doc_name, chunk_id in keys:
+        by_doc[(owner, doc_name)].append(chunk_id)
+    with_owner = _has_owner_field()
+    expr = " or ".join(
+        "(" + (f"owner == {milvus_str(o)} and " if with_owner else "")
+        + f"doc_name == {milvus_str(d)} and chunk_id in {sorted(ids)})"
+        for (o, d), ids in by_doc.items()
+    )
+    fields = _output_fields()
+    with metrics.span("milvus_fetch"):
+        rows = get_store().call(lambda client: client.query(
+            collection_name=COLLECTION, filter=expr, output_fields=fields,
+        ))
+    return {(*doc_key(r), r.get("chunk_id")): r for r in rows}
+
+def _lexical_search(lexical, query: str, n: int, owners: List[str] | None, doc_names: Sequence[str] | None):
+    with metrics.span("bm25"):
+        return lexical.search(query, n, owners, None if doc_names is None else set(doc_names))
+
+def search_hybrid(
+    query: str,
+    top_k: int = TOP_K_DEFAULT,
+    candidates: int | None = None,
+    query_vec: np.ndarray | None = None,
+    owner: str | None = None,
+    doc_names: Sequence[str] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Dense (Milvus) + BM25 (backend/lexical.py) параллельно, слияние reciprocal rank fusion:
+    score = sum 1 / (HYBRID_RRF_K + rank). Хиты в формате search(), score — RRF.
+    """
+    n = candidates or max(top_k * 4, 20)
+    lexical = get_lexical_index()
+    # copy_context — стадия bm25 попадает в трассу запроса и из потока пула
+    lex_fut = (_hybrid_pool.submit(contextvars.copy_context().run, _lexical_search,
+                                   lexical, query, n, scope_owners(owner), doc_names)
+               if lexical is not None else None)
+    if query_vec is None:
+        query_vec = embed_query(query)
+    dense = _search_vectors(query_vec[None, :], n, **_filter_kwargs(scope_filter(owner, doc_names)))[0]
+    lex = lex_fut.result() if lex_fut is not None else []
+
+    # ключ чанка — (owner, doc_name, chunk_id): одноимённые документы разных владельцев не сливаются
+    fused: Dict[tuple[str, str, int], float] = defaultdict(float)
+    entities: Dict[tuple[str, str, int], Dict[str, Any]] = {}
+    for rank, h in enumerate(dense, start=1):
+        ent = h.get("entity", {})
+        key = (*doc_key(ent), ent.get("chunk_id"))
+        fused[key] += 1.0 / (HYBRID_RRF_K + rank)
+        entities.setdefault(key, {"id": h.get("id"), **ent})
+    for rank, (lex_owner, doc_name, chunk_id, _) in enumerate(lex, start=1):
+        fused[(lex_owner, doc_name, chunk_id)] += 1.0 / (HYBRID_RRF_K + rank)
+
+    top = sorted(fused, key=fused.__getitem__, reverse=True)[:top_k]
+    entities.update(_fetch_chunks([k for k in top if k not in entities]))
+    hits = [{"id": entities[k].get("id"), "score": fused[k], "entity": entities[k]} for k in top if k in entities]
+    logger.info("Гибридный поиск '%s' -> %d хитов (dense=%d, bm25=%d)", query, len(hits), len(dense), len(lex))
+    return hits
+
+# -------------------- MMR и склейка соседних чанков --------------------
+def _vectors_for(items: List[Dict[str, Any]]) -> np.ndarray:
+    """
+    [N, D] векторы: из самих items (поле VECTOR_FIELD), недостающие — одним client.get по id.
+    В режиме truncated — полные векторы из файла по vec_row.
+    """
+    if TRUNCATED:
+        return _full_vectors_for(items)
+    missing = [it["id"] for it in items if VECTOR_FIELD not in it and it.get("id") is not None]
+    fetched: Dict[Any, Any] = {}
+    if missing:
+        rows = get_store().call(lambda client: client.get(
+            collection_name=COLLECTION, ids=missing, output_fields=[VECTOR_FIELD],
+        ))
+        fetched = {r["id"]: r[VECTOR_FIELD] for r in rows}
+    out = np.zeros((len(items), DIMENSION), dtype=np.float32)
+    for i, it in enumerate(items):
+        vec = it.get(VECTOR_FIELD, fetched.get(it.get("id")))
+        if vec is not None:
+            out[i] = vec
+    return out
+
+def _full_vectors_for(items: List[Dict[str, Any]]) -> np.ndarray:
+    missing = [it["id"] for it in items if it.get(ROW_FIELD) is None and it.get("id") is not None]
+    rows = {}
+    if missing:
+        got = get_store().call(lambda client: client.get(
+            collection_name=COLLECTION, ids=missing, output_fields=[ROW_FIELD],
+        ))
+        rows = {r["id"]: r[ROW_FIELD] for r in got}
+    idx = [it.get(ROW_FIELD, rows.get(it.get("id"))) for it in items]
+    out = np.zeros((len(items), DIMENSION), dtype=np.float32)
+    known = [i for i, r in enumerate(idx) if r is not None]
+    if known:
+        out[known] = get_full_vectors().get(np.array([idx[i] for i in known]))
+    return out
+
+def diversify(query_vec: np.ndarray, items: List[Dict[str, Any]], k: int) -> List[Dict[str, Any]]:
+    """
+    items — плоские dict чанков (doc_name, chunk_id, text, score, id[, vector]).
+    MMR выбирает k из них; результат — по убыванию score, без векторов.
+    """
+    if MMR_ENABLED and len(items) > k:
+        with metrics.span("mmr"):
+            items = [items[i] for i in mmr(query_vec, _vectors_for(items), k, MMR_LAMBDA)]
+    else:
+        items = items[:k]
+    items = [{f: v for f, v in it.items() if f not in (VECTOR_FIELD, ROW_FIELD)} for it in items]
+    return sorted(items, key=lambda it: it["score"], reverse=True)
+
+def _mmr_fields() -> List[str]:
+    # в truncated-режиме MMR берёт полные векторы из файла, срез из Milvus не нужен
+    return _output_fields() if TRUNCATED else _output_fields() + [VECTOR_FIELD]
+
+def _diverse_hits(query_vec: np.ndarray, raw: List[Dict[str, Any]], top_k: int) -> List[Dict[str, Any]]:
+    """Кандидаты поиска -> top_k хитов после MMR, в формате search()."""
+    items = [{**h.get("entity", {}), "id": h.get("id"), "score": hit_score(h)} for h in raw]
+    return [{"id": it.get("id"), "score": it["score"], "entity": it} for it in diversify(query_vec, items, top_k)]
+
+def search_diverse(
+    query: str,
+    top_k: int = TOP_K_DEFAULT,
+    query_vec: np.ndarray | None = None,
+    owner: str | None = None,
+    doc_names: Sequence[str] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    search() с MMR: MMR_FETCH_FACTOR * top_k кандидатов (с векторами), из них
+    MMR выбирает top_k. Хиты в формате search().
+    """
+    n = top_k * max(MMR_FETCH_FACTOR, 1) if MMR_ENABLED else top_k
+    if query_vec is None:
+        query_vec = embed_query(query)
+    if SEARCH_MODE == "hybrid":
+        raw = search_hybrid(query, n, query_vec=query_vec, owner=owner, doc_names=doc_names)
+    else:
+        raw = _search_vectors(query_vec[None, :], n, fields=_mmr_fields(),
+                              **_filter_kwargs(scope_filter(owner, doc_names)))[0]
+    hits = _diverse_hits(query_vec, raw, top_k)
+    logger.info("Поиск '%s' -> %d кандидатов, %d после MMR", query, len(raw), len(hits))
     return hits
 
-def search_grouped_by_doc(query: str, top_docs: int = 5, chunks_per_doc: int = 3, oversample: int = 80) -> List[Dict[str, Any]]:
-    raw_hits = search(query, top_k=max(oversample, top_docs * chunks_per_doc * 2))
-    by_doc: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+def _group_hits(raw_hits: List[Dict[str, Any]], top_docs: int, chunks_per_doc: int) -> List[Dict[str, Any]]:
+    by_doc: Dict[tuple[str, str], List[Dict[str, Any]]] = defaultdict(list)
     for h in raw_hits:
         ent = h["entity"]
-        by_doc[(ent.get("doc_name") or "unknown")].append({
+        by_doc[doc_key(ent)].append({
+            "id": h.get("id"),
             "text": ent.get("text",""),
-            "score": h.get("score", 0.0),
+            "score": hit_score(h),
             "chunk_id": ent.get("chunk_id"),
+            "page": ent.get("page"),
         })
     docs = []
-    for doc_name, items in by_doc.items():
+    for (owner, doc_name), items in by_doc.items():
         items_sorted = sorted(items, key=lambda x: x["score"], reverse=True)[:chunks_per_doc]
         doc_score = max((x["score"] for x in items_sorted), default=0.0)
-        docs.append({"doc_name": doc_name, "score": doc_score, "chunks": items_sorted})
-    docs_sorted = sorted(docs, key=lambda d: d["score"], reverse=True)[:top_docs]
+        docs.append({"doc_name": doc_name, "owner": owner, "score": doc_score, "chunks": items_sorted})
+    return sorted(docs, key=lambda d: d["score"], reverse=True)[:top_docs]
+
+# -------------------- группировка по документам --------------------
+# native — группирующий поиск Milvus (group_by_field="doc_name"; одноимённые документы
+#          разных владельцев попадают в одну группу и разделяются в _group_hits),
+# two_phase — адаптивный поиск только по id/скорам и дозагрузка текста выбранных чанков,
+# oversample — старое поведение: oversample полных хитов и группировка в Python,
+# auto — native, а если сервер его не умеет, то two_phase.
+_native_grouping_supported: bool | None = None
+
+def _meta_fields() -> List[str]:
+    return [f for f in _output_fields() if f != "text"]
+
+def _fill_texts(groups: List[List[Dict[str, Any]]]) -> None:
+    """Вторая фаза two_phase: один client.get за текстами только оставленных чанков."""
+    ids = list({c["id"] for docs in groups for d in docs for c in d["chunks"] if c.get("id") is not None})
+    if not ids:
+        return
+    with metrics.span("milvus_fetch"):
+        rows = get_store().call(lambda client: client.get(
+            collection_name=COLLECTION, ids=ids, output_fields=["text"],
+        ))
+    texts = {r["id"]: r.get("text", "") for r in rows}
+    for docs in groups:
+        for d in docs:
+            for c in d["chunks"]:
+                c["text"] = texts.get(c["id"], "")
+
+def _grouped_two_phase(
+    vectors: np.ndarray, top_docs: int, chunks_per_doc: int, expr: str | None = None,
+) -> List[List[Dict[str, Any]]]:
+    fields = _meta_fields()
+    limit = top_docs * chunks_per_doc * 2
+    todo = list(range(len(vectors)))
+    groups: List[List[Dict[str, Any]]] = [[] for _ in todo]
+    while todo:
+        raw = _search_vectors(vectors[todo], limit, fields=fields, **_filter_kwargs(expr))
+        retry = []
+        for i, hits in zip(todo, raw):
+            groups[i] = _group_hits(hits, top_docs, chunks_per_doc)
+            # один большой документ съел выдачу, а в коллекции есть ещё — расширяем окно
+            if len(groups[i]) < top_docs and len(hits) >= limit and limit < SEARCH_GROUP_MAX_LIMIT:
+                retry.append(i)
+        todo = retry
+        limit = min(limit * 4, SEARCH_GROUP_MAX_LIMIT)
+    _fill_texts(groups)
+    return groups
+
+def _grouped_native(
+    vectors: np.ndarray, top_docs: int, chunks_per_doc: int, expr: str | None = None,
+) -> List[List[Dict[str, Any]]]:
+    raw = _search_vectors(vectors, top_docs, group_by_field="doc_name", group_size=chunks_per_doc,
+                          **_filter_kwargs(expr))
+    return [_group_hits(hits, top_docs, chunks_per_doc) for hits in raw]
+
+def _grouped_for_vectors(
+    vectors: np.ndarray,
+    top_docs: int,
+    chunks_per_doc: int,
+    oversample: int,
+    mode: str = SEARCH_GROUPING,
+    expr: str | None = None,
+) -> List[List[Dict[str, Any]]]:
+    global _native_grouping_supported
+    if mode == "oversample":
+        raw = _search_vectors(vectors, max(oversample, top_docs * chunks_per_doc * 2), **_filter_kwargs(expr))
+        return [_group_hits(hits, top_docs, chunks_per_doc) for hits in raw]
+    if mode == "two_phase" or (mode == "auto" and _native_grouping_supported is False):
+        return _grouped_two_phase(vectors, top_docs, chunks_per_doc, expr)
+    if mode == "native":
+        return _grouped_native(vectors, top_docs, chunks_per_doc, expr)
+    try:
+        groups = _grouped_native(vectors, top_docs, chunks_per_doc, expr)
+        _native_grouping_supported = True
+        return groups
+    except Exception as e:
+        # навсегда на two_phase — только если сервер не умеет group_by; прочие ошибки
+        # (связь — её уже повторил store.call, таймаут, плохой filter) — наверх
+        if not _grouping_unsupported(e):
+            raise
+        logger.info("Группирующий поиск Milvus недоступен (%s) — переключаюсь на two_phase", e)
+        _native_grouping_supported = False
+        return _grouped_two_phase(vectors, top_docs, chunks_per_doc, expr)
+
+_GROUPING_UNSUPPORTED_MARKERS = ("not support", "unsupported", "not implemented", "unimplemented", "unknown param")
+
+def _grouping_unsupported(e: BaseException) -> bool:
+    """Ошибка «сервер / клиент не умеет группирующий поиск», а не сбой конкретного запроса."""
+    if isinstance(e, TypeError):
+        return "group" in str(e)   # старый pymilvus: unexpected keyword argument 'group_by_field'
+    if isinstance(e, grpc.RpcError) and callable(getattr(e, "code", None)):
+        return e.code() == grpc.StatusCode.UNIMPLEMENTED
+    msg = str(e).lower()
+    return "group" in msg and any(m in msg for m in _GROUPING_UNSUPPORTED_MARKERS)
+
+def _diversify_groups(query_vec: np.ndarray, docs: List[Dict[str, Any]], chunks_per_doc: int) -> None:
+    """MMR внутри каждого документа до chunks_per_doc; векторы — одним get."""
+    items = [{**c, "doc_name": d["doc_name"], "owner": d.get("owner", "")} for d in docs for c in d["chunks"]]
+    if MMR_ENABLED:
+        vecs = _vectors_for(items)
+        for it, v in zip(items, vecs):
+            it[VECTOR_FIELD] = v
+    pos = 0
+    for d in docs:
+        n = len(d["chunks"])
+        d["chunks"] = diversify(query_vec, items[pos : pos + n], chunks_per_doc)
+        pos += n
+
+def search_grouped_by_doc(
+    query: str,
+    top_docs: int = 5,
+    chunks_per_doc: int = 3,
+    oversample: int = 80,
+    query_vec: np.ndarray | None = None,
+    owner: str | None = None,
+    doc_names: Sequence[str] | None = None,
+) -> List[Dict[str, Any]]:
+    """Топ документов с лучшими чанками; owner / doc_names — область поиска, как у search()."""
+    # под MMR берём больше кандидатов на документ, выбираем chunks_per_doc из них
+    per_doc = chunks_per_doc * max(MMR_FETCH_FACTOR, 1) if MMR_ENABLED else chunks_per_doc
+    if query_vec is None:
+        query_vec = embed_query(query)
+    if SEARCH_MODE == "hybrid":
+        hits = search_hybrid(query, top_k=top_docs * per_doc * 2, candidates=max(oversample, top_docs * per_doc * 4),
+                             query_vec=query_vec, owner=owner, doc_names=doc_names)
+        docs_sorted = _group_hits(hits, top_docs, per_doc)
+    else:
+        docs_sorted = _grouped_for_vectors(query_vec[None, :], top_docs, per_doc, oversample,
+                                           expr=scope_filter(owner, doc_names))[0]
+    if MMR_ENABLED:
+        _diversify_groups(query_vec, docs_sorted, chunks_per_doc)
 
     logger.info("=== Топ-%d документов '%s' ===", top_docs, query)
     for d in docs_sorted:
         logger.info("Документ %s (score=%.4f, чанков=%d)", d["doc_name"], d["score"], len(d["chunks"]))
-    return docs_sorted
\ No newline at end of file
+    return docs_sorted
+
+def search_grouped_by_doc_many(
+    queries: List[str],
+    top_docs: int = 5,
+    chunks_per_doc: int = 3,
+    oversample: int = 80,
+    owner: str | None = None,
+    doc_names: Sequence[str] | None = None,
+) -> List[List[Dict[str, Any]]]:
+    """
+    Пакетная версия search_grouped_by_doc: один /embed и общий поиск на все запросы,
+    тот же MMR и область поиска. Гибридный режим —
+    search_grouped_by_doc на каждый запрос (BM25 пакетно не ищет).
+    """
+    if not queries:
+        return []
+    vectors = embed_queries(queries)
+    if SEARCH_MODE == "hybrid":
+        return [search_grouped_by_doc(q, top_docs, chunks_per_doc, oversample, query_vec=v,
+                                      owner=owner, doc_names=doc_names)
+                for q, v in zip(queries, vectors)]
+    per_doc = chunks_per_doc * max(MMR_FETCH_FACTOR, 1) if MMR_ENABLED else chunks_per_doc
+    groups = _grouped_for_vectors(vectors, top_docs, per_doc, oversample, expr=scope_filter(owner, doc_names))
+    if MMR_ENABLED:
+        for v, docs in zip(vectors, groups):
+            _diversify_groups(v, docs, chunks_per_doc)
+    return groups
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Подбор профиля ANN-индекса на своих данных.
+
+Для каждого профиля индекс коллекции перестраивается (время построения + загрузки),
+затем те же запросы прогоняются по одному: recall@k против точного поиска (FLAT),
+p50/p99 задержки запроса. HNSW перебирается по --ef, IVF_* — по --nprobe.
+Запросы — векторы случайных строк коллекции (в режиме truncated — срезы их
+полных векторов), так что меряется именно индекс, без эмбеддера и пересчёта скоров.
+
+В конце индекс возвращается к INDEX_PROFILE из конфига. Пока идёт замер,
+поиск по коллекции из бота работает на чужом индексе — запускать вне нагрузки.
+
+Нужен Milvus-сервер (MILVUS_URI): Milvus Lite принимает HNSW / IVF_*, но ищет
+перебором, как FLAT, — recall всегда 1.0, а ef / nprobe ни на что не влияют.
+На Lite скрипт отказывается работать.
+
+    python -m backend.tune_index --queries 200 --top-k 10 --ef 16,32,64,128 --nprobe 8,16,32
+"""
+
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+# Если запускаешь из папки backend/, гарантируем импорт конфига из корня
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from backend.config import COLLECTION, VECTOR_FIELD, INDEX_PROFILE
+from backend.milvus_store import INDEX_PROFILES, MilvusStore, get_store, rebuild_index, search_params
+from backend.vector_storage import TRUNCATED, ROW_FIELD, reduce_vectors, get_full_vectors
+
+def sample_queries(store: MilvusStore, n: int, seed: int = 0) -> List[Any]:
+    """
+    Значения поля вектора для n случайных живых строк коллекции: id всех строк —
+    постранично через query_iterator (query() упирается в limit), векторы выбранных — одним get.
+    """
+    it = store.call(lambda client: client.query_iterator(
+        collection_name=COLLECTION, batch_size=4096, filter="id >= 0", output_fields=["id"],
+    ))
+    ids: List[int] = []
+    try:
+        while batch := it.next():
+            ids.extend(r["id"] for r in batch)
+    finally:
+        it.close()
+    if not ids:
+        raise SystemExit("Коллекция пуста — сначала проиндексируй документы")
+    rng = np.random.default_rng(seed)
+    picked_ids = [ids[i] for i in rng.choice(len(ids), size=min(n, len(ids)), replace=False)]
+    field = ROW_FIELD if TRUNCATED else VECTOR_FIELD
+    picked = store.call(lambda client: client.get(collection_name=COLLECTION, ids=picked_ids, output_fields=[field]))
+    if TRUNCATED:
+        return reduce_vectors(get_full_vectors().get(np.array([r[ROW_FIELD] for r in picked])))
+    return [np.asarray(r[VECTOR_FIELD], dtype=np.float32).tolist() for r in picked]
+
+def run_queries(client, data: List[Any], top_k: int, params: dict) -> tuple[List[List[int]], np.ndarray]:
+    """id хитов и задержки (мс) — запросы по одному, как их шлёт бот."""
+    ids, latencies = [], []
+    client.search(collection_name=COLLECTION, data=data[:1], anns_field=VECTOR_FIELD,
+                  limit=top_k, search_params=params)   # прогрев
+    for v in data:
+        started = time.perf_counter()
+        res = client.search(collection_name=COLLECTION, data=[v], anns_field=VECTOR_FIELD,
+                            limit=top_k, search_params=params)
+        latencies.append(1000 * (time.perf_counter() - started))
+        ids.append([h["id"] for h in res[0]])
+    return ids, np.array(latencies)
+
+def recall_at_k(exact: List[List[int]], found: List[List[int]], top_k: int) -> float:
+    return float(np.mean([len(set(e) & set(f)) / max(min(top_k, len(e)), 1) for e, f in zip(exact, found)]))
+
+def tune(profiles: List[str], n_queries: int, top_k: int, efs: List[int], nprobes: List[int]) -> List[Dict[str, Any]]:
+    store = get_store()
+    if store.is_lite:
+        raise SystemExit(f"{store.uri} — Milvus Lite: HNSW / IVF там ищут перебором, как FLAT, и замер "
+                         "ничего не покажет. Подбирать индекс нужно на Milvus-сервере: задай MILVUS_URI.")
+    client = store.ready()
+    data = sample_queries(store, n_queries)
+    rows = client.query(collection_name=COLLECTION, filter="id >= 0", output_fields=["count(*)"])
+    n_rows = rows[0]["count(*)"] if rows else 0
+    print(f"Коллекция {COLLECTION}: {n_rows} векторов, запросов {len(data)}, top_k={top_k}")
+
+    results: List[Dict[str, Any]] = []
+    try:
+        rebuild_index(client, "flat")
+        exact, _ = run_queries(client, data, top_k, search_params("flat"))
+        for profile in profiles:
+            build_s = rebuild_index(client, profile)
+            if profile == "hnsw":
+                grid = [{"ef": ef} for ef in efs]
+            elif profile.startswith("ivf"):
+                grid = [{"nprobe": p} for p in nprobes]
+            else:
+                grid = [{}]
+            for knobs in grid:
+                params = search_params(profile, limit=top_k, **knobs)
+                found, lat = run_queries(client, data, top_k, params)
+                results.append({
+                    "profile": profile,
+                    "search_params": params["params"],
+                    "recall": recall_at_k(exact, found, top_k),
+                    "p50_ms": float(np.percentile(lat, 50)),
+                    "p99_ms": float(np.percentile(lat, 99)),
+                    "build_s": build_s,
+                    "rows": n_rows,
+                    "queries": len(data),
+                    "top_k": top_k,
+                })
+    finally:
+        rebuild_index(client, INDEX_PROFILE)
+    return results
+
+def _ints(s: str) -> List[int]:
+    return [int(x) for x in s.split(",") if x.strip()]
+
+def main():
+    ap = argparse.ArgumentParser(description="recall@k / латентность / время построения для профилей ANN-индекса")
+    ap.add_argument("--profiles", default=",".join(INDEX_PROFILES), help="через запятую")
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--top-k", type=int, default=10)
+    ap.add_argument("--ef", default="16,32,64,128", help="ef для hnsw, через запятую")
+    ap.add_argument("--nprobe", default="4,16,64", help="nprobe для ivf_*, через запятую")
+    ap.add_argument("--json", type=Path, help="куда дополнительно записать результаты")
+    args = ap.parse_args()
+
+    profiles = [p.strip().lower() for p in args.profiles.split(",") if p.strip()]
+    unknown = [p for p in profiles if p not in INDEX_PROFILES]
+    if unknown:
+        raise SystemExit(f"Неизвестные профили: {', '.join(unknown)} (есть: {', '.join(INDEX_PROFILES)})")
+
+    results = tune(profiles, args.queries, args.top_k, _ints(args.ef), _ints(args.nprobe))
+    print(f"\n{'профиль':<10} {'параметры':<16} {'recall@k':>9} {'p50, мс':>9} {'p99, мс':>9} {'сборка, с':>10}")
+    for r in results:
+        knobs = ",".join(f"{k}={v}" for k, v in r["search_params"].items()) or "-"
+        print(f"{r['profile']:<10} {knobs:<16} {r['recall']:>9.3f} {r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['build_s']:>10.2f}")
+    if args.json:
+        args.json.write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"\n💾 {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Формат хранения векторов в Milvus (VECTOR_STORAGE).
+
+full      — как раньше: полный DIMENSION-мерный FLOAT_VECTOR.
+truncated — в индекс идёт Matryoshka-срез: первые STORE_DIM компонент,
+            заново L2-нормализованные, в STORE_DTYPE (float32 | float16 | binary).
+            Полные float32-векторы лежат в memory-mapped файле рядом с коллекцией,
+            строка Milvus ссылается на них полем vec_row. Поиск берёт
+            RESCORE_FACTOR * top_k кандидатов по срезу и пересчитывает скоры
+            по полным векторам.
+
+Milvus Lite умеет только FLOAT_VECTOR, поэтому float16 и binary — для Milvus-сервера.
+Режим задаёт схему коллекции: при смене — новое COLLECTION_NAME и переиндексация.
+
+python -m backend.vector_storage --recall 200 — recall@k поиска против точного
+перебора по полным векторам.
+"""
+
+import argparse
+import fcntl
+import os
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+# Если запускаешь из папки backend/, гарантируем импорт конфига из корня
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from backend.config import DIMENSION, VECTOR_STORAGE, STORE_DIM, STORE_DTYPE, FULL_VECTORS_PATH
+from backend import metrics
+
+ROW_FIELD = "vec_row"
+TRUNCATED = VECTOR_STORAGE == "truncated"
+
+def index_dim() -> int:
+    return min(STORE_DIM, DIMENSION) if TRUNCATED else DIMENSION
+
+def metric_type() -> str:
+    return "HAMMING" if TRUNCATED and STORE_DTYPE == "binary" else "IP"
+
+def reduce_vectors(vectors: np.ndarray) -> List[Any]:
+    """Полные векторы [N, D] -> значения поля вектора для insert/search в текущем режиме."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if not TRUNCATED:
+        return [v.tolist() for v in vectors]
+    cut = vectors[:, : index_dim()]
+    cut = cut / np.maximum(np.linalg.norm(cut, axis=1, keepdims=True), 1e-12)
+    if STORE_DTYPE == "binary":
+        return [np.packbits(v > 0).tobytes() for v in cut]
+    if STORE_DTYPE == "float16":
+        return list(cut.astype(np.float16))
+    return [v.tolist() for v in cut]
+
+# -------------------- полные векторы на диске --------------------
+class FullVectors:
+    """
+    Append-only float32 [rows, D] в файле. Дописывание под flock — бот и
+    CLI-индексатор пишут в один файл. Строки удалённых чанков не переиспользуются.
+    """
+
+    def __init__(self, path: Path, dim: int):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self._lock = threading.Lock()
+        self._mm: np.memmap | None = None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch(exist_ok=True)
+
+    def append(self, vectors: np.ndarray) -> np.ndarray:
+        data = np.ascontiguousarray(vectors, dtype="<f4")
+        with self._lock, open(self.path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                start = f.seek(0, os.SEEK_END) // self.row_bytes
+                f.write(data.tobytes())
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return np.arange(start, start + len(data), dtype=np.int64)
+
+    def get(self, rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        with self._lock:
+            n = os.path.getsize(self.path) // self.row_bytes
+            if self._mm is None or len(self._mm) < n:
+                # файл вырос (в том числе из другого процесса) — переоткрываем отображение
+                self._mm = np.memmap(self.path, dtype="<f4", mode="r", shape=(n, self.dim)) if n else None
+            mm = self._mm
+        if mm is None or (len(rows) and rows.max() >= len(mm)):
+            raise RuntimeError(f"В {self.path} нет строк {rows.tolist()} — файл полных векторов не от этой коллекции?")
+        return np.asarray(mm[rows])
+
+    def __len__(self) -> int:
+        return os.path.getsize(self.path) // self.row_bytes
+
+@lru_cache(maxsize=1)
+def get_full_vectors() -> FullVectors:
+    return FullVectors(Path(FULL_VECTORS_PATH), DIMENSION)
+
+# -------------------- пересчёт скоров --------------------
+def rescore(query: np.ndarray, hits: List[Dict[str, Any]], top_k: int | None) -> List[Dict[str, Any]]:
+    """
+    Скоры хитов (с vec_row в entity) по полным векторам: distance = IP с полным
+    запросом, порядок по убыванию, top_k=None — без обрезки (группирующий поиск).
+    """
+    rows = [h.get("entity", {}).get(ROW_FIELD) for h in hits]
+    keep = [i for i, r in enumerate(rows) if r is not None]
+    if not keep:
+        return hits if top_k is None else hits[:top_k]
+    with metrics.span("rescore"):
+        scores = get_full_vectors().get(np.array([rows[i] for i in keep])) @ np.asarray(query, dtype=np.float32)
+    out = [{**hits[i], "distance": float(s)} for i, s in zip(keep, scores)]
+    out.sort(key=lambda h: h["distance"], reverse=True)
+    return out if top_k is None else out[:top_k]
+
+# -------------------- замер recall --------------------
+RECALL_BATCH_ROWS = 65536   # строк полных векторов на шаг точного перебора
+
+def _live_rows(store) -> np.ndarray:
+    """vec_row всех живых строк коллекции — постранично, query() без итератора упирается в limit."""
+    from backend.config import COLLECTION
+
+    it = store.call(lambda client: client.query_iterator(
+        collection_name=COLLECTION, batch_size=4096, filter="id >= 0", output_fields=[ROW_FIELD],
+    ))
+    rows: List[int] = []
+    try:
+        while batch := it.next():
+            rows.extend(r[ROW_FIELD] for r in batch)
+    finally:
+        it.close()
+    return np.array(sorted(rows), dtype=np.int64)
+
+def _exact_top_k(queries: np.ndarray, live: np.ndarray, top_k: int) -> np.ndarray:
+    """[Q, top_k] vec_row точных соседей (IP): полные векторы читаются пачками по RECALL_BATCH_ROWS."""
+    full = get_full_vectors()
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(live), RECALL_BATCH_ROWS):
+        part = live[start : start + RECALL_BATCH_ROWS]
+        scores = np.concatenate([best_scores, queries @ full.get(part).T], axis=1)
+        rows = np.concatenate([best_rows, np.broadcast_to(part, (len(queries), len(part)))], axis=1)
+        order = np.argsort(-scores, axis=1)[:, :top_k]
+        best_scores = np.take_along_axis(scores, order, axis=1)
+        best_rows = np.take_along_axis(rows, order, axis=1)
+    return best_rows
+
+def measure_recall(n_queries: int, top_k: int, seed: int = 0) -> Dict[str, float]:
+    """
+    Запросы — случайные живые строки коллекции. Эталон — точный перебор полных
+    векторов всех живых строк (IP), проверяемое — обычный путь поиска searcher.
+    """
+    from backend.milvus_store import get_store
+    from backend.searcher import _search_vectors
+
+    if not TRUNCATED:
+        raise SystemExit("recall имеет смысл для VECTOR_STORAGE=truncated")
+    live = _live_rows(get_store())
+    if len(live) == 0:
+        raise SystemExit("Коллекция пуста")
+    rng = np.random.default_rng(seed)
+    queries = get_full_vectors().get(np.sort(rng.choice(live, size=min(n_queries, len(live)), replace=False)))
+
+    exact = _exact_top_k(queries, live, top_k)
+    started = time.perf_counter()
+    found = _search_vectors(queries, top_k)
+    elapsed = time.perf_counter() - started
+    recall = np.mean([
+        len(set(e.tolist()) & {h["entity"].get(ROW_FIELD) for h in f}) / top_k
+        for e, f in zip(exact, found)
+    ])
+    return {"recall": float(recall), "queries": len(queries), "top_k": top_k,
+            "ms_per_query": 1000 * elapsed / len(queries)}
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="recall@k поиска по срезанным векторам против полных")
+    ap.add_argument("--recall", type=int, default=200, help="число запросов")
+    ap.add_argument("--top-k", type=int, default=10)
+    args = ap.parse_args()
+    print(measure_recall(args.recall, args.top_k))
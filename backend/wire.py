@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бинарный формат ответа /embed.
+
+Тело — сырые little-endian float32 или float16 подряд (row-major), форма и тип
+передаются заголовками X-Embeddings-Shape ("N,D") и X-Embeddings-Dtype.
+Клиент просит формат через Accept: application/x-embeddings; dtype=float16,
+сервер без поддержки формата просто ответит JSON — он остаётся фолбэком.
+"""
+
+import numpy as np
+
+MEDIA_TYPE = "application/x-embeddings"
+SHAPE_HEADER = "X-Embeddings-Shape"
+DTYPE_HEADER = "X-Embeddings-Dtype"
+
+_DTYPES = {"float32": np.dtype("<f4"), "float16": np.dtype("<f2")}
+
+def accept_header(wire_format: str) -> str:
+    """Accept для клиента: бинарный формат с JSON в качестве запасного."""
+    if wire_format not in _DTYPES:
+        return "application/json"
+    return f"{MEDIA_TYPE}; dtype={wire_format}, application/json;q=0.5"
+
+def negotiate(accept: str | None) -> str | None:
+    """Разбирает Accept на стороне сервера. Возвращает dtype или None (= отвечать JSON)."""
+    if not accept:
+        return None
+    for part in accept.split(","):
+        media, *params = [p.strip() for p in part.split(";")]
+        if media.lower() != MEDIA_TYPE:
+            continue
+        dtype = "float32"
+        for p in params:
+            key, _, value = p.partition("=")
+            if key.strip().lower() == "dtype":
+                dtype = value.strip().lower()
+        return dtype if dtype in _DTYPES else None
+    return None
+
+def encode(arr: np.ndarray, dtype: str) -> tuple[bytes, dict[str, str]]:
+    """[N, D] -> (тело, заголовки)."""
+    data = np.ascontiguousarray(arr, dtype=_DTYPES[dtype])
+    n, d = data.shape
+    headers = {SHAPE_HEADER: f"{n},{d}", DTYPE_HEADER: dtype}
+    return data.tobytes(), headers
+
+def decode(content: bytes, headers) -> np.ndarray:
+    """Тело + заголовки -> [N, D] float32. Для float32 без копирования (read-only view)."""
+    dtype = (headers.get(DTYPE_HEADER) or "float32").strip().lower()
+    if dtype not in _DTYPES:
+        raise RuntimeError(f"Неизвестный тип эмбеддингов в ответе: {dtype}")
+    try:
+        n, d = (int(x) for x in headers[SHAPE_HEADER].split(","))
+    except (KeyError, ValueError):
+        raise RuntimeError("Сервис вернул бинарный ответ без корректного X-Embeddings-Shape")
+    arr = np.frombuffer(content, dtype=_DTYPES[dtype])
+    if arr.size != n * d:
+        raise RuntimeError(f"Размер тела не совпадает с формой [{n},{d}]")
+    arr = arr.reshape(n, d)
+    return arr if dtype == "float32" else arr.astype(np.float32)
+
+def decode_response(resp) -> np.ndarray:
+    """Декодирует ответ requests: бинарный формат или JSON."""
+    ctype = (resp.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+    if ctype == MEDIA_TYPE:
+        return decode(resp.content, resp.headers)
+    payload = resp.json()
+    if "embeddings" not in payload:
+        raise RuntimeError("Сервис вернул некорректный ответ: нет ключа 'embeddings'")
+    return np.array(payload["embeddings"], dtype=np.float32)
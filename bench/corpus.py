@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Синтетические корпуса PDF / DOCX / TXT для бенчмарка.
+
+Текст — псевдослова из русских слогов с зипфовским распределением частот,
+так что нарезка, BM25 и эмбеддинги работают как на живом тексте. В каждый
+документ вшиты «факты» вида «Параметр <код> равен <число>» с уникальным
+кодом — из них строятся вопросы, а по документу факта считается hit rate.
+Всё детерминировано по seed: один и тот же размер даёт одни и те же файлы.
+"""
+
+import html
+import json
+import random
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Dict, List
+
+import docx
+import fitz
+
+# размер -> (документов каждого формата, страниц в документе)
+SIZES: Dict[str, tuple[int, int]] = {
+    "small": (2, 10),
+    "medium": (6, 40),
+    "large": (16, 120),
+}
+FORMATS = ("pdf", "docx", "txt")
+WORDS_PER_PAGE = 350
+FACTS_PER_PAGE = 2
+
+_SYLLABLES = [
+    "ка", "ро", "ми", "на", "те", "ло", "за", "ви", "ст", "пра", "до", "ре", "ко", "ны", "ли",
+    "мо", "се", "ва", "то", "ни", "ра", "ста", "про", "де", "бу", "го", "жи", "чу", "ше", "ры",
+]
+
+@dataclass
+class Question:
+    text: str
+    doc_name: str
+    answer: str
+
+@dataclass
+class Corpus:
+    size: str
+    root: Path
+    files: List[Path]
+    questions: List[Question]
+    seed: int = 0
+
+    def manifest(self) -> dict:
+        return {**corpus_spec(self.size, self.seed), "files": [p.name for p in self.files],
+                "questions": [asdict(q) for q in self.questions]}
+
+def corpus_spec(size: str, seed: int) -> dict:
+    """Всё, от чего зависит содержимое корпуса: при расхождении с corpus.json корпус пересоздаётся."""
+    n_docs, n_pages = SIZES[size]
+    return {"size": size, "seed": seed, "docs_per_format": n_docs, "pages": n_pages,
+            "formats": list(FORMATS), "words_per_page": WORDS_PER_PAGE, "facts_per_page": FACTS_PER_PAGE}
+
+def _vocabulary(rng: random.Random, n: int = 4000) -> List[str]:
+    words: dict[str, None] = {}
+    while len(words) < n:
+        words["".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(1, 4)))] = None
+    return list(words)
+
+def _pages(rng: random.Random, vocab: List[str], weights: List[float], doc_key: str,
+           n_pages: int) -> tuple[List[List[str]], List[Question]]:
+    """Страницы (список абзацев) и вопросы по вшитым фактам."""
+    pages, questions = [], []
+    for p in range(n_pages):
+        words = rng.choices(vocab, weights=weights, k=WORDS_PER_PAGE)
+        paragraphs = [" ".join(words[i:i + 70]).capitalize() + "." for i in range(0, len(words), 70)]
+        for f in range(FACTS_PER_PAGE):
+            code = f"{doc_key}x{p}x{f}"
+            value = str(rng.randint(10, 99999))
+            paragraphs.insert(rng.randint(0, len(paragraphs)), f"Параметр {code} равен {value}.")
+            questions.append(Question(f"Чему равен параметр {code}?", "", value))
+        pages.append(paragraphs)
+    return pages, questions
+
+def _write_txt(path: Path, pages: List[List[str]]) -> None:
+    path.write_text("\n\n".join("\n".join(p) for p in pages), encoding="utf-8")
+
+def _write_docx(path: Path, pages: List[List[str]]) -> None:
+    d = docx.Document()
+    for paragraphs in pages:
+        for text in paragraphs:
+            d.add_paragraph(text)
+    d.save(str(path))
+
+def _write_pdf(path: Path, pages: List[List[str]]) -> None:
+    # insert_htmlbox подставляет шрифт с кириллицей, базовые 14 шрифтов PDF её не умеют
+    doc = fitz.open()
+    for paragraphs in pages:
+        page = doc.new_page()
+        page.insert_htmlbox(page.rect + (40, 40, -40, -40),
+                            "".join(f"<p>{html.escape(t)}</p>" for t in paragraphs),
+                            css="* {font-size: 9px;}")
+    doc.save(str(path))
+    doc.close()
+
+_WRITERS = {"pdf": _write_pdf, "docx": _write_docx, "txt": _write_txt}
+
+def generate(size: str, root: Path, seed: int = 0) -> Corpus:
+    """
+    Создаёт корпус размера size в root/size или берёт уже созданный — если он создан
+    с тем же seed и параметрами (corpus_spec) и все его файлы на месте; иначе пересоздаёт.
+    """
+    if size not in SIZES:
+        raise ValueError(f"Неизвестный размер корпуса {size!r} (есть: {', '.join(SIZES)})")
+    out = root / size
+    meta_path = out / "corpus.json"
+    spec = corpus_spec(size, seed)
+    if meta_path.exists():
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        files = [out / f for f in meta["files"]]
+        if {k: meta.get(k) for k in spec} == spec and all(p.exists() for p in files):
+            return Corpus(size, out, files, [Question(**q) for q in meta["questions"]], seed)
+        changed = {k: meta.get(k) for k in spec if meta.get(k) != spec[k]}
+        reason = f"создан с другими параметрами (было {changed})" if changed else "не все файлы на месте"
+        print(f"♻️ Корпус {out}: {reason} — пересоздаю")
+        meta_path.unlink()
+        for p in files:
+            p.unlink(missing_ok=True)
+
+    out.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(f"{seed}:{size}")
+    vocab = _vocabulary(rng)
+    weights = [1.0 / (i + 1) for i in range(len(vocab))]
+    n_docs, n_pages = SIZES[size]
+    files, questions = [], []
+    for fmt in FORMATS:
+        for i in range(n_docs):
+            name = f"{size}_{fmt}_{i:03d}.{fmt}"
+            pages, qs = _pages(rng, vocab, weights, f"{fmt[0]}{i}", n_pages)
+            _WRITERS[fmt](out / name, pages)
+            files.append(out / name)
+            questions += [Question(q.text, name, q.answer) for q in qs]
+    rng.shuffle(questions)
+    corpus = Corpus(size, out, files, questions, seed)
+    meta_path.write_text(json.dumps(corpus.manifest(), ensure_ascii=False), encoding="utf-8")
+    return corpus
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Заглушка сервиса эмбеддингов для бенчмарка: тот же контракт, что у backend/deploy.py
+(POST /embed, GET /healthz, JSON или бинарный формат backend/wire.py), без модели.
+
+Вектор — feature hashing слов текста в DIMENSION измерений со знаком и
+L2-нормализацией: детерминированный, и тексты с общими словами близки,
+так что поиск по вопросам корпуса осмысленный. Задержка модели имитируется
+sleep'ом: --delay-ms на запрос плюс --per-text-ms на каждый текст.
+
+    python -m bench.fake_embed --port 8765 --delay-ms 20 --per-text-ms 2
+"""
+
+import argparse
+import asyncio
+import re
+import zlib
+
+import numpy as np
+from aiohttp import web
+
+# Если запускаешь из папки bench/, гарантируем импорт конфига из корня
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from backend.config import DIMENSION
+from backend import wire
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+HASHES_PER_WORD = 4
+
+def hash_embed(texts: list[str], dim: int = DIMENSION) -> np.ndarray:
+    """[N, dim] float32, строки L2-нормализованы."""
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        words = _WORD_RE.findall(text.lower())
+        if not words:
+            out[i, 0] = 1.0
+            continue
+        h = np.array([zlib.crc32(f"{k}:{w}".encode()) for w in words for k in range(HASHES_PER_WORD)], dtype=np.uint64)
+        signs = np.where((h >> np.uint64(31)) & np.uint64(1), -1.0, 1.0).astype(np.float32)
+        np.add.at(out[i], (h % np.uint64(dim)).astype(np.int64), signs)
+        norm = np.linalg.norm(out[i])
+        if norm > 0:
+            out[i] /= norm
+        else:
+            out[i, 0] = 1.0
+    return out
+
+def make_app(delay_ms: float = 0.0, per_text_ms: float = 0.0, dim: int = DIMENSION) -> web.Application:
+    stats = {"requests": 0, "texts": 0}
+
+    async def embed(request: web.Request) -> web.Response:
+        texts = (await request.json()).get("texts") or []
+        stats["requests"] += 1
+        stats["texts"] += len(texts)
+        delay = (delay_ms + per_text_ms * len(texts)) / 1000
+        if delay > 0:
+            await asyncio.sleep(delay)
+        arr = hash_embed(texts, dim) if texts else np.zeros((0, dim), dtype=np.float32)
+        wire_dtype = wire.negotiate(request.headers.get("Accept"))
+        if wire_dtype is not None:
+            body, headers = wire.encode(arr, wire_dtype)
+            return web.Response(body=body, content_type=wire.MEDIA_TYPE, headers=headers)
+        return web.json_response({"embeddings": arr.tolist()})
+
+    async def healthz(_: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "device": "cpu", "model": "hash-stub", "backend": "stub",
+                                  "delay_ms": delay_ms, "per_text_ms": per_text_ms, **stats})
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/embed", embed)
+    app.router.add_get("/healthz", healthz)
+    return app
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Заглушка /embed с детерминированными векторами")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--delay-ms", type=float, default=0.0, help="задержка на запрос")
+    ap.add_argument("--per-text-ms", type=float, default=0.0, help="задержка на каждый текст в запросе")
+    args = ap.parse_args()
+    web.run_app(make_app(args.delay_ms, args.per_text_ms), host=args.host, port=args.port, print=None)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сквозной бенчмарк: индексация, поиск и ответ на вопрос — офлайн, на CPU.
+
+Для каждого размера корпуса (bench/corpus.py) отдельный процесс с чистой базой
+Milvus Lite, манифестом и BM25-индексом в рабочей директории:
+  index   — index_file по всем файлам, чанков/с всего и по форматам;
+  search  — search() по вопросам корпуса: p50/p95/p99 и hit rate (документ факта в выдаче);
+  grouped — то же для search_grouped_by_doc;
+  answer  — answer_with_top_docs целиком, lc_answer подменён заглушкой с задержкой.
+Кэши эмбеддингов, разобранных файлов и ответов выключены, кэши поиска в памяти
+сбрасываются перед каждой фазой — каждый вопрос идёт через /embed и Milvus.
+
+Эмбеддер — заглушка bench/fake_embed.py (по умолчанию) или настоящий deploy.py на CPU
+(--embedder deploy; модель должна лежать в кэше HF, сеть не используется).
+Результат — JSON; два прогона сравниваются через --compare.
+
+    python -m bench.run --sizes small,medium --embed-delay-ms 20 --llm-delay-ms 300
+    python -m bench.run --compare db/bench/results-old.json db/bench/results-new.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+import requests
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT))
+
+from bench.corpus import SIZES, Corpus, generate
+
+DEFAULT_DIR = ROOT / "db" / "bench"
+
+def latency_stats(ms: List[float]) -> Dict[str, float]:
+    a = np.asarray(ms, dtype=np.float64)
+    if a.size == 0:
+        return {"n": 0}
+    return {
+        "n": int(a.size),
+        "mean_ms": float(a.mean()),
+        "p50_ms": float(np.percentile(a, 50)),
+        "p95_ms": float(np.percentile(a, 95)),
+        "p99_ms": float(np.percentile(a, 99)),
+        "max_ms": float(a.max()),
+    }
+
+# -------------------- эмбеддер --------------------
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_embedder(kind: str, port: int, delay_ms: float, per_text_ms: float, log_path: Path) -> subprocess.Popen:
+    env = dict(os.environ)
+    if kind == "stub":
+        cmd = [sys.executable, "-m", "bench.fake_embed", "--port", str(port),
+               "--delay-ms", str(delay_ms), "--per-text-ms", str(per_text_ms)]
+        timeout = 60
+    else:
+        cmd = [sys.executable, str(ROOT / "backend" / "deploy.py")]
+        # только CPU и только локальный кэш модели
+        env.update(SERVICE_HOST="127.0.0.1", SERVICE_PORT=str(port), CUDA_VISIBLE_DEVICES="",
+                   HF_HUB_OFFLINE="1", TRANSFORMERS_OFFLINE="1")
+        timeout = 900
+    log = open(log_path, "w")
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"Эмбеддер завершился с кодом {proc.returncode}, лог: {log_path}")
+        try:
+            health = requests.get(f"http://127.0.0.1:{port}/healthz", timeout=2).json()
+            print(f"🧩 Эмбеддер {kind}: {health}")
+            return proc
+        except requests.RequestException:
+            time.sleep(0.5)
+    proc.terminate()
+    raise SystemExit(f"Эмбеддер не поднялся за {timeout} с, лог: {log_path}")
+
+# -------------------- прогон одного корпуса (дочерний процесс) --------------------
+def _fake_lc_answer(delay_ms: float):
+    def lc_answer(system_prompt: str, user_prompt: str) -> str:
+        time.sleep(delay_ms / 1000)
+        return f"Заглушка ответа ({len(system_prompt) + len(user_prompt)} символов промпта)."
+    return lc_answer
+
+def run_corpus(corpus: Corpus, n_queries: int, top_k: int, llm_delay_ms: float) -> Dict[str, Any]:
+    # backend импортируется здесь: конфиг читается из окружения, которое выставил родитель
+    from backend import config, rag_qa, gigachat_langchain, metrics
+    from backend.indexer import index_file
+    from backend.searcher import search, search_grouped_by_doc, clear_caches
+
+    rag_qa.lc_answer = gigachat_langchain.lc_answer = _fake_lc_answer(llm_delay_ms)
+
+    # --- индексация ---
+    by_format: Dict[str, Dict[str, float]] = {}
+    files = []
+    devnull = open(os.devnull, "w")
+    for path in corpus.files:
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(devnull):   # index_file печатает отчёт по каждому файлу
+            res = index_file(str(path), doc_name=path.name)   # вопросы корпуса ссылаются на имя файла
+        elapsed = time.perf_counter() - started
+        fmt = path.suffix.lstrip(".")
+        agg = by_format.setdefault(fmt, {"files": 0, "chunks": 0, "seconds": 0.0})
+        agg["files"] += 1
+        agg["chunks"] += res["chunks"]
+        agg["seconds"] += elapsed
+        files.append({"file": path.name, "chunks": res["chunks"], "seconds": elapsed})
+    total_chunks = sum(a["chunks"] for a in by_format.values())
+    total_s = sum(a["seconds"] for a in by_format.values())
+    for agg in by_format.values():
+        agg["chunks_per_s"] = agg["chunks"] / max(agg["seconds"], 1e-9)
+    index = {"files": len(files), "chunks": total_chunks, "seconds": total_s,
+             "chunks_per_s": total_chunks / max(total_s, 1e-9), "by_format": by_format, "per_file": files}
+    print(f"  index: {total_chunks} чанков за {total_s:.1f} с ({index['chunks_per_s']:.1f} чанков/с)")
+
+    questions = corpus.questions[:n_queries]
+    warmup = corpus.questions[n_queries:n_queries + 3] or questions[:3]
+
+    def phase(name: str, fn, hit=None) -> Dict[str, Any]:
+        clear_caches()
+        for q in warmup:
+            fn(q.text)
+        clear_caches()
+        ms, hits = [], 0
+        for q in questions:
+            started = time.perf_counter()
+            out = fn(q.text)
+            ms.append(1000 * (time.perf_counter() - started))
+            hits += hit is not None and bool(hit(q, out))
+        stats = latency_stats(ms)
+        if hit is not None:
+            stats["hit_rate"] = hits / max(len(questions), 1)
+        print(f"  {name}: p50={stats.get('p50_ms', 0):.1f} p95={stats.get('p95_ms', 0):.1f} "
+              f"p99={stats.get('p99_ms', 0):.1f} мс" + (f", hit rate {stats['hit_rate']:.2f}" if hit else ""))
+        return stats
+
+    result = {
+        "size": corpus.size,
+        "index": index,
+        "search": phase("search", lambda q: search(q, top_k=top_k),
+                        lambda q, hits: any(h.get("entity", {}).get("doc_name") == q.doc_name for h in hits)),
+        "grouped": phase("grouped", lambda q: search_grouped_by_doc(q, top_docs=5, chunks_per_doc=3),
+                         lambda q, docs: any(d["doc_name"] == q.doc_name for d in docs)),
+        "answer": phase("answer", lambda q: rag_qa.answer_with_top_docs(q, top_docs=5, chunks_per_doc=3)),
+        "config": {k: getattr(config, k) for k in (
+            "CHUNK_MODE", "SEARCH_MODE", "SEARCH_GROUPING", "INDEX_PROFILE", "VECTOR_STORAGE",
+            "MMR_ENABLED", "MERGE_NEIGHBOURS", "EMBED_WIRE_FORMAT", "INDEX_EMBED_INFLIGHT",
+        ) if hasattr(config, k)},
+    }
+    result["answer"]["llm_delay_ms"] = llm_delay_ms
+    if config.METRICS_ENABLED:
+        # разбивка по стадиям за весь прогон (индексация и все фазы вместе)
+        result["stages"] = [{"stage": st, "calls": n, "seconds": sec} for st, n, sec in metrics.stage_summary()]
+    return result
+
+def _child_env(work: Path, size: str, service_url: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update(
+        MILVUS_DB_PATH=str(work / "milvus.db"),
+        COLLECTION_NAME=f"bench_{size}",
+        MANIFEST_PATH=str(work / "manifest.sqlite"),
+        LEXICAL_INDEX_PATH=str(work / "lexical.sqlite"),
+        FULL_VECTORS_PATH=str(work / "full.f32"),
+        ANSWER_CACHE_PATH=str(work / "answers.sqlite"),
+        EMBED_CACHE_DIR=str(work / "embed_cache"),
+        PARSED_CACHE_DIR=str(work / "parsed"),
+        EMBED_CACHE_ENABLED="false",
+        PARSED_CACHE_ENABLED="false",
+        ANSWER_CACHE_ENABLED="false",
+        SERVICE_URL=service_url,
+        TQDM_DISABLE="1",
+    )
+    return env
+
+# -------------------- сравнение прогонов --------------------
+_COMPARE = [
+    ("index", "chunks_per_s", "чанков/с", True),
+    ("search", "p50_ms", "search p50", False),
+    ("search", "p95_ms", "search p95", False),
+    ("search", "p99_ms", "search p99", False),
+    ("grouped", "p95_ms", "grouped p95", False),
+    ("answer", "p95_ms", "answer p95", False),
+    ("search", "hit_rate", "search hit", True),
+]
+
+def compare(old_path: Path, new_path: Path) -> None:
+    old = {r["size"]: r for r in json.loads(old_path.read_text(encoding="utf-8"))["runs"]}
+    new = {r["size"]: r for r in json.loads(new_path.read_text(encoding="utf-8"))["runs"]}
+    print(f"{'размер':<8} {'метрика':<12} {'было':>10} {'стало':>10} {'Δ':>8}")
+    for size in [s for s in new if s in old]:
+        for phase, key, label, higher_better in _COMPARE:
+            a, b = old[size].get(phase, {}).get(key), new[size].get(phase, {}).get(key)
+            if a is None or b is None:
+                continue
+            delta = (b - a) / a * 100 if a else 0.0
+            worse = delta < -5 if higher_better else delta > 5
+            print(f"{size:<8} {label:<12} {a:>10.2f} {b:>10.2f} {delta:>+7.1f}%{' ⚠️' if worse else ''}")
+
+# -------------------- главная функция --------------------
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def main():
+    ap = argparse.ArgumentParser(description="Сквозной бенчмарк индексации, поиска и ответа")
+    ap.add_argument("--sizes", default="small", help=f"через запятую: {', '.join(SIZES)}")
+    ap.add_argument("--dir", type=Path, default=DEFAULT_DIR, help="корпуса, рабочие базы и результаты")
+    ap.add_argument("--out", type=Path, help="JSON с результатами (по умолчанию <dir>/results-<время>.json)")
+    ap.add_argument("--embedder", choices=("stub", "deploy"), default="stub")
+    ap.add_argument("--embed-delay-ms", type=float, default=20.0, help="заглушка: задержка на запрос /embed")
+    ap.add_argument("--embed-per-text-ms", type=float, default=2.0, help="заглушка: задержка на текст")
+    ap.add_argument("--llm-delay-ms", type=float, default=300.0, help="задержка заглушки lc_answer")
+    ap.add_argument("--queries", type=int, default=100)
+    ap.add_argument("--top-k", type=int, default=10)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--compare", nargs=2, type=Path, metavar=("OLD", "NEW"), help="сравнить два JSON и выйти")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    ap.add_argument("--result", type=Path, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.child:
+        corpus = generate(args.child, args.dir / "corpus", args.seed)
+        result = run_corpus(corpus, args.queries, args.top_k, args.llm_delay_ms)
+        args.result.write_text(json.dumps(result, ensure_ascii=False), encoding="utf-8")
+        return
+
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    unknown = [s for s in sizes if s not in SIZES]
+    if unknown:
+        raise SystemExit(f"Неизвестные размеры: {', '.join(unknown)} (есть: {', '.join(SIZES)})")
+    args.dir.mkdir(parents=True, exist_ok=True)
+    out = args.out or args.dir / f"results-{time.strftime('%Y%m%d-%H%M%S')}.json"
+
+    port = _free_port()
+    embedder = start_embedder(args.embedder, port, args.embed_delay_ms, args.embed_per_text_ms,
+                              args.dir / f"embedder-{args.embedder}.log")
+    runs = []
+    try:
+        for size in sizes:
+            corpus = generate(size, args.dir / "corpus", args.seed)
+            print(f"📚 {size}: {len(corpus.files)} файлов, {len(corpus.questions)} вопросов")
+            work = args.dir / "work" / size
+            shutil.rmtree(work, ignore_errors=True)
+            work.mkdir(parents=True)
+            result_path = work / "result.json"
+            cmd = [sys.executable, "-m", "bench.run", "--child", size, "--dir", str(args.dir),
+                   "--result", str(result_path), "--queries", str(args.queries), "--top-k", str(args.top_k),
+                   "--llm-delay-ms", str(args.llm_delay_ms), "--seed", str(args.seed)]
+            subprocess.run(cmd, cwd=ROOT, env=_child_env(work, size, f"http://127.0.0.1:{port}"), check=True)
+            runs.append(json.loads(result_path.read_text(encoding="utf-8")))
+    finally:
+        embedder.terminate()
+        embedder.wait(timeout=30)
+
+    report = {
+        "meta": {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "embedder": args.embedder,
+            "embed_delay_ms": args.embed_delay_ms if args.embedder == "stub" else None,
+            "embed_per_text_ms": args.embed_per_text_ms if args.embedder == "stub" else None,
+            "llm_delay_ms": args.llm_delay_ms,
+            "queries": args.queries,
+            "top_k": args.top_k,
+            "seed": args.seed,
+        },
+        "runs": runs,
+    }
+    out.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"💾 {out}")
+
+if __name__ == "__main__":
+    main()
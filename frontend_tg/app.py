@@ -3,6 +3,8 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 import asyncio
 import logging
 import sys
+import time
+from contextlib import asynccontextmanager
 from os import getenv
 from pathlib import Path
 from datetime import datetime
@@ -10,6 +12,7 @@ from datetime import datetime
 from aiogram import Bot, Dispatcher, html, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import CommandStart
 from aiogram.types import (
     Message,
@@ -18,9 +21,18 @@ from aiogram.types import (
     CallbackQuery,
     ReplyKeyboardRemove,
 )
-from backend.indexer import index_file
 from backend.searcher import search  # подключаем поиск
-from backend.rag_qa import answer_with_top_docs
+from backend.rag_qa import aanswer_with_top_docs, astream_answer_with_top_docs
+from backend.async_search import close_http_session
+from backend import metrics
+from backend.config import (
+    BOT_MAX_CONCURRENT_QUESTIONS, BOT_USER_MAX_CONCURRENCY,
+    BOT_STREAM_ANSWERS, BOT_STREAM_EDIT_INTERVAL, BOT_SEARCH_SCOPE,
+    INDEX_QUEUE_WORKERS, INDEX_QUEUE_MAX_PENDING, INDEX_QUEUE_MAX_PER_USER, INDEX_PROGRESS_INTERVAL,
+)
+from frontend_tg.index_queue import IndexQueue, IndexQueueFull
+
+logger = logging.getLogger(__name__)
 
 # Bot token can be obtained via https://t.me/BotFather
 TOKEN = getenv("BOT_TOKEN")
@@ -35,6 +47,110 @@ start_keyboard = InlineKeyboardMarkup(
     ]
 )
 
+# === Ограничения параллельности вопросов ===
+class UserLimiter:
+    """Не больше per_user одновременных вопросов от одного пользователя и total на весь бот."""
+
+    def __init__(self, per_user: int, total: int):
+        self.per_user = max(1, per_user)
+        self._total = asyncio.Semaphore(max(1, total))
+        self._users: dict[int, tuple[asyncio.Semaphore, int]] = {}
+
+    def busy(self, user_id: int) -> bool:
+        entry = self._users.get(user_id)
+        return entry is not None and entry[0].locked()
+
+    @asynccontextmanager
+    async def slot(self, user_id: int):
+        sem, refs = self._users.get(user_id) or (asyncio.Semaphore(self.per_user), 0)
+        self._users[user_id] = (sem, refs + 1)
+        try:
+            async with sem, self._total:
+                yield
+        finally:
+            sem, refs = self._users[user_id]
+            if refs <= 1:
+                del self._users[user_id]   # не копим семафоры ушедших пользователей
+            else:
+                self._users[user_id] = (sem, refs - 1)
+
+question_limiter = UserLimiter(BOT_USER_MAX_CONCURRENCY, BOT_MAX_CONCURRENT_QUESTIONS)
+
+# === Очередь индексации ===
+index_queue = IndexQueue(INDEX_QUEUE_WORKERS, INDEX_QUEUE_MAX_PENDING, INDEX_QUEUE_MAX_PER_USER, INDEX_PROGRESS_INTERVAL)
+
+# === Область поиска ===
+def search_owner(user_id: int) -> str | None:
+    """owner для поиска по вопросу: свои документы пользователя и общие; None — вся база (scope all)."""
+    return str(user_id) if BOT_SEARCH_SCOPE == "own" else None
+
+# === Стриминг ответа в сообщение ===
+class StreamingReply:
+    """
+    Дописывает ответ в уже отправленное сообщение правками не чаще interval секунд.
+    Текст длиннее лимита Telegram продолжается в следующем сообщении.
+    Неудачная правка не прерывает ответ: текст копится дальше, а окончательный
+    текст, который не удалось вписать правкой, уходит новым сообщением.
+    """
+
+    LIMIT = 4096
+    CURSOR = " ▌"
+
+    def __init__(self, message: Message, interval: float):
+        self.message = message
+        self.interval = interval
+        self.text = ""
+        self._shown = ""
+        self._last_edit = 0.0
+
+    async def _edit(self, text: str) -> bool:
+        """Правка сообщения; False — Telegram её не принял (ошибка в лог, следующая правка — через interval)."""
+        if text == self._shown:
+            return True
+        try:
+            try:
+                await self.message.edit_text(text, parse_mode=None)
+            except TelegramRetryAfter as e:
+                # флуд-контроль: ждём сколько просят и пробуем ещё раз
+                await asyncio.sleep(e.retry_after)
+                await self.message.edit_text(text, parse_mode=None)
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e):
+                logger.warning("Не удалось обновить ответ: %s", e)
+                self._last_edit = time.monotonic()
+                return False
+        except TelegramAPIError as e:
+            logger.warning("Не удалось обновить ответ: %s", e)
+            self._last_edit = time.monotonic()
+            return False
+        self._shown = text
+        self._last_edit = time.monotonic()
+        return True
+
+    async def _settle(self, text: str) -> None:
+        """Окончательный текст сообщения: правкой, а если не вышло — новым сообщением."""
+        if not await self._edit(text):
+            await self.message.answer(text, parse_mode=None)
+
+    async def push(self, delta: str) -> None:
+        self.text += delta
+        limit = self.LIMIT - len(self.CURSOR)
+        while len(self.text) > limit:
+            cut = self.text.rfind("\n", 0, limit)
+            if cut < limit // 2:
+                cut = self.text.rfind(" ", 0, limit)
+            if cut < limit // 2:
+                cut = limit
+            head, self.text = self.text[:cut], self.text[cut:].lstrip()
+            await self._settle(head)
+            self.message = await self.message.answer("…", parse_mode=None)
+            self._shown = "…"
+        if self.text.strip() and time.monotonic() - self._last_edit >= self.interval:
+            await self._edit(self.text + self.CURSOR)
+
+    async def finish(self) -> None:
+        await self._settle(self.text if self.text.strip() else "Пустой ответ модели.")
+
 # All handlers should be attached to the Router (or Dispatcher)
 
 dp = Dispatcher()
@@ -99,24 +215,36 @@ async def handle_document(message: Message, bot: Bot) -> None:
     await message.answer(
         "✅ Файл получен.\n"
         f"Путь: <code>{dest_path.as_posix()}</code>\n"
-        "Начинаю индексацию… Это может занять немного времени."
+        "Ставлю в очередь на индексацию…"
     )
+    # это сообщение очередь правит: позиция, затем прогресс
+    status = await message.answer("⏳ В очереди на индексацию…")
 
-    def _run():
-        index_file(str(dest_path))
-
-    loop = asyncio.get_running_loop()
+    user_id = message.from_user.id if message.from_user else message.chat.id
     try:
-        await loop.run_in_executor(None, _run)
+        job = await index_queue.submit(user_id, dest_path, original_name, status)
+        result = await job.wait()
         # После успешной индексации показываем клавиатуру
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
                 [InlineKeyboardButton(text="💬 Начать ответы по документам", callback_data="start_qa")]
             ]
         )
-        await message.answer("✅ Индексация завершена. Файл добавлен в БД Milvus.", reply_markup=keyboard)
+        if result.get("skipped"):
+            text = "✅ Этот файл уже есть в базе — повторная индексация не нужна."
+        else:
+            text = f"✅ Индексация завершена. Файл добавлен в БД Milvus ({result.get('chunks', 0)} фрагментов)."
+        await status.edit_text(text, parse_mode=None)
+        await message.answer("Можно задавать вопросы.", reply_markup=keyboard)
+    except IndexQueueFull as e:
+        await status.edit_text("⚠️ " + str(e), parse_mode=None)
     except Exception as e:
-        await message.answer("❌ Ошибка индексации:\n" + html.code(str(e)))
+        # статус-сообщение не должно застрять на «Индексирую…»
+        text = f"❌ Ошибка индексации «{html.quote(original_name)}»:\n" + html.code(html.quote(str(e)))
+        try:
+            await status.edit_text(text)
+        except TelegramAPIError:
+            await message.answer(text)
 
 @dp.callback_query(F.data == "start_qa")
 async def on_start_qa(callback: CallbackQuery) -> None:
@@ -135,23 +263,44 @@ async def handle_question(message: Message) -> None:
     if not query:
         return
 
-    await message.answer("🔎 Ищу ответ по документам…")
+    user_id = message.from_user.id if message.from_user else message.chat.id
+    if question_limiter.busy(user_id):
+        await message.answer("⏳ Предыдущий вопрос ещё обрабатывается — этот отвечу следом.")
 
-    try:
-        # можно answer_with_top_chunks(query, top_k=10)
-        answer = answer_with_top_docs(query, top_docs=5, chunks_per_doc=3)
-        await message.answer(answer, parse_mode=None)  # без HTML-парсинга – безопасно
-    except Exception as e:
-        # не даём Телеграму парсить угловые скобки из трейсбеков
-        await message.answer(f"⚠️ Ошибка поиска/генерации:\n{e}", parse_mode=None)
+    metrics.inc("questions")
+    async with question_limiter.slot(user_id):
+        status = await message.answer("🔎 Ищу ответ по документам…")
+
+        try:
+            # трасса вопроса: медленные (METRICS_SLOW_SECONDS) пишутся в лог с разбивкой по стадиям
+            with metrics.trace("question"):
+                owner = search_owner(user_id)
+                if BOT_STREAM_ANSWERS:
+                    # ответ появляется в сообщении-статусе по мере генерации
+                    reply = StreamingReply(status, BOT_STREAM_EDIT_INTERVAL)
+                    async for delta in astream_answer_with_top_docs(query, top_docs=5, chunks_per_doc=3, owner=owner):
+                        await reply.push(delta)
+                    await reply.finish()
+                else:
+                    # можно aanswer_with_top_chunks(query, top_k=10)
+                    answer = await aanswer_with_top_docs(query, top_docs=5, chunks_per_doc=3, owner=owner)
+                    await message.answer(answer, parse_mode=None)  # без HTML-парсинга – безопасно
+        except Exception as e:
+            metrics.inc("question_errors")
+            # не даём Телеграму парсить угловые скобки из трейсбеков
+            await message.answer(f"⚠️ Ошибка поиска/генерации:\n{e}", parse_mode=None)
 
         
 async def main() -> None:
     # Initialize Bot instance with default bot properties which will be passed to all API calls
     bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    metrics.start_exporter()   # /metrics на METRICS_PORT, если включено
 
     # And the run events dispatching
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await close_http_session()
 
 
 if __name__ == "__main__":
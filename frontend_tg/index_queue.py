@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Очередь индексации загруженных в бот файлов.
+
+- одновременно индексируется не больше workers файлов (свой пул потоков,
+  дефолтный executor не занимаем);
+- пользователи обслуживаются по кругу: пачка файлов от одного не задерживает
+  остальных больше чем на один файл;
+- файл с тем же содержимым (sha256) от того же пользователя, который уже ждёт
+  или индексируется, повторно в очередь не ставится — статус подписывается на ту же
+  задачу (у разных пользователей свои копии: документ индексируется с owner = id загрузившего);
+- документ называется исходным именем загрузки: новая версия файла с тем же именем
+  заменяет старую; версии одного документа индексируются строго по очереди;
+- позиция в очереди и прогресс показываются правками статус-сообщений; позиции
+  обновляются фоновой задачей, воркер их не ждёт.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
+
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from aiogram.types import Message
+
+from backend.indexer import index_file
+from backend.manifest import file_hash
+
+logger = logging.getLogger(__name__)
+
+class IndexQueueFull(RuntimeError):
+    pass
+
+@dataclass(eq=False)
+class IndexJob:
+    user_id: int
+    path: Path
+    doc_name: str
+    content_hash: str
+    future: asyncio.Future
+    messages: list[Message] = field(default_factory=list)
+    running: bool = False
+    chunks_done: int = 0
+
+    def add_chunks(self, n: int) -> None:
+        # вызывается из потока индексации; int += под GIL достаточно для счётчика прогресса
+        self.chunks_done += n
+
+    async def wait(self) -> dict:
+        """Результат index_file. shield — отмена одного ожидающего не отменяет задачу для остальных."""
+        return await asyncio.shield(self.future)
+
+class IndexQueue:
+    def __init__(self, workers: int, max_pending: int, max_per_user: int, progress_interval: float):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self.progress_interval = progress_interval
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="index")
+        self._per_user: dict[int, deque[IndexJob]] = {}
+        self._turns: deque[int] = deque()          # пользователи с задачами, по кругу
+        self._by_hash: dict[tuple[int, str], IndexJob] = {}    # (user_id, sha256) ждущих и выполняющихся задач
+        # (user_id, doc_name) -> (лок индексации документа, сколько задач его держат или ждут)
+        self._doc_locks: dict[tuple[int, str], tuple[asyncio.Lock, int]] = {}
+        self._shown: dict[tuple[int, int], str] = {}   # (chat_id, message_id) -> текст статуса
+        self._ready: asyncio.Condition | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._refresher: asyncio.Task | None = None
+        self._refresh_again = False
+
+    # -------------------- постановка --------------------
+    async def submit(self, user_id: int, path: Path, doc_name: str, status: Message) -> IndexJob:
+        """
+        Ставит файл в очередь (или подписывает status на такую же задачу). Ждать — job.wait().
+        doc_name — имя документа в индексе (исходное имя загрузки).
+        """
+        self._start()
+        content_hash = await asyncio.to_thread(file_hash, str(path))
+        job = self._by_hash.get((user_id, content_hash))
+        if job is not None:
+            job.messages.append(status)
+            await self._edit(status, self._status_text(job))
+            return job
+
+        pending = sum(len(q) for q in self._per_user.values())
+        if pending >= self.max_pending:
+            raise IndexQueueFull("Очередь индексации переполнена, попробуй чуть позже.")
+        if len(self._per_user.get(user_id, ())) >= self.max_per_user:
+            raise IndexQueueFull(f"У тебя уже {self.max_per_user} файлов в очереди — дождись их индексации.")
+
+        job = IndexJob(user_id, path, doc_name, content_hash, asyncio.get_running_loop().create_future(), [status])
+        self._by_hash[(user_id, content_hash)] = job
+        if user_id not in self._per_user:
+            self._per_user[user_id] = deque()
+            self._turns.append(user_id)
+        self._per_user[user_id].append(job)
+        async with self._ready:
+            self._ready.notify()
+        self._schedule_refresh()
+        return job
+
+    def _start(self) -> None:
+        if self._tasks:
+            return
+        self._ready = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker(), name=f"index-worker-{i}") for i in range(self.workers)]
+
+    # -------------------- порядок обслуживания --------------------
+    def _order(self) -> list[IndexJob]:
+        """Ждущие задачи в порядке, в котором их возьмут воркеры (по кругу между пользователями)."""
+        queues = [self._per_user[u] for u in self._turns]
+        out: list[IndexJob] = []
+        depth = 0
+        while True:
+            layer = [q[depth] for q in queues if depth < len(q)]
+            if not layer:
+                return out
+            out += layer
+            depth += 1
+
+    async def _next(self) -> IndexJob:
+        async with self._ready:
+            await self._ready.wait_for(lambda: bool(self._turns))
+            user_id = self._turns.popleft()
+            queue = self._per_user[user_id]
+            job = queue.popleft()
+            if queue:
+                self._turns.append(user_id)
+            else:
+                del self._per_user[user_id]
+            return job
+
+    # -------------------- выполнение --------------------
+    async def _worker(self) -> None:
+        while True:
+            job = await self._next()
+            # всё про задачу — под try: ошибка одной задачи (в том числе правки статусов)
+            # не должна останавливать воркер и оставлять её ожидающих без ответа
+            try:
+                await self._run(job)
+            except Exception as e:
+                logger.exception("Ошибка индексации %s", job.path)
+                if not job.future.done():
+                    job.future.set_exception(e)
+
+    async def _run(self, job: IndexJob) -> None:
+        loop = asyncio.get_running_loop()
+        job.running = True
+        progress: asyncio.Task | None = None
+        try:
+            self._schedule_refresh()
+            progress = asyncio.create_task(self._report_progress(job))
+            # две версии одного документа параллельно перемешали бы его чанки
+            async with self._doc_lock((job.user_id, job.doc_name)):
+                result = await loop.run_in_executor(
+                    self._executor,
+                    # pdf_workers=1: spawn-воркеры разбора PDF заново импортировали бы
+                    # frontend_tg/app.py как __mp_main__ (aiogram, LangChain, запуск бота)
+                    partial(index_file, str(job.path), content_hash=job.content_hash, on_chunks=job.add_chunks,
+                            owner=str(job.user_id), doc_name=job.doc_name, pdf_workers=1),
+                )
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            if progress is not None:
+                progress.cancel()
+            self._by_hash.pop((job.user_id, job.content_hash), None)
+            for m in job.messages:
+                self._shown.pop((m.chat.id, m.message_id), None)
+
+    @asynccontextmanager
+    async def _doc_lock(self, key: tuple[int, str]):
+        lock, refs = self._doc_locks.get(key) or (asyncio.Lock(), 0)
+        self._doc_locks[key] = (lock, refs + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, refs = self._doc_locks[key]
+            if refs <= 1:
+                del self._doc_locks[key]   # не копим локи документов, которые больше не индексируются
+            else:
+                self._doc_locks[key] = (lock, refs - 1)
+
+    async def _report_progress(self, job: IndexJob) -> None:
+        started = time.monotonic()
+        while True:
+            for m in list(job.messages):
+                await self._edit(m, self._status_text(job, time.monotonic() - started))
+            await asyncio.sleep(self.progress_interval)
+
+    # -------------------- статус-сообщения --------------------
+    def _status_text(self, job: IndexJob, elapsed: float | None = None) -> str:
+        name = job.doc_name
+        if job.running:
+            text = f"⚙️ Индексирую «{name}»… обработано фрагментов: {job.chunks_done}"
+            return text + (f" ({elapsed:.0f} с)" if elapsed else "")
+        order = self._order()
+        pos = order.index(job) + 1 if job in order else 1
+        return f"⏳ «{name}» в очереди на индексацию: позиция {pos} из {len(order)}."
+
+    def _schedule_refresh(self) -> None:
+        """Обновить позиции в очереди в фоне; запросы во время обновления схлопываются в ещё один проход."""
+        self._refresh_again = True
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.create_task(self._refresh_positions())
+
+    async def _refresh_positions(self) -> None:
+        try:
+            while self._refresh_again:
+                self._refresh_again = False
+                for job in self._order():
+                    for m in list(job.messages):
+                        # пока шли правки, задачу могли взять в работу — её статус ведёт _report_progress
+                        if job.running:
+                            break
+                        await self._edit(m, self._status_text(job))
+        except Exception:
+            logger.exception("Не удалось обновить позиции в очереди индексации")
+
+    async def _edit(self, message: Message, text: str) -> None:
+        key = (message.chat.id, message.message_id)
+        if self._shown.get(key) == text:
+            return
+        try:
+            await message.edit_text(text, parse_mode=None)
+            self._shown[key] = text
+        except TelegramRetryAfter as e:
+            logger.info("Telegram просит подождать %s с — пропускаю обновление статуса", e.retry_after)
+        except TelegramAPIError as e:
+            # сообщение удалено, сеть, лимиты — статус не главное, индексация идёт дальше
+            if "not modified" not in str(e):
+                logger.warning("Не удалось обновить статус индексации: %s", e)